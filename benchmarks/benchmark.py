@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import argparse
+import contextlib
+import copy
+import gc
+import importlib.util
+import io
+import json
+import pathlib
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+benchmark_path = pathlib.Path(__file__).absolute()
+baseline_path = benchmark_path.with_name('baseline.json')
+wg_wizard_path = benchmark_path.parent.parent / 'wg-wizard.py'
+scenarios = OrderedDict([
+    ('small', OrderedDict([('peers', 10), ('rules', 2), ('width', 1)])),
+    ('medium', OrderedDict([('peers', 100), ('rules', 10), ('width', 10)])),
+    ('max-peers', OrderedDict([('peers', 253), ('rules', 20), ('width', 10)])),
+    ('wide-ranges', OrderedDict([('peers', 253), ('rules', 4), ('width', 64)])),
+    ('sharded', OrderedDict([('peers', 1000), ('rules', 2), ('width', 1)])),
+])
+# Timings below the noise floor are never reported as regressions.
+noise_floor_seconds = 0.005
+noise_floor_kib = 64
+
+def load_wg_wizard():
+    spec = importlib.util.spec_from_file_location('wg_wizard', str(wg_wizard_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['wg_wizard'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def generate_config(peers, rules, width):
+    # Ranges of every peer alternate between tcp and udp and are separated by one unused port, so nothing is merged by normalize_config.
+    config = OrderedDict()
+    next_port = {'tcp': 1024, 'udp': 1024}
+
+    for i in range(peers):
+        forward_rules = []
+        for j in range(rules):
+            protocol = ['tcp', 'udp'][j % 2]
+            start_port = next_port[protocol]
+            end_port = start_port + width - 1
+            if end_port > 65535:
+                raise ValueError(f"{peers} peers with {rules} rules of width {width} do not fit into the port space.")
+            forward_rules.append(OrderedDict([('protocol', protocol), ('port-range', str(start_port) if width == 1 else f"{start_port}-{end_port}")]))
+            next_port[protocol] = end_port + 2
+        config[f"peer{i}"] = forward_rules
+
+    return config
+
+def fake_docker_run(wg_wizard):
+    def handler(executor, command):
+        peers = re.search(r'PEERS="([^"]*)"', command).group(1).split(',')
+        config_path = wg_wizard.pathlib.Path(re.search(r'-v "([^"]*)":/config', command).group(1))
+        subnet = re.search(r'INTERNAL_SUBNET=([0-9.]+)\.0 ', command).group(1)
+        wg0_config = ["[Interface]", f"Address = {subnet}.1", "ListenPort = 51820", "PrivateKey = server", "PostUp = iptables -A FORWARD -i %i -j ACCEPT", "PostDown = iptables -D FORWARD -i %i -j ACCEPT"]
+        for peer in peers:
+            public_key = executor.read_text(config_path / f"peer_{peer}/publickey-peer_{peer}").strip()
+            wg0_config += ["", "[Peer]", f"# peer_{peer}", f"PublicKey = {public_key}"]
+        executor.store(config_path / 'wg_confs/wg0.conf', '\n'.join(wg0_config) + '\n', None)
+        return 0, ''
+
+    return handler
+
+def fake_executor(wg_wizard, config, files=None):
+    executor = wg_wizard.FakeExecutor(files=files, handlers=[
+        (r'^sudo ss ', lambda executor, command: (0, 'tcp LISTEN 0 128 0.0.0.0:22 0.0.0.0:* users:(("sshd",pid=1,fd=3))\n')),
+        (r'^sudo docker run ', fake_docker_run(wg_wizard)),
+    ])
+    executor.files[wg_wizard.program_config_path] = json.dumps(config)
+    executor.files[wg_wizard.ufw_user_rules_path] = "*filter\n### RULES ###\n\n### END RULES ###\nCOMMIT\n"
+    return executor
+
+def ufw_executor(wg_wizard, config, batched):
+    # Every ufw call starts a process, as ufw itself would, so the per-rule path pays for one process start per rule.
+    executor = fake_executor(wg_wizard, config)
+    executor.handlers[:0] = [(r'^sudo ufw ', lambda executor, command: (subprocess.run(['true']).returncode, ''))]
+    if not batched:
+        del executor.files[wg_wizard.ufw_user_rules_path]
+    return executor
+
+def fake_counters(wg_wizard, executor, config, assignment):
+    # Output in the formats of 'wg show wg0 dump' and 'iptables -t nat -L PREROUTING -v -x -n', with one line per peer and forward rule.
+    wg_dump = ["privatekey\tpublickey\t51820\toff"]
+    iptables_counters = ["Chain PREROUTING (policy ACCEPT 0 packets, 0 bytes)", "    pkts      bytes target     prot opt in     out     source               destination"]
+
+    for i, (peer, forward_rules) in enumerate(config.items()):
+        shard, address = assignment[peer]
+        public_key = executor.read_text(wg_wizard.get_shard_path(shard) / f"peer_{peer}/publickey-peer_{peer}").strip()
+        wg_dump.append(f"{public_key}\t(none)\t198.51.100.1:{1024 + i}\t{address}/32\t{1700000000 + i}\t{i * 1000}\t{i * 2000}\toff")
+        for forward_rule in forward_rules:
+            dport = f"dpt:{forward_rule['port-range']}" if '-' not in forward_rule['port-range'] else f"dpts:{forward_rule['port-range'].replace('-', ':')}"
+            iptables_counters.append(f"{i:>8} {i * 60:>8} DNAT       {forward_rule['protocol']:<4} --  eth+   *       0.0.0.0/0            0.0.0.0/0            {forward_rule['protocol']} {dport} to:{address}")
+
+    return '\n'.join(wg_dump) + '\n', '\n'.join(iptables_counters) + '\n'
+
+def collect_port_intervals(wg_wizard, config):
+    port_intervals = {'tcp': [], 'udp': []}
+
+    for peer, forward_rules in config.items():
+        for forward_rule in forward_rules:
+            port_intervals[forward_rule['protocol']].append(wg_wizard.parse_port_range(forward_rule['port-range']) + (peer,))
+
+    return port_intervals
+
+def find_port_conflicts_with_sets(intervals):
+    # The check verify_config used before the interval sweep, kept as a reference: every range is expanded into a set of ports.
+    conflicts = []
+    used_ports = {}
+
+    for interval in intervals:
+        ports = set(range(interval[0], interval[1] + 1))
+        conflicts.extend(set(used_ports[e] for e in ports if e in used_ports))
+        used_ports.update((e, interval) for e in ports)
+
+    return conflicts
+
+def build_stages(wg_wizard, config):
+    # Each stage is (setup, run). setup prepares the input outside of the measurement and returns it to run.
+    normalized = wg_wizard.normalize_config(copy.deepcopy(config))
+    seeded = fake_executor(wg_wizard, config)
+    shards = wg_wizard.count_shards(seeded, normalized)
+    assignment = wg_wizard.assign_peer_addresses(seeded, normalized, shards)
+    _, peer_configs = wg_wizard.seed_wireguard_config(seeded, normalized, '192.0.2.1', assignment)
+    wg0_config_text = "[Interface]\nPostUp = x\nPostDown = y\n"
+    wg_dump, iptables_counters = fake_counters(wg_wizard, seeded, normalized, assignment)
+
+    def metrics_collector():
+        # Labels are built outside of the measurement, so the stage times a scrape of a server that is already running.
+        executor = fake_executor(wg_wizard, config, files=seeded.files)
+        executor.handlers[:0] = [(r' wg show ', lambda executor, command: (0, wg_dump)), (r' iptables -t nat -L ', lambda executor, command: (0, iptables_counters))]
+        collector = wg_wizard.MetricsCollector(executor)
+        collector.reload()
+        return collector
+
+    stages = OrderedDict()
+    stages['verify'] = (lambda: copy.deepcopy(config), lambda e: wg_wizard.verify_config(e))
+    stages['conflicts'] = (lambda: collect_port_intervals(wg_wizard, config), lambda e: [wg_wizard.find_port_conflicts(intervals) for intervals in e.values()])
+    stages['conflicts-set'] = (lambda: collect_port_intervals(wg_wizard, config), lambda e: [find_port_conflicts_with_sets(intervals) for intervals in e.values()])
+    stages['normalize'] = (lambda: config, lambda e: wg_wizard.normalize_config(e))
+    stages['assign'] = (lambda: fake_executor(wg_wizard, config, files=seeded.files), lambda e: wg_wizard.assign_peer_addresses(e, normalized, shards))
+    stages['render-ufw'] = (lambda: normalized, lambda e: wg_wizard.render_ufw_rules(wg_wizard.render_ufw_allow_rules(e, ['22'], shards), '0.0.0.0/0', 'ufw-user-input'))
+    stages['ufw'] = (lambda: ufw_executor(wg_wizard, config, True), lambda e: wg_wizard.configure_ufw(e, wg_wizard.render_ufw_allow_rules(normalized, ['22'], shards)))
+    stages['ufw-per-rule'] = (lambda: ufw_executor(wg_wizard, config, False), lambda e: wg_wizard.configure_ufw(e, wg_wizard.render_ufw_allow_rules(normalized, ['22'], shards)))
+    stages['render-docker-run'] = (lambda: wg_wizard.split_config(normalized, assignment, shards), lambda e: [wg_wizard.render_docker_run(shard_config, '192.0.2.1', shard) for shard, shard_config in enumerate(e)])
+    stages['render-wg0'] = (lambda: wg_wizard.split_config(normalized, assignment, shards), lambda e: [wg_wizard.render_wg0_config(wg0_config_text, *wg_wizard.render_wg0_postup_postdown(shard_config, assignment)) for shard_config in e])
+    stages['render-nft'] = (lambda: wg_wizard.split_config(normalized, assignment, shards), lambda e: [wg_wizard.render_nft_ruleset(shard_config, assignment) for shard_config in e])
+    stages['keys'] = (lambda: fake_executor(wg_wizard, config), lambda e: wg_wizard.seed_wireguard_config(e, normalized, '192.0.2.1', assignment))
+    stages['scripts'] = (lambda: fake_executor(wg_wizard, config), lambda e: wg_wizard.write_auto_setup_scripts(e, normalized, peer_configs))
+    stages['metrics'] = (metrics_collector, lambda e: e.collect())
+    stages['provision'] = (lambda: fake_executor(wg_wizard, config, files=seeded.files), lambda e: wg_wizard.main(['--server-url', '192.0.2.1', '--force'], executor=e))
+    return stages
+
+def measure(setup, run, repeat):
+    # The median of several runs is reported, as a single slow or fast run on a busy machine would move it less than the minimum.
+    # Like timeit, garbage left by earlier stages is collected first and the collector is paused while a run is timed.
+    seconds = []
+
+    for _ in range(repeat):
+        argument = setup()
+        gc.collect()
+        gc.disable()
+
+        try:
+            start_time = time.perf_counter()
+            run(argument)
+            seconds.append(time.perf_counter() - start_time)
+        finally:
+            gc.enable()
+
+    # Peak memory is measured in a separate run because tracing allocations slows everything down.
+    argument = setup()
+    tracemalloc.start()
+    run(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return OrderedDict([('seconds', statistics.median(seconds)), ('peak_kib', peak / 1024)])
+
+def run_benchmarks(wg_wizard, selected_scenarios, repeat):
+    results = OrderedDict()
+
+    for name, parameters in selected_scenarios.items():
+        config = generate_config(**parameters)
+        results[name] = OrderedDict()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            stages = build_stages(wg_wizard, config)
+
+        for stage, (setup, run) in stages.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name][stage] = measure(setup, run, repeat)
+            wg_wizard.print_info(f"{name:<12}{stage:<18}{results[name][stage]['seconds'] * 1000:>10.2f} ms{results[name][stage]['peak_kib']:>12.1f} KiB")
+
+    return results
+
+def find_regressions(results, baseline, tolerance, time_tolerance):
+    regressions = []
+
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            if name not in baseline or stage not in baseline[name]:
+                continue
+            expected = baseline[name][stage]
+            if result['seconds'] > max(expected['seconds'] * time_tolerance, expected['seconds'] + noise_floor_seconds):
+                regressions.append(f"{name} {stage}: {result['seconds'] * 1000:.2f} ms, baseline {expected['seconds'] * 1000:.2f} ms")
+            if result['peak_kib'] > max(expected['peak_kib'] * tolerance, expected['peak_kib'] + noise_floor_kib):
+                regressions.append(f"{name} {stage}: {result['peak_kib']:.1f} KiB, baseline {expected['peak_kib']:.1f} KiB")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark config validation, rule rendering and script generation of wg-wizard.py on synthetic configurations.")
+    parser.add_argument('--scenario', action='append', choices=list(scenarios.keys()), help="scenario to run, can be given more than once (default: all)")
+    parser.add_argument('--repeat', type=int, default=5, help="number of timed runs per stage, the median is reported (default: %(default)s)")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="factor over the baseline peak memory that counts as a regression (default: %(default)s)")
+    parser.add_argument('--time-tolerance', type=float, default=2.5, help="factor over the baseline time that counts as a regression. The median time of a stage still varies by up to 2x between runs on a shared machine (default: %(default)s)")
+    parser.add_argument('--update-baseline', action='store_true', help=f"store the results as the new baseline in {baseline_path.name}")
+    parser.add_argument('--write-config', metavar='PATH', help="write the configuration of the first selected scenario as a wg-wizard.json file and exit")
+    args = parser.parse_args()
+
+    wg_wizard = load_wg_wizard()
+    selected_scenarios = OrderedDict([(e, scenarios[e]) for e in (args.scenario or scenarios.keys())])
+
+    if args.write_config:
+        with open(args.write_config, 'w', encoding='utf-8') as f:
+            json.dump(generate_config(**next(iter(selected_scenarios.values()))), f, indent=2, sort_keys=False)
+        return
+
+    results = run_benchmarks(wg_wizard, selected_scenarios, args.repeat)
+
+    if args.update_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding='utf-8'), object_pairs_hook=OrderedDict) if baseline_path.is_file() else OrderedDict()
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=False) + '\n', encoding='utf-8')
+        wg_wizard.print_info(f"{str(baseline_path)} has been updated.")
+        return
+
+    if not baseline_path.is_file():
+        wg_wizard.print_warn(f"{str(baseline_path)} cannot be found. Run with --update-baseline to create it.")
+        return
+
+    regressions = find_regressions(results, json.loads(baseline_path.read_text(encoding='utf-8')), args.tolerance, args.time_tolerance)
+
+    if len(regressions) > 0:
+        for regression in regressions:
+            wg_wizard.print_error(f"Regression. {regression}")
+        sys.exit(1)
+
+    wg_wizard.print_info("No regressions against the baseline.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+from collections import OrderedDict
+import argparse
+import json
+import os
+import pathlib
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchmark
+
+dataplane_path = pathlib.Path(__file__).absolute()
+# The internet namespace reaches the server on its uplink, the server forwards to the peers in the client namespace.
+# The peers sit on a veth instead of a wireguard tunnel, so only the forward rules are measured and not the encryption.
+namespaces = OrderedDict([('server', 'wgw-server'), ('client', 'wgw-client'), ('internet', 'wgw-internet')])
+uplink = 'wgw-up'
+peer_link = 'wg0'
+server_uplink_address = '10.200.0.1'
+internet_address = '10.200.0.2'
+forward_backends = ['none', 'iptables', 'nft']
+udp_payload_size = 1400
+tcp_chunk_size = 65536
+
+def run(command, input=None):
+    return subprocess.run(command.split(), input=input, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+def netns_exec(name, command, input=None):
+    return run(f"ip netns exec {namespaces[name]} {command}", input)
+
+def build_config(wg_wizard, rule_count):
+    # Every peer gets at least one tcp and one udp rule, and the peers are filled up to max_peers before a peer gets more rules.
+    peers = min(wg_wizard.max_peers, max(1, rule_count // 2))
+    config = wg_wizard.normalize_config(benchmark.generate_config(peers, max(2, rule_count // peers), 1))
+    assignment = wg_wizard.assign_peer_addresses(wg_wizard.FakeExecutor(), config, 1)
+    return config, assignment
+
+def find_targets(config, assignment):
+    # The last rule of each protocol is the worst case for iptables, which walks the rules in order.
+    targets = OrderedDict()
+
+    for peer, forward_rules in config.items():
+        for forward_rule in forward_rules:
+            targets[forward_rule['protocol']] = (assignment[peer][1], int(forward_rule['port-range'].partition('-')[0]))
+
+    return targets
+
+def set_up_topology(addresses):
+    teardown_topology()
+
+    for namespace in namespaces.values():
+        run(f"ip netns add {namespace}")
+        run(f"ip -n {namespace} link set lo up")
+
+    run(f"ip -n {namespaces['server']} link add {uplink} type veth peer name eth0 netns {namespaces['internet']}")
+    run(f"ip -n {namespaces['server']} link add {peer_link} type veth peer name eth0 netns {namespaces['client']}")
+    run(f"ip -n {namespaces['server']} addr add {server_uplink_address}/24 dev {uplink}")
+    run(f"ip -n {namespaces['server']} addr add 10.13.13.1/24 dev {peer_link}")
+    run(f"ip -n {namespaces['internet']} addr add {internet_address}/24 dev eth0")
+    # The client namespace holds the address of every peer, so every DNAT target answers.
+    run(f"ip -n {namespaces['client']} -batch -", input=''.join([f"addr add {e}/24 dev eth0\n" for e in addresses]))
+
+    for name, link in [('server', uplink), ('server', peer_link), ('internet', 'eth0'), ('client', 'eth0')]:
+        run(f"ip -n {namespaces[name]} link set {link} up")
+
+    run(f"ip -n {namespaces['client']} route add default via 10.13.13.1")
+    # Only the 'none' backend sends to the peers directly, the others reach them through the forwarded ports of the uplink.
+    run(f"ip -n {namespaces['internet']} route add 10.13.13.0/24 via {server_uplink_address}")
+    netns_exec('server', "sysctl -qw net.ipv4.ip_forward=1")
+    netns_exec('client', "sysctl -qw net.core.somaxconn=4096")
+
+def teardown_topology():
+    existing = run("ip netns list")
+
+    for namespace in namespaces.values():
+        if namespace in existing.split():
+            run(f"ip netns del {namespace}")
+
+def render_iptables_restore(postup):
+    # wg-quick runs PostUp one command at a time. The same commands are loaded with one iptables-restore per table, in the same order,
+    # because thousands of iptables calls would take longer than the measurement.
+    tables = OrderedDict()
+
+    for command in postup.replace('PostUp = ', '', 1).split('; '):
+        if not command.startswith('iptables '):
+            continue
+        words = command.replace('%i', peer_link).split()[1:]
+        table = 'filter'
+        if words[0] == '-t':
+            table = words[1]
+            words = words[2:]
+        tables.setdefault(table, []).append(' '.join(words))
+
+    return ''.join([f"*{table}\n" + ''.join([f"{e}\n" for e in rules]) + "COMMIT\n" for table, rules in tables.items()])
+
+def apply_rules(wg_wizard, config, assignment, forward_backend):
+    if forward_backend == 'none':
+        return
+
+    postup, _ = wg_wizard.render_wg0_postup_postdown(config, assignment, forward_backend, 'native', 0, uplink)
+
+    if shutil.which('iptables-restore') is not None:
+        netns_exec('server', "iptables-restore --noflush", input=render_iptables_restore(postup))
+    elif forward_backend == 'iptables':
+        wg_wizard.print_error("iptables-restore cannot be found.")
+        sys.exit(1)
+
+    if forward_backend == 'nft':
+        with tempfile.NamedTemporaryFile('w', suffix='.nft') as f:
+            f.write(wg_wizard.render_nft_ruleset(config, assignment, 0, uplink))
+            f.flush()
+            netns_exec('server', f"nft -f {f.name}")
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if len(values) > 0 else None
+
+def run_sink(tcp_port, udp_port):
+    # Runs in the client namespace. A tcp connection starts with E to be echoed, anything else is discarded.
+    # A udp datagram starting with E is echoed, Q is answered with the bytes received since the last Q, anything else is counted.
+    selector = selectors.DefaultSelector()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', tcp_port))
+    listener.listen(4096)
+    listener.setblocking(False)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(('0.0.0.0', udp_port))
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(receiver, selectors.EVENT_READ)
+    modes = {}
+    udp_received = 0
+    print('ready', flush=True)
+
+    while True:
+        for key, _ in selector.select():
+            sock = key.fileobj
+
+            if sock is listener:
+                connection, _ = listener.accept()
+                connection.setblocking(False)
+                selector.register(connection, selectors.EVENT_READ)
+                modes[connection] = None
+            elif sock is receiver:
+                data, address = receiver.recvfrom(65535)
+                if data[:1] == b'E':
+                    receiver.sendto(data, address)
+                elif data[:1] == b'Q':
+                    receiver.sendto(str(udp_received).encode(), address)
+                    udp_received = 0
+                else:
+                    udp_received += len(data)
+            else:
+                try:
+                    data = sock.recv(262144)
+                except ConnectionError:
+                    data = b''
+                if len(data) == 0:
+                    selector.unregister(sock)
+                    modes.pop(sock, None)
+                    sock.close()
+                    continue
+                if modes[sock] is None:
+                    modes[sock] = data[:1]
+                if modes[sock] == b'E':
+                    sock.setblocking(True)
+                    sock.sendall(data)
+                    sock.setblocking(False)
+
+def measure_tcp(address, port, duration):
+    result = OrderedDict()
+
+    # Connection setup. Closing with a reset keeps the source ports out of TIME_WAIT.
+    connect_seconds = []
+    end_time = time.perf_counter() + duration
+
+    while time.perf_counter() < end_time:
+        start_time = time.perf_counter()
+        sock = socket.create_connection((address, port), timeout=2)
+        connect_seconds.append(time.perf_counter() - start_time)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.close()
+
+    result['connections_per_second'] = len(connect_seconds) / duration
+    result['connect_p50_ms'] = percentile(connect_seconds, 0.5) * 1000
+    result['connect_p99_ms'] = percentile(connect_seconds, 0.99) * 1000
+
+    # Round trip time of an established connection
+    round_trip_seconds = []
+
+    with socket.create_connection((address, port), timeout=2) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        end_time = time.perf_counter() + duration / 3
+        while time.perf_counter() < end_time:
+            start_time = time.perf_counter()
+            sock.sendall(b'E')
+            sock.recv(1)
+            round_trip_seconds.append(time.perf_counter() - start_time)
+
+    result['round_trip_p50_us'] = percentile(round_trip_seconds, 0.5) * 1000000
+
+    # Throughput, counted until the sink has read everything and closed the connection.
+    chunk = b'S' * tcp_chunk_size
+    sent_bytes = 0
+
+    with socket.create_connection((address, port), timeout=10) as sock:
+        start_time = time.perf_counter()
+        end_time = start_time + duration
+        while time.perf_counter() < end_time:
+            sock.sendall(chunk)
+            sent_bytes += len(chunk)
+        sock.shutdown(socket.SHUT_WR)
+        sock.recv(1)
+        result['throughput_mbit'] = sent_bytes * 8 / (time.perf_counter() - start_time) / 1000000
+
+    return result
+
+def measure_udp(address, port, duration):
+    result = OrderedDict()
+
+    # Every probe comes from a new source port, so it is a new flow that goes through the forward rules.
+    round_trip_seconds = []
+    lost = 0
+    end_time = time.perf_counter() + duration
+
+    while time.perf_counter() < end_time:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(1)
+            start_time = time.perf_counter()
+            sock.sendto(b'E', (address, port))
+            try:
+                sock.recv(16)
+                round_trip_seconds.append(time.perf_counter() - start_time)
+            except socket.timeout:
+                lost += 1
+
+    result['flows_per_second'] = len(round_trip_seconds) / duration
+    result['flow_p50_ms'] = percentile(round_trip_seconds, 0.5) * 1000 if len(round_trip_seconds) > 0 else None
+    result['flow_p99_ms'] = percentile(round_trip_seconds, 0.99) * 1000 if len(round_trip_seconds) > 0 else None
+    result['flows_lost'] = lost
+
+    # Throughput of one flow, as received by the sink
+    payload = b'S' * udp_payload_size
+    sent_bytes = 0
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.connect((address, port))
+        sock.send(b'Q')
+        sock.recv(32)
+        start_time = time.perf_counter()
+        end_time = start_time + duration
+        while time.perf_counter() < end_time:
+            try:
+                sent_bytes += sock.send(payload)
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+        seconds = time.perf_counter() - start_time
+        time.sleep(0.2)
+        sock.send(b'Q')
+        received_bytes = int(sock.recv(32))
+
+    result['throughput_mbit'] = received_bytes * 8 / seconds / 1000000
+    result['loss'] = 1 - received_bytes / sent_bytes if sent_bytes > 0 else None
+    return result
+
+def run_load(targets, duration):
+    # Runs in the internet namespace and prints the results as JSON.
+    results = OrderedDict()
+
+    for protocol, (address, port) in targets.items():
+        results[protocol] = measure_tcp(address, port, duration) if protocol == 'tcp' else measure_udp(address, port, duration)
+
+    print(json.dumps(results))
+
+def measure_forwarding(wg_wizard, rule_count, forward_backend, duration):
+    config, assignment = build_config(wg_wizard, rule_count)
+    targets = find_targets(config, assignment)
+    set_up_topology([e[1] for e in assignment.values()])
+
+    try:
+        apply_rules(wg_wizard, config, assignment, forward_backend)
+        sink = subprocess.Popen(f"ip netns exec {namespaces['client']} {sys.executable} {str(dataplane_path)} --role sink --tcp-port {targets['tcp'][1]} --udp-port {targets['udp'][1]}".split(), stdout=subprocess.PIPE, universal_newlines=True)
+
+        try:
+            sink.stdout.readline()
+            # Except for 'none', the load goes to the forwarded port on the uplink of the server.
+            load_targets = OrderedDict([(protocol, (address if forward_backend == 'none' else server_uplink_address, port)) for protocol, (address, port) in targets.items()])
+            output = netns_exec('internet', f"{sys.executable} {str(dataplane_path)} --role load --targets {json.dumps(load_targets, separators=(',', ':'))} --duration {duration}")
+        finally:
+            sink.kill()
+            sink.wait()
+    finally:
+        teardown_topology()
+
+    result = OrderedDict([('rules', sum([len(e) for e in config.values()])), ('peers', len(config))])
+    result.update(json.loads(output, object_pairs_hook=OrderedDict))
+    return result
+
+def format_result(result):
+    tcp = result['tcp']
+    udp = result['udp']
+    return f"{result['rules']:>6} rules  tcp {tcp['connections_per_second']:>8.0f} conn/s {tcp['connect_p50_ms']:>6.3f}/{tcp['connect_p99_ms']:.3f} ms {tcp['round_trip_p50_us']:>6.1f} us {tcp['throughput_mbit']:>8.0f} Mbit/s  udp {udp['flows_per_second']:>8.0f} flows/s {udp['flow_p50_ms'] or 0:>6.3f}/{udp['flow_p99_ms'] or 0:.3f} ms {udp['throughput_mbit']:>8.0f} Mbit/s {(udp['loss'] or 0) * 100:>5.1f}% loss"
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure connection setup rate, latency and throughput through the port forwarding rules of wg-wizard.py in network namespaces on this host. Needs root.")
+    parser.add_argument('--rules', default='2,64,512,4096', help="comma separated numbers of forward rules to measure (default: %(default)s)")
+    parser.add_argument('--forward-backend', action='append', choices=forward_backends, help="rules to measure, can be given more than once. none forwards to the peers without any rule (default: every backend whose tools are installed)")
+    parser.add_argument('--duration', type=float, default=3, help="seconds spent on each measurement (default: %(default)s)")
+    parser.add_argument('--json', metavar='PATH', help="write the results to a JSON file")
+    parser.add_argument('--role', choices=['sink', 'load'], help=argparse.SUPPRESS)
+    parser.add_argument('--tcp-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--udp-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--targets', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == 'sink':
+        run_sink(args.tcp_port, args.udp_port)
+        return
+
+    if args.role == 'load':
+        run_load(OrderedDict([(k, tuple(v)) for k, v in json.loads(args.targets, object_pairs_hook=OrderedDict).items()]), args.duration)
+        return
+
+    wg_wizard = benchmark.load_wg_wizard()
+
+    if os.geteuid() != 0:
+        wg_wizard.print_error("Network namespaces can only be created by root.")
+        sys.exit(1)
+
+    selected_backends = args.forward_backend or ['none'] + [e for e, tool in [('iptables', 'iptables-restore'), ('nft', 'nft')] if shutil.which(tool) is not None]
+    results = OrderedDict()
+
+    for forward_backend in selected_backends:
+        results[forward_backend] = []
+
+        # Without rules the rule count does not matter, so 'none' is measured once.
+        for rule_count in [int(e) for e in args.rules.split(',')][:1 if forward_backend == 'none' else None]:
+            try:
+                result = measure_forwarding(wg_wizard, rule_count, forward_backend, args.duration)
+            except subprocess.CalledProcessError as e:
+                wg_wizard.print_error(f"{' '.join(e.cmd)} failed. {e.stderr.strip() if e.stderr else ''}")
+                sys.exit(1)
+            results[forward_backend].append(result)
+            wg_wizard.print_info(f"{forward_backend:<10}{format_result(result)}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=False)
+
+if __name__ == '__main__':
+    main()
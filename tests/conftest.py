@@ -0,0 +1,26 @@
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+wg_wizard_path = pathlib.Path(__file__).absolute().parent.parent / 'wg-wizard.py'
+
+def load_wg_wizard():
+    spec = importlib.util.spec_from_file_location('wg_wizard', str(wg_wizard_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['wg_wizard'] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def wg_wizard():
+    return load_wg_wizard()
+
+@pytest.fixture(scope='session')
+def auto_setup_script(wg_wizard):
+    # The functions and the argument parser of an auto setup script, without running its setup.
+    script = wg_wizard.render_auto_setup_script('alice', [], "[Interface]\n")
+    namespace = {'__name__': 'auto_setup_alice', '__file__': 'auto-setup-alice.py'}
+    exec(compile(script[:script.index("args = parser.parse_args()\n")], 'auto-setup-alice.py', 'exec'), namespace)
+    return namespace
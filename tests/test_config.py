@@ -0,0 +1,20 @@
+from collections import OrderedDict
+
+def test_find_port_conflicts_reports_every_overlapping_pair_once(wg_wizard):
+    intervals = [(1000, 2000, 'a'), (1500, 1500, 'b'), (1800, 2500, 'c'), (2001, 2100, 'd'), (3000, 3000, 'e')]
+
+    conflicts = wg_wizard.find_port_conflicts(intervals)
+
+    assert sorted((other[2], interval[2]) for other, interval in conflicts) == [('a', 'b'), ('a', 'c'), ('c', 'd')]
+
+def test_find_port_conflicts_accepts_touching_ranges(wg_wizard):
+    assert wg_wizard.find_port_conflicts([(1000, 1999, 'a'), (2000, 2999, 'b'), (3000, 3000, 'c')]) == []
+
+def test_verify_config_names_both_peers_of_a_conflict(wg_wizard, capsys):
+    config = OrderedDict([
+        ('a', [OrderedDict([('protocol', 'tcp'), ('port-range', '1000-2000')])]),
+        ('b', [OrderedDict([('protocol', 'udp'), ('port-range', '1500')]), OrderedDict([('protocol', 'tcp'), ('port-range', '2000')])]),
+    ])
+
+    assert not wg_wizard.verify_config(config)
+    assert "tcp port range 1000-2000 of 'a' overlaps with tcp port range 2000 of 'b'" in capsys.readouterr().out
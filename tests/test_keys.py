@@ -0,0 +1,39 @@
+import base64
+
+# RFC 7748 section 5.2 and 6.1.
+alice_private_key = bytes.fromhex('77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a')
+alice_public_key = bytes.fromhex('8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a')
+bob_private_key = bytes.fromhex('5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb')
+bob_public_key = bytes.fromhex('de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f')
+shared_secret = bytes.fromhex('4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742')
+
+def test_x25519_matches_the_rfc_7748_key_exchange(wg_wizard):
+    assert wg_wizard.x25519(alice_private_key, wg_wizard.curve25519_base_point) == alice_public_key
+    assert wg_wizard.x25519(bob_private_key, wg_wizard.curve25519_base_point) == bob_public_key
+    assert wg_wizard.x25519(alice_private_key, bob_public_key) == shared_secret
+    assert wg_wizard.x25519(bob_private_key, alice_public_key) == shared_secret
+
+def test_x25519_matches_the_rfc_7748_function_vectors(wg_wizard):
+    assert wg_wizard.x25519(bytes.fromhex('a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4'), bytes.fromhex('e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c')) == bytes.fromhex('c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552')
+    assert wg_wizard.x25519(wg_wizard.curve25519_base_point, wg_wizard.curve25519_base_point) == bytes.fromhex('422c8e7a6227d7bca1350b3e2bb7279f7897b87bb6854b783c60e80311ae3079')
+
+def test_generate_key_set_derives_the_public_key(wg_wizard):
+    private_key, public_key, preshared_key = [base64.b64decode(e) for e in wg_wizard.generate_key_set()]
+
+    assert len(private_key) == len(preshared_key) == 32
+    assert private_key[0] & 7 == 0 and private_key[31] & 192 == 64
+    assert wg_wizard.x25519(private_key, wg_wizard.curve25519_base_point) == public_key
+
+def test_detect_server_url_prefers_the_existing_profiles(wg_wizard):
+    executor = wg_wizard.FakeExecutor(files={wg_wizard.wireguard_config_path / 'peer_a/peer_a.conf': "[Peer]\nEndpoint = 198.51.100.7:51820\n"}, responses={wg_wizard.server_url_api: "203.0.113.1\n"})
+
+    assert wg_wizard.detect_server_url(executor, {'a': []}) == '198.51.100.7'
+    assert executor.requests == []
+
+def test_detect_server_url_asks_through_the_executor(wg_wizard):
+    executor = wg_wizard.FakeExecutor(responses={wg_wizard.server_url_api: "203.0.113.1\n"})
+
+    assert wg_wizard.detect_server_url(executor, {'a': []}) == '203.0.113.1'
+    assert wg_wizard.detect_server_url(executor, {'a': []}, fetch=False) is None
+    assert executor.requests == [wg_wizard.server_url_api]
+    assert [e['name'] for e in executor.events if e['category'] == 'request'] == [wg_wizard.server_url_api]
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import json
+import pathlib
+
+import pytest
+
+fixtures_path = pathlib.Path(__file__).absolute().parent / 'fixtures'
+
+def read_fixture(name):
+    return (fixtures_path / name).read_text(encoding='utf-8')
+
+def test_parse_wg_dump_reads_every_peer_of_every_interface(wg_wizard):
+    peers = list(wg_wizard.parse_wg_dump(wg_wizard.iter_lines(read_fixture('wg-show-all-dump.txt'))))
+
+    assert peers == [
+        ('xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=', '1760601600', '1048576', '52428800'),
+        ('TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=', '0', '0', '0'),
+        ('LyWWDdq5s1k2CaVIAIFnZ8Ak3X0P8vY1G5H3W3tS9Ek=', '1760601660', '2048', '4096'),
+    ]
+
+def test_parse_wg_dump_reads_a_single_interface(wg_wizard):
+    dump = '\n'.join([e.partition('\t')[2] for e in read_fixture('wg-show-all-dump.txt').split('\n') if e.startswith('wg0\t')])
+
+    assert [e[0] for e in wg_wizard.parse_wg_dump(wg_wizard.iter_lines(dump))] == ['xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=', 'TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=']
+
+def test_parse_iptables_counters_of_iptables_legacy(wg_wizard):
+    counters = list(wg_wizard.parse_iptables_counters(wg_wizard.iter_lines(read_fixture('iptables-legacy-nat.txt'))))
+
+    assert counters == [
+        ('tcp', '30000-30010', '10.13.13.2', '12', '720'),
+        ('udp', '30000', '10.13.13.2', '4', '296'),
+        ('tcp', '30011', '10.13.13.3', '0', '0'),
+    ]
+
+def test_parse_iptables_counters_of_iptables_nft(wg_wizard):
+    # iptables-nft prints protocol numbers with -n, and rules of other tools may carry comments.
+    counters = list(wg_wizard.parse_iptables_counters(wg_wizard.iter_lines(read_fixture('iptables-nft-nat.txt'))))
+
+    assert counters == [
+        ('tcp', '30000-30010', '10.13.13.2', '12', '720'),
+        ('udp', '30000', '10.13.13.2', '4', '296'),
+        ('tcp', '30011', '10.13.13.3', '18446744', '9223372036'),
+        ('tcp', '8080', '172.17.0.2', '7', '420'),
+    ]
+
+def test_parse_nft_counters_reads_elements_across_lines(wg_wizard):
+    counters = list(wg_wizard.parse_nft_counters(wg_wizard.iter_lines(read_fixture('nft-list-map.txt'))))
+
+    assert counters == [
+        ('tcp', '30000-30010', '10.13.13.2', '12', '720'),
+        ('udp', '30000', '10.13.13.2', '4', '296'),
+        ('tcp', '30011', '10.13.13.3', '0', '0'),
+    ]
+
+@pytest.mark.parametrize('forward_backend, counter_fixture', [('iptables', 'iptables-legacy-nat.txt'), ('nft', 'nft-list-map.txt')])
+def test_metrics_collector_labels_the_counters(wg_wizard, forward_backend, counter_fixture):
+    config = OrderedDict([
+        ('alice', [OrderedDict([('protocol', 'tcp'), ('port-range', '30000-30010')]), OrderedDict([('protocol', 'udp'), ('port-range', '30000')])]),
+        ('bob', [OrderedDict([('protocol', 'tcp'), ('port-range', '30011')])]),
+    ])
+    dump = '\n'.join([e.partition('\t')[2] for e in read_fixture('wg-show-all-dump.txt').split('\n') if e.startswith('wg0\t')])
+    executor = wg_wizard.FakeExecutor(files={
+        wg_wizard.program_config_path: json.dumps(config),
+        wg_wizard.program_state_path: json.dumps({'server-backend': 'docker', 'forward-backend': forward_backend, 'phases': {'container': {}}}),
+        wg_wizard.wireguard_config_path / 'peer_alice/peer_alice.conf': "[Interface]\nAddress = 10.13.13.2\n",
+        wg_wizard.wireguard_config_path / 'peer_alice/publickey-peer_alice': "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=\n",
+        wg_wizard.wireguard_config_path / 'peer_bob/peer_bob.conf': "[Interface]\nAddress = 10.13.13.3\n",
+        wg_wizard.wireguard_config_path / 'peer_bob/publickey-peer_bob': "TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=\n",
+    }, handlers=[
+        (r' wg show wg0 dump$', lambda executor, command: (0, dump)),
+        (r' (iptables -t nat -L|nft list map) ', lambda executor, command: (0, read_fixture(counter_fixture))),
+    ])
+
+    metrics = wg_wizard.MetricsCollector(executor).collect().split('\n')
+
+    assert 'wg_wizard_server_up{server="wireguard"} 1' in metrics
+    assert 'wg_wizard_peer_latest_handshake_seconds{peer="alice",server="wireguard"} 1760601600' in metrics
+    assert 'wg_wizard_peer_transmit_bytes_total{peer="alice",server="wireguard"} 52428800' in metrics
+    assert 'wg_wizard_peer_receive_bytes_total{peer="bob",server="wireguard"} 0' in metrics
+    assert 'wg_wizard_forward_packets_total{peer="alice",protocol="tcp",port_range="30000-30010"} 12' in metrics
+    assert 'wg_wizard_forward_bytes_total{peer="alice",protocol="udp",port_range="30000"} 296' in metrics
+    assert 'wg_wizard_forward_packets_total{peer="bob",protocol="tcp",port_range="30011"} 0' in metrics
+
+@pytest.mark.parametrize('broken', ['invalid json', 'invalid config', 'no free address'])
+def test_metrics_collector_keeps_the_last_labels(wg_wizard, monkeypatch, broken):
+    config = OrderedDict([('alice', [OrderedDict([('protocol', 'tcp'), ('port-range', '30000')])])])
+    executor = wg_wizard.FakeExecutor(files={
+        wg_wizard.program_config_path: json.dumps(config),
+        wg_wizard.wireguard_config_path / 'peer_alice/peer_alice.conf': "[Interface]\nAddress = 10.13.13.2\n",
+        wg_wizard.wireguard_config_path / 'peer_alice/publickey-peer_alice': "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=\n",
+    }, handlers=[
+        (r' wg show wg0 dump$', lambda executor, command: (0, "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=\t(none)\t198.51.100.7:51820\t10.13.13.2/32\t1760601600\t100\t200\toff\n")),
+    ])
+    collector = wg_wizard.MetricsCollector(executor)
+    first = collector.collect()
+
+    if broken == 'invalid json':
+        executor.files[wg_wizard.program_config_path] = '{"alice": ['
+    elif broken == 'invalid config':
+        executor.files[wg_wizard.program_config_path] = json.dumps({'alice': [{'protocol': 'sctp', 'port-range': '30000'}]})
+    else:
+        def exit_like_assign_peer_addresses(*args):
+            wg_wizard.print_error("There is no free address for carol.")
+            wg_wizard.sys.exit(1)
+        monkeypatch.setattr(wg_wizard, 'assign_peer_addresses', exit_like_assign_peer_addresses)
+        executor.files[wg_wizard.program_config_path] = json.dumps(OrderedDict(config, carol=[]))
+
+    second = collector.collect()
+
+    assert 'wg_wizard_peer_receive_bytes_total{peer="alice",server="wireguard"} 100' in first.split('\n')
+    assert [e for e in second.split('\n') if e.startswith('wg_wizard_peer_')] == [e for e in first.split('\n') if e.startswith('wg_wizard_peer_')]
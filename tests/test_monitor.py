@@ -0,0 +1,25 @@
+import re
+import shlex
+
+def parse_exec_start(unit):
+    exec_start = re.search(r"^ExecStart=(.*)$", unit, re.M).group(1)
+    return [e.replace('%%', '%').replace('$$', '$') for e in shlex.split(exec_start)]
+
+def test_monitor_service_passes_every_monitor_option(auto_setup_script):
+    parser = auto_setup_script['parser']
+    args = parser.parse_args(['--install-monitor', '--port-test-api', 'http://checker.example/%25/check-{protocol}?host={address}&key=$KEY', '--concurrency', '4', '--probe-timeout', '2.5', '--monitor-interval', '30', '--stale-after', '120', '--port-check-interval', '0', '--metrics-path', '/srv/metrics/wg0 "a".prom'])
+
+    command = parse_exec_start(auto_setup_script['render_monitor_service'](args))
+    monitor_args = parser.parse_args(command[2:])
+
+    assert command[:3] == ['/usr/bin/python3', str(auto_setup_script['monitor_script_path']), '--monitor']
+    for name in ['port_test_api', 'concurrency', 'probe_timeout', 'monitor_interval', 'stale_after', 'port_check_interval', 'metrics_path']:
+        assert getattr(monitor_args, name) == getattr(args, name)
+
+def test_monitor_service_keeps_the_defaults(auto_setup_script):
+    parser = auto_setup_script['parser']
+    args = parser.parse_args([])
+
+    monitor_args = parser.parse_args(parse_exec_start(auto_setup_script['render_monitor_service'](args))[2:])
+
+    assert vars(monitor_args) == dict(vars(args), monitor=True)
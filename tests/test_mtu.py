@@ -0,0 +1,49 @@
+import pytest
+
+def simulated_path(path_mtu, answers=True):
+    probes = []
+
+    def probe(size):
+        probes.append(size)
+        return answers and size <= path_mtu
+
+    return probe, probes
+
+@pytest.mark.parametrize('path_mtu', [576, 577, 1000, 1279, 1280, 1339, 1340, 1420, 1472, 1492, 1499, 1500])
+def test_discover_path_mtu_finds_the_path_mtu(wg_wizard, path_mtu):
+    probe, probes = simulated_path(path_mtu)
+
+    assert wg_wizard.discover_path_mtu(probe) == path_mtu
+    assert len(probes) <= 12
+
+def test_discover_path_mtu_gives_up_without_answers(wg_wizard):
+    probe, probes = simulated_path(1500, answers=False)
+
+    assert wg_wizard.discover_path_mtu(probe) is None
+    assert probes == [576]
+
+@pytest.mark.parametrize('path_mtu, tunnel_mtu', [(1500, 1440), (1492, 1432), (1340, 1280), (1300, 1240), (576, 516)])
+def test_get_tunnel_mtu_never_exceeds_the_path(wg_wizard, path_mtu, tunnel_mtu):
+    assert wg_wizard.get_tunnel_mtu(path_mtu) == tunnel_mtu
+
+def test_choose_mtu_prefers_the_largest_mtu_within_tolerance(wg_wizard):
+    throughput = {1440: 96, 1420: 100, 1400: 80, 1360: None}
+
+    chosen, results = wg_wizard.choose_mtu([1440, 1420, 1400, 1360], throughput.get)
+
+    assert chosen == 1440
+    assert results == [(1440, 96), (1420, 100), (1400, 80), (1360, None)]
+    assert wg_wizard.choose_mtu([1440, 1420], {1440: 90, 1420: 100}.get)[0] == 1420
+
+def test_choose_mtu_without_measurements(wg_wizard):
+    assert wg_wizard.choose_mtu([1440, 1420], lambda mtu: None) == (None, [(1440, None), (1420, None)])
+
+def test_auto_setup_scripts_carry_the_shared_functions(wg_wizard):
+    script = wg_wizard.render_auto_setup_script('alice', [], "[Interface]\nAddress = 10.13.13.2\n")
+    namespace = {}
+
+    exec(compile(wg_wizard.auto_setup_script_head + '\n' + wg_wizard.auto_setup_script_shared, 'auto-setup-alice.py', 'exec'), namespace)
+
+    assert script.count("def discover_path_mtu(") == 1
+    assert namespace['get_tunnel_mtu'](1500) == 1440
+    assert namespace['discover_path_mtu'](simulated_path(1400)[0]) == 1400
@@ -0,0 +1,33 @@
+from collections import OrderedDict
+import re
+
+config = OrderedDict([
+    ('alice', [OrderedDict([('protocol', 'tcp'), ('port-range', '30000-30010')]), OrderedDict([('protocol', 'udp'), ('port-range', '30000')])]),
+    ('bob', [OrderedDict([('protocol', 'tcp'), ('port-range', '30011')])]),
+    ('carol', []),
+])
+assignment = {'alice': (0, '10.13.13.2'), 'bob': (0, '10.13.13.3'), 'carol': (0, '10.13.13.4')}
+
+def read_map(ruleset):
+    return OrderedDict([((protocol, port_range), ip) for protocol, port_range, ip in re.findall(r"^ +(tcp|udp) \. ([0-9-]+) : ([0-9.]+),?$", ruleset, re.M)])
+
+def test_render_nft_ruleset_maps_every_forward_rule(wg_wizard):
+    ruleset = wg_wizard.render_nft_ruleset(config, assignment)
+
+    assert read_map(ruleset) == OrderedDict([
+        (('tcp', '30000-30010'), '10.13.13.2'),
+        (('udp', '30000'), '10.13.13.2'),
+        (('tcp', '30011'), '10.13.13.3'),
+    ])
+
+def test_render_nft_ruleset_replaces_its_own_table(wg_wizard):
+    ruleset = wg_wizard.render_nft_ruleset(config, assignment, 2, 'ens+')
+
+    assert ruleset.startswith("table ip wg_wizard_2\ndelete table ip wg_wizard_2\ntable ip wg_wizard_2 {\n")
+    assert 'iifname "ens*" meta l4proto { tcp, udp } dnat ip to meta l4proto . th dport map @forward_ports' in ruleset
+
+def test_render_nft_ruleset_without_forward_rules(wg_wizard):
+    ruleset = wg_wizard.render_nft_ruleset(OrderedDict([('carol', [])]), assignment)
+
+    assert read_map(ruleset) == OrderedDict()
+    assert "elements" not in ruleset
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import hashlib
+import json
+import pathlib
+import re
+
+cache_path = pathlib.Path('/srv/wg-wizard-cache')
+distribution = 'ubuntu jammy amd64'
+created = 1700000000
+image = 'linuxserver/wireguard:latest'
+
+def make_cache(wg_wizard, set_names=('docker', 'client')):
+    files = OrderedDict()
+    sets = OrderedDict()
+
+    for set_name in set_names:
+        entries = []
+
+        for package in wg_wizard.package_sets[set_name]:
+            path = f"debs/{set_name}/{package}_1.0_amd64.deb"
+            files[cache_path / path] = f"deb {package}"
+            entries.append(OrderedDict([('path', path), ('package', package), ('version', '1.0'), ('sha256', hashlib.sha256(f"deb {package}".encode()).hexdigest())]))
+
+        sets[set_name] = OrderedDict([('packages', wg_wizard.package_sets[set_name]), ('files', entries)])
+
+    files[cache_path / wg_wizard.package_cache_images[image]] = 'image'
+    images = OrderedDict([(image, OrderedDict([('path', wg_wizard.package_cache_images[image]), ('sha256', hashlib.sha256(b'image').hexdigest())]))])
+    files[cache_path / wg_wizard.package_cache_manifest_name] = json.dumps(OrderedDict([('created', created), ('distribution', distribution), ('sets', sets), ('images', images)]))
+
+    return files
+
+def check(wg_wizard, files, set_names=('docker', 'client'), images=(image,), max_age_days=30, now=created + 86400):
+    return wg_wizard.check_package_cache(wg_wizard.FakeExecutor(files), cache_path, list(set_names), list(images), distribution, max_age_days, now)
+
+def test_check_package_cache_accepts_a_fresh_cache(wg_wizard):
+    assert check(wg_wizard, make_cache(wg_wizard)) == []
+
+def test_check_package_cache_without_manifest(wg_wizard):
+    files = make_cache(wg_wizard)
+    del files[cache_path / wg_wizard.package_cache_manifest_name]
+
+    assert check(wg_wizard, files) == [f"{str(cache_path / 'manifest.json')} cannot be found."]
+
+def test_check_package_cache_finds_missing_files(wg_wizard):
+    files = make_cache(wg_wizard)
+    del files[cache_path / 'debs/client/resolvconf_1.0_amd64.deb']
+
+    assert check(wg_wizard, files) == ["debs/client/resolvconf_1.0_amd64.deb is missing."]
+
+def test_check_package_cache_finds_bad_checksums(wg_wizard):
+    files = make_cache(wg_wizard)
+    files[cache_path / 'debs/docker/docker-ce_1.0_amd64.deb'] = 'truncated'
+    files[cache_path / wg_wizard.package_cache_images[image]] = 'truncated'
+
+    assert check(wg_wizard, files) == ["debs/docker/docker-ce_1.0_amd64.deb is damaged.", f"{wg_wizard.package_cache_images[image]} is damaged."]
+
+def test_check_package_cache_expires(wg_wizard):
+    files = make_cache(wg_wizard)
+
+    assert check(wg_wizard, files, now=created + 31 * 86400) == ["It is 31 days old and may miss security updates. Create it again or raise --cache-max-age."]
+    assert check(wg_wizard, files, max_age_days=0, now=created + 365 * 86400) == []
+
+def test_check_package_cache_for_another_distribution(wg_wizard):
+    files = make_cache(wg_wizard)
+
+    problems = wg_wizard.check_package_cache(wg_wizard.FakeExecutor(files), cache_path, ['client'], [], 'debian bookworm arm64', 30, created)
+
+    assert problems == [f"It was made for {distribution}, but this is debian bookworm arm64."]
+
+def test_check_package_cache_finds_missing_sets(wg_wizard):
+    files = make_cache(wg_wizard, ['client'])
+
+    assert check(wg_wizard, files, ['docker', 'wireguard-nftables', 'client'], []) == ["It has no docker packages.", "It has no wireguard-nftables packages."]
+
+def test_install_from_package_cache_skips_installed_packages(wg_wizard):
+    installed = "ii wireguard\t1.0\nii resolvconf\t0.9\n"
+    executor = wg_wizard.FakeExecutor(make_cache(wg_wizard), [
+        (r"^dpkg-query ", lambda executor, command: (0, installed)),
+        (r"^dpkg --compare-versions 1\.0 gt 0\.9$", lambda executor, command: (0, '')),
+    ])
+
+    assert wg_wizard.install_from_package_cache(executor, cache_path, 'client')
+    assert executor.commands[-1] == f"sudo DEBIAN_FRONTEND=noninteractive apt-get install -y --no-download {str(cache_path / 'debs/client/resolvconf_1.0_amd64.deb')}"
+
+def test_open_package_cache_unpacks_tarballs_through_the_executor(wg_wizard):
+    tarball_path = pathlib.Path('/srv/wg-wizard-cache.tgz')
+    executor = wg_wizard.FakeExecutor({tarball_path: 'tarball'})
+
+    unpacked_path, temporary = wg_wizard.open_package_cache(executor, str(tarball_path))
+    wg_wizard.close_package_cache(executor, unpacked_path, temporary)
+
+    assert temporary
+    assert not unpacked_path.exists()
+    assert executor.temp_dirs == [unpacked_path]
+    assert executor.commands == [f"tar -xf {str(tarball_path)} -C {str(unpacked_path)}", f"rm -rf {str(unpacked_path)}"]
+
+def test_open_package_cache_keeps_directories(wg_wizard):
+    executor = wg_wizard.FakeExecutor()
+
+    assert wg_wizard.open_package_cache(executor, str(cache_path)) == (cache_path, False)
+    wg_wizard.close_package_cache(executor, cache_path, False)
+    assert executor.commands == []
+
+def test_auto_setup_scripts_run_the_installer_of_the_cache(wg_wizard):
+    installer = wg_wizard.render_package_cache_installer()
+    script = wg_wizard.render_auto_setup_script('alice', [], "[Interface]\n")
+
+    compile(installer, wg_wizard.package_cache_installer_name, 'exec')
+    compile(script, 'alice.py', 'exec')
+    assert re.search(r"^def check_package_cache\(executor, ", installer, re.M)
+    assert "def check_package_cache" not in script
+    assert "client_packages = ['wireguard', 'resolvconf']" in script
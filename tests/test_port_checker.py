@@ -0,0 +1,126 @@
+import http.server
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+class PortChecker(http.server.ThreadingHTTPServer):
+    # Stand-in for the port test service. It connects to the requested port on localhost unless the port is unreachable,
+    # and answers 503 for unavailable ports.
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), PortCheckerHandler)
+        self.unreachable = set()
+        self.unavailable = set()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/check-{{protocol}}?host={{address}}"
+
+class PortCheckerHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        protocol = re.match(r"^/check-(tcp|udp)\?", self.path).group(1)
+        _, _, port = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['host'][0].rpartition(':')
+        port = int(port)
+
+        with self.server.lock:
+            self.server.requests.append((protocol, port))
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+
+        try:
+            time.sleep(0.1)
+
+            if port in self.server.unavailable:
+                self.send_response(503)
+                self.end_headers()
+                return
+
+            if port not in self.server.unreachable:
+                if protocol == 'tcp':
+                    socket.create_connection(('127.0.0.1', port), timeout=2).close()
+                else:
+                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                        s.sendto(b'probe', ('127.0.0.1', port))
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def checker():
+    server = PortChecker()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def free_ports(count):
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+
+    try:
+        for s in sockets:
+            s.bind(('0.0.0.0', 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+def test_sample_ports_keeps_small_ranges(auto_setup_script):
+    assert auto_setup_script['sample_ports']('30000', 3) == [30000]
+    assert auto_setup_script['sample_ports']('30000-30002', 3) == [30000, 30001, 30002]
+    assert auto_setup_script['sample_ports']('30000-30099', 0) == list(range(30000, 30100))
+
+def test_sample_ports_samples_large_ranges_with_both_ends(auto_setup_script):
+    for _ in range(20):
+        ports = auto_setup_script['sample_ports']('30000-30099', 4)
+
+        assert len(ports) == 4 and ports == sorted(set(ports))
+        assert ports[0] == 30000 and ports[-1] == 30099
+
+    assert 30000 <= auto_setup_script['sample_ports']('30000-30099', 1)[0] <= 30099
+
+def test_ports_reports_reachable_and_unreachable_ports(auto_setup_script, checker):
+    tcp_open, tcp_closed, udp_open, udp_closed, unavailable = free_ports(5)
+    checker.unreachable.update([tcp_closed, udp_closed])
+    checker.unavailable.add(unavailable)
+    targets = [('tcp', tcp_open), ('tcp', tcp_closed), ('udp', udp_open), ('udp', udp_closed), ('tcp', unavailable)]
+
+    results = auto_setup_script['test_ports'](checker.api, '127.0.0.1', targets, 16, 1)
+
+    assert results == ['passed', 'failed', 'passed', 'failed', 'api unavailable']
+    assert sorted(checker.requests) == sorted(targets)
+
+def test_ports_reports_ports_in_use(auto_setup_script, checker):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('0.0.0.0', 0))
+        s.listen()
+
+        assert auto_setup_script['test_ports'](checker.api, '127.0.0.1', [('tcp', s.getsockname()[1])], 4, 1) == ['port in use']
+
+    assert checker.requests == []
+
+def test_ports_asks_the_checker_in_chunks_of_concurrency(auto_setup_script, checker):
+    targets = [('udp', e) for e in free_ports(8)]
+
+    started = time.time()
+    results = auto_setup_script['test_ports'](checker.api, '127.0.0.1', targets, 2, 1)
+
+    assert results == ['passed'] * 8
+    assert checker.max_active == 2
+    # Four rounds of two requests of 0.1 seconds each.
+    assert time.time() - started >= 0.4
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import json
+import re
+
+import pytest
+
+config = OrderedDict([
+    ('alice', [OrderedDict([('protocol', 'tcp'), ('port-range', '30000-30010')])]),
+    ('bob', [OrderedDict([('protocol', 'udp'), ('port-range', '40000')])]),
+])
+
+def fake_docker_run(wg_wizard):
+    # Writes the wg0.conf the wireguard image would create for the peers in the command.
+    def handler(executor, command):
+        peers = re.search(r'PEERS="([^"]*)"', command).group(1).split(',')
+        config_path = wg_wizard.pathlib.Path(re.search(r'-v "([^"]*)":/config', command).group(1))
+        wg0_config = ["[Interface]", "Address = 10.13.13.1", "PostUp = iptables -A FORWARD -i %i -j ACCEPT", "PostDown = iptables -D FORWARD -i %i -j ACCEPT"]
+        for peer in peers:
+            wg0_config += ["", "[Peer]", f"# peer_{peer}", f"PublicKey = {executor.read_text(config_path / f'peer_{peer}/publickey-peer_{peer}').strip()}"]
+        executor.store(config_path / 'wg_confs/wg0.conf', '\n'.join(wg0_config) + '\n', None)
+        return 0, ''
+
+    return handler
+
+@pytest.fixture
+def executor(wg_wizard):
+    executor = wg_wizard.FakeExecutor(files={
+        wg_wizard.program_config_path: json.dumps(config),
+        wg_wizard.ufw_user_rules_path: "*filter\n### RULES ###\n\n### END RULES ###\nCOMMIT\n",
+    }, handlers=[
+        (r'^sudo ss ', lambda executor, command: (0, 'tcp LISTEN 0 128 0.0.0.0:2222 0.0.0.0:* users:(("sshd",pid=1,fd=3))\n')),
+        (r'^sudo docker run ', fake_docker_run(wg_wizard)),
+    ], responses={wg_wizard.server_url_api: "203.0.113.1\n"})
+    return executor
+
+def test_provision_sets_up_the_docker_backend(wg_wizard, executor):
+    wg_wizard.main([], executor=executor)
+
+    docker_run = [e for e in executor.commands if e.startswith('sudo docker run ')]
+    assert len(docker_run) == 1
+    assert '-e SERVERURL=203.0.113.1 ' in docker_run[0] and '-e PEERS="alice,bob" ' in docker_run[0]
+    assert '-p 30000-30010:30000-30010/tcp' in docker_run[0] and '-p 40000:40000/udp' in docker_run[0]
+    assert executor.requests == [wg_wizard.server_url_api]
+
+    user_rules = executor.files[wg_wizard.ufw_user_rules_path]
+    for rule in ["-A ufw-user-input -p tcp --dport 2222 -j ACCEPT", "-A ufw-user-input -p udp --dport 51820 -j ACCEPT", "-A ufw-user-input -p tcp -m multiport --dports 30000:30010 -j ACCEPT", "-A ufw-user-input -p udp --dport 40000 -j ACCEPT"]:
+        assert rule in user_rules
+
+    wg0_config = executor.files[wg_wizard.wireguard_config_path / 'wg_confs/wg0.conf']
+    assert "--dport 30000:30010 -j DNAT --to-destination 10.13.13.2" in wg0_config
+    assert "--dport 40000 -j DNAT --to-destination 10.13.13.3" in wg0_config
+
+    peer_config = executor.files[wg_wizard.wireguard_config_path / 'peer_alice/peer_alice.conf']
+    assert "Address = 10.13.13.2" in peer_config and "Endpoint = 203.0.113.1:51820" in peer_config
+    assert wg_wizard.program_path.with_name('auto-setup-alice.py') in executor.files
+    assert wg_wizard.program_path.with_name('auto-setup-bob.py') in executor.files
+
+def test_provision_skips_unchanged_phases(wg_wizard, executor):
+    wg_wizard.main([], executor=executor)
+    executor.commands.clear()
+    executor.requests.clear()
+
+    wg_wizard.main([], executor=executor)
+
+    assert not any(re.match(r'^sudo (ufw|docker (run|restart|stop)) ', e) for e in executor.commands)
+    assert executor.requests == []
+
+def test_provision_restarts_only_for_changed_forward_rules(wg_wizard, executor):
+    wg_wizard.main([], executor=executor)
+    executor.commands.clear()
+    changed = json.loads(executor.files[wg_wizard.program_config_path], object_pairs_hook=OrderedDict)
+    changed['bob'].append(OrderedDict([('protocol', 'tcp'), ('port-range', '40001')]))
+    executor.files[wg_wizard.program_config_path] = json.dumps(changed)
+
+    wg_wizard.main([], executor=executor)
+
+    assert "-A ufw-user-input -p tcp --dport 40001 -j ACCEPT" in executor.files[wg_wizard.ufw_user_rules_path]
+    assert len([e for e in executor.commands if e.startswith('sudo docker run ')]) == 1
+    assert "--dport 40001 -j DNAT --to-destination 10.13.13.3" in executor.files[wg_wizard.wireguard_config_path / 'wg_confs/wg0.conf']
+
+def test_provision_does_not_take_the_wg0_conf_of_the_old_container(wg_wizard, executor, capsys):
+    wg_wizard.main([], executor=executor)
+    executor.commands.clear()
+    executor.handlers = [e for e in executor.handlers if e[0] != r'^sudo docker run ']
+    changed = json.loads(executor.files[wg_wizard.program_config_path], object_pairs_hook=OrderedDict)
+    changed['bob'].append(OrderedDict([('protocol', 'tcp'), ('port-range', '40001')]))
+    executor.files[wg_wizard.program_config_path] = json.dumps(changed)
+
+    wg_wizard.main([], executor=executor)
+
+    assert "wg0.conf would be written by the wireguard server. The remaining steps cannot be simulated." in capsys.readouterr().out
+    assert not any(e.startswith('sudo docker restart ') for e in executor.commands)
+
+def test_provision_runs_nftables_offline_from_the_package_cache(wg_wizard, executor):
+    cache_path = wg_wizard.pathlib.Path('/srv/wg-wizard-cache')
+    image_path = wg_wizard.package_cache_images[wg_wizard.wireguard_nft_image]
+    executor.files[cache_path / image_path] = 'image'
+    executor.files[cache_path / wg_wizard.package_cache_manifest_name] = json.dumps(OrderedDict([
+        ('created', int(wg_wizard.time.time())),
+        ('distribution', wg_wizard.get_distribution(executor)),
+        ('sets', OrderedDict()),
+        ('images', OrderedDict([(wg_wizard.wireguard_nft_image, OrderedDict([('path', image_path), ('sha256', executor.hash_file(cache_path / image_path))]))])),
+    ]))
+    executor.handlers.insert(0, (r'^sudo docker image inspect ', lambda executor, command: (1, '')))
+
+    wg_wizard.main(['--forward-backend', 'nft', '--cache', str(cache_path)], executor=executor)
+
+    assert f"sudo docker load -i {str(cache_path / image_path)}" in executor.commands
+    assert not any(re.match(r'^sudo docker (build|pull) ', e) or 'apk ' in e for e in executor.commands)
+    assert [e for e in executor.commands if e.startswith('sudo docker run ')][0].endswith(f" {wg_wizard.wireguard_nft_image}")
+
+    # Without nft, only the forward table is missing. The interface still comes up.
+    wg0_config = executor.files[wg_wizard.wireguard_config_path / 'wg_confs/wg0.conf']
+    assert "apk " not in wg0_config
+    assert "; if command -v nft > /dev/null; then nft -f /config/wg-wizard.nft; else echo " in wg0_config
+
+def test_provision_stops_when_the_nftables_image_cannot_be_built(wg_wizard, executor):
+    executor.handlers[:0] = [(r'^sudo docker image inspect ', lambda executor, command: (1, '')), (r'^sudo docker build ', lambda executor, command: (1, ''))]
+
+    with pytest.raises(SystemExit):
+        wg_wizard.main(['--forward-backend', 'nft'], executor=executor)
+
+    assert any(e.startswith(f"sudo docker build -t {wg_wizard.wireguard_nft_image} ") for e in executor.commands)
+    assert not any(e.startswith('sudo docker run ') for e in executor.commands)
+
+def watch_once(wg_wizard, executor, monkeypatch, changed):
+    # One reload of the watch mode, without waiting for the next change.
+    monkeypatch.setattr(wg_wizard, 'watch', wg_wizard.provision)
+    executor.files[wg_wizard.program_config_path] = json.dumps(changed)
+    wg_wizard.main(['--watch'], executor=executor)
+
+def test_watch_changes_peers_and_forward_rules_of_the_running_container(wg_wizard, executor, monkeypatch):
+    wg_wizard.main([], executor=executor)
+    executor.commands.clear()
+    # Only the DNAT rule of bob is in place, as docker exec runs into the container.
+    executor.handlers.insert(0, (r'^sudo docker exec wireguard iptables -t nat -C ', lambda executor, command: (0 if '10.13.13.3' in command else 1, '')))
+    changed = OrderedDict([('alice', config['alice']), ('bob', []), ('carol', config['bob'])])
+
+    watch_once(wg_wizard, executor, monkeypatch, changed)
+
+    assert not any(re.match(r'^sudo docker (run|stop|rm|restart) ', e) for e in executor.commands)
+    carol_key = executor.files[wg_wizard.wireguard_config_path / 'peer_carol/publickey-peer_carol'].strip()
+    assert f"sudo docker exec wireguard wg set wg0 peer {carol_key} preshared-key /config/peer_carol/presharedkey-peer_carol allowed-ips 10.13.13.4/32" in executor.commands
+    assert "sudo docker exec wireguard ip -4 route replace 10.13.13.4/32 dev wg0" in executor.commands
+    assert "sudo docker exec wireguard iptables -t nat -D PREROUTING -i eth+ -p udp --dport 40000 -j DNAT --to-destination 10.13.13.3" in executor.commands
+    assert "sudo docker exec wireguard iptables -t nat -A PREROUTING -i eth+ -p udp --dport 40000 -j DNAT --to-destination 10.13.13.4" in executor.commands
+
+    wg0_config = executor.files[wg_wizard.wireguard_config_path / 'wg_confs/wg0.conf']
+    assert f"# peer_carol\nPublicKey = {carol_key}\n" in wg0_config and "AllowedIPs = 10.13.13.4/32" in wg0_config
+    assert "--dport 40000 -j DNAT --to-destination 10.13.13.4" in wg0_config and "--to-destination 10.13.13.3" not in wg0_config
+
+    executor.commands.clear()
+    wg_wizard.main(['--watch'], executor=executor)
+
+    assert not any(re.match(r'^sudo docker (run|stop|rm|restart|exec) ', e) for e in executor.commands)
+
+def test_watch_recreates_the_container_for_new_published_ports(wg_wizard, executor, monkeypatch):
+    wg_wizard.main([], executor=executor)
+    executor.commands.clear()
+    changed = json.loads(executor.files[wg_wizard.program_config_path], object_pairs_hook=OrderedDict)
+    changed['bob'].append(OrderedDict([('protocol', 'tcp'), ('port-range', '40001')]))
+
+    watch_once(wg_wizard, executor, monkeypatch, changed)
+
+    assert len([e for e in executor.commands if e.startswith('sudo docker run ')]) == 1
+    assert not any(re.match(r'^sudo docker exec wireguard (wg|iptables) ', e) for e in executor.commands)
@@ -0,0 +1,34 @@
+rules_file = "*filter\n### RULES ###\n\n### END RULES ###\nCOMMIT\n"
+
+def test_apply_ufw_rules_uses_the_chain_of_each_address_family(wg_wizard):
+    executor = wg_wizard.FakeExecutor(files={
+        wg_wizard.ufw_default_path: "IPV6=yes\n",
+        wg_wizard.ufw_user_rules_path: rules_file,
+        wg_wizard.ufw_user6_rules_path: rules_file,
+    })
+
+    assert wg_wizard.apply_ufw_rules(executor, [('tcp', '22'), ('udp', '51820'), ('tcp', '30000:30010')])
+
+    user_rules = executor.files[wg_wizard.ufw_user_rules_path]
+    user6_rules = executor.files[wg_wizard.ufw_user6_rules_path]
+    assert "### tuple ### allow tcp 22 0.0.0.0/0 any 0.0.0.0/0 in\n-A ufw-user-input -p tcp --dport 22 -j ACCEPT" in user_rules
+    assert "-A ufw-user-input -p tcp -m multiport --dports 30000:30010 -j ACCEPT" in user_rules
+    assert "ufw6-user-input" not in user_rules
+    assert "### tuple ### allow udp 51820 ::/0 any ::/0 in\n-A ufw6-user-input -p udp --dport 51820 -j ACCEPT" in user6_rules
+    assert "-A ufw-user-input" not in user6_rules
+    assert user6_rules.endswith("### END RULES ###\nCOMMIT\n")
+
+def test_apply_ufw_rules_leaves_user6_rules_alone_without_ipv6(wg_wizard):
+    executor = wg_wizard.FakeExecutor(files={
+        wg_wizard.ufw_default_path: "IPV6=no\n",
+        wg_wizard.ufw_user_rules_path: rules_file,
+        wg_wizard.ufw_user6_rules_path: rules_file,
+    })
+
+    assert wg_wizard.apply_ufw_rules(executor, [('tcp', '22')])
+    assert executor.files[wg_wizard.ufw_user6_rules_path] == rules_file
+
+def test_apply_ufw_rules_falls_back_without_markers(wg_wizard):
+    executor = wg_wizard.FakeExecutor(files={wg_wizard.ufw_user_rules_path: "*filter\nCOMMIT\n"})
+
+    assert not wg_wizard.apply_ufw_rules(executor, [('tcp', '22')])
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+import pytest
+
+def make_stale_file(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("[Interface]\n# left over from the last container\n")
+    os.utime(path, (time.time() - 3600, time.time() - 3600))
+
+def rewrite_later(path, delay):
+    def rewrite():
+        time.sleep(delay)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.write_text("[Interface]\n# written by the new container\n")
+        os.replace(temp_path, path)
+
+    thread = threading.Thread(target=rewrite)
+    thread.start()
+    return thread
+
+def test_wait_for_files_takes_existing_files_without_a_start_time(wg_wizard, tmp_path):
+    path = tmp_path / 'wg_confs/wg0.conf'
+    make_stale_file(path)
+
+    assert list(wg_wizard.wait_for_files([path], 5)) == [path]
+
+def test_wait_for_files_waits_until_a_stale_file_is_rewritten(wg_wizard, tmp_path):
+    path = tmp_path / 'wg_confs/wg0.conf'
+    make_stale_file(path)
+    thread = rewrite_later(path, 0.3)
+
+    ready = wg_wizard.wait_for_files([path], 5, {path: time.time()})
+    thread.join()
+
+    assert ready[path] >= 0.25
+    assert "new container" in path.read_text()
+
+def test_wait_for_files_gives_up_on_a_stale_file(wg_wizard, tmp_path):
+    path = tmp_path / 'wg_confs/wg0.conf'
+    make_stale_file(path)
+
+    assert wg_wizard.wait_for_files([path], 0.5, {path: time.time()}) == {}
+
+@pytest.mark.parametrize('rewritten', [False, True])
+def test_poll_for_files_skips_stale_files(wg_wizard, tmp_path, rewritten):
+    path = tmp_path / 'wg_confs/wg0.conf'
+    make_stale_file(path)
+    start_time = time.time()
+    thread = rewrite_later(path, 0.3 if rewritten else 0)
+    thread.join()
+    if not rewritten:
+        os.utime(path, (start_time - 3600, start_time - 3600))
+    ready = {}
+
+    wg_wizard.poll_for_files([path], 1, start_time, ready, {path: start_time})
+
+    assert (path in ready) == rewritten
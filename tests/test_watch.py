@@ -0,0 +1,199 @@
+from collections import OrderedDict
+import ipaddress
+import re
+import subprocess
+
+import pytest
+
+class LiveServer:
+    # Answers wg, ip, iptables and nft commands from the state of a running server, like the kernel would.
+    # The commands start with prefix, which is where the server runs.
+    def __init__(self, wg_wizard, fail_on=None, prefix='sudo '):
+        self.wg_wizard = wg_wizard
+        self.peers = set()
+        self.routes = set()
+        self.rules = set()
+        self.elements = OrderedDict()
+        self.fail_on = fail_on
+        self.prefix = prefix
+
+    def handlers(self):
+        return [
+            ('^' + re.escape(self.prefix) + r'wg set ', self.wg_set),
+            ('^' + re.escape(self.prefix) + r'ip -4 route (replace|del) ', self.ip_route),
+            ('^' + re.escape(self.prefix) + r'iptables -t nat -[ACD] ', self.iptables),
+            ('^' + re.escape(self.prefix) + r'nft list map ', self.nft_list),
+            ('^' + re.escape(self.prefix) + r'nft (add|delete) element ', self.nft_element),
+        ]
+
+    def wg_set(self, executor, command):
+        public_key = re.search(r" wg set \S+ peer (\S+)", command).group(1)
+        if command.endswith(' remove'):
+            self.peers.discard(public_key)
+        else:
+            self.peers.add(public_key)
+        return 0, ''
+
+    def ip_route(self, executor, command):
+        network, device = re.search(r" route \S+ (\S+) dev (\S+)$", command).groups()
+        if ' replace ' in command:
+            self.routes.add((network, device))
+        elif (network, device) not in self.routes:
+            return 2, ''
+        else:
+            self.routes.remove((network, device))
+        return 0, ''
+
+    def is_routable(self, address, device='wg0'):
+        return any([ipaddress.ip_address(address) in ipaddress.ip_network(network) for network, e in self.routes if e == device])
+
+    def iptables(self, executor, command):
+        if self.fail_on is not None and self.fail_on in command:
+            self.fail_on = None
+            return 1, ''
+        rule = re.sub(r' -[ACD] ', ' ', command)
+        if ' -C ' in command:
+            return (0 if rule in self.rules else 1), ''
+        if ' -D ' in command:
+            if rule not in self.rules:
+                return 1, ''
+            self.rules.remove(rule)
+        elif rule in self.rules:
+            raise AssertionError(f"{command} would append the rule twice.")
+        else:
+            self.rules.add(rule)
+        return 0, ''
+
+    def nft_list(self, executor, command):
+        elements = ', '.join([f"{key} counter packets 0 bytes 0 : {address}" for key, address in self.elements.items()])
+        return 0, f"table ip wg_wizard {{\n\tmap forward_ports {{\n\t\telements = {{ {elements} }}\n\t}}\n}}\n"
+
+    def nft_element(self, executor, command):
+        elements = [e.strip() for e in re.search(r"\{ (.*) \}$", command).group(1).split(', ')]
+        if ' delete ' in command:
+            if any(e not in self.elements for e in elements):
+                return 1, ''
+            for e in elements:
+                del self.elements[e]
+        else:
+            for e in elements:
+                key, _, address = e.partition(' : ')
+                if self.elements.get(key, address) != address:
+                    return 1, ''
+                self.elements[key] = address
+        return 0, ''
+
+def render_artifact(wg_wizard, config, forward_backend, uplink='eth0'):
+    assignment = dict([(peer, (0, f"10.13.13.{i + 2}")) for i, peer in enumerate(config.keys())])
+    postup, postdown = wg_wizard.render_wg0_postup_postdown(config, assignment, forward_backend, 'native', 0, uplink)
+    nft_ruleset = wg_wizard.render_nft_ruleset(config, assignment, 0, uplink.replace('*', '+')) if forward_backend == 'nft' else None
+    return [f"PEERS={','.join(config.keys())}"] + wg_wizard.render_rules_artifact(postup, postdown, nft_ruleset), assignment
+
+def add_peer_files(wg_wizard, executor, peer, address):
+    executor.files[wg_wizard.wireguard_config_path / f"peer_{peer}/publickey-peer_{peer}"] = f"key-{peer}\n"
+    executor.files[wg_wizard.wireguard_config_path / f"peer_{peer}/peer_{peer}.conf"] = f"[Interface]\nAddress = {address}\n"
+
+def start(wg_wizard, config, forward_backend, fail_on=None):
+    # A server that runs config, as wg-quick up would have left it. The interface address has no prefix, so every peer has a route of its own.
+    server = LiveServer(wg_wizard, fail_on)
+    artifact, assignment = render_artifact(wg_wizard, config, forward_backend)
+    executor = wg_wizard.FakeExecutor(handlers=server.handlers())
+
+    for peer in config.keys():
+        add_peer_files(wg_wizard, executor, peer, assignment[peer][1])
+        server.peers.add(f"key-{peer}")
+        server.routes.add((f"{assignment[peer][1]}/32", 'wg0'))
+
+    for line in artifact:
+        if ' -A PREROUTING ' in line:
+            server.rules.add(re.sub(r' -A ', ' ', server.prefix + line))
+        elif re.match(r"^(tcp|udp) \. ", line):
+            key, _, address = line.partition(' : ')
+            server.elements[key] = address
+
+    return server, executor, artifact
+
+def apply(wg_wizard, executor, old_artifact, config, forward_backend, applied=None):
+    new_artifact, assignment = render_artifact(wg_wizard, config, forward_backend)
+    assert wg_wizard.is_live_change(old_artifact, new_artifact)
+    wg_wizard.apply_live_changes(executor, 'wg0', 'wg_wizard', old_artifact, new_artifact, assignment, lambda peer: wg_wizard.wireguard_config_path / f"peer_{peer}", applied)
+    return new_artifact
+
+def rule(protocol, port_range):
+    return OrderedDict([('protocol', protocol), ('port-range', port_range)])
+
+config = OrderedDict([('alice', [rule('tcp', '30000-30010')]), ('bob', [rule('udp', '40000')])])
+
+@pytest.mark.parametrize('forward_backend', ['iptables', 'nft'])
+def test_apply_live_changes_adds_a_peer(wg_wizard, forward_backend):
+    server, executor, artifact = start(wg_wizard, config, forward_backend)
+    changed = OrderedDict(list(config.items()) + [('carol', [rule('tcp', '50000')])])
+    add_peer_files(wg_wizard, executor, 'carol', '10.13.13.4')
+
+    apply(wg_wizard, executor, artifact, changed, forward_backend)
+
+    assert server.peers == set(['key-alice', 'key-bob', 'key-carol'])
+    assert server.is_routable('10.13.13.4')
+    assert "sudo wg set wg0 peer key-carol preshared-key " + str(wg_wizard.wireguard_config_path / 'peer_carol/presharedkey-peer_carol') + " allowed-ips 10.13.13.4/32" in executor.commands
+    if forward_backend == 'nft':
+        assert server.elements == OrderedDict([('tcp . 30000-30010', '10.13.13.2'), ('udp . 40000', '10.13.13.3'), ('tcp . 50000', '10.13.13.4')])
+    else:
+        assert "sudo iptables -t nat PREROUTING -i eth0 -p tcp --dport 50000 -j DNAT --to-destination 10.13.13.4" in server.rules and len(server.rules) == 3
+
+@pytest.mark.parametrize('forward_backend', ['iptables', 'nft'])
+def test_apply_live_changes_removes_a_peer(wg_wizard, forward_backend):
+    server, executor, artifact = start(wg_wizard, config, forward_backend)
+
+    apply(wg_wizard, executor, artifact, OrderedDict([('alice', config['alice'])]), forward_backend)
+
+    assert server.peers == set(['key-alice'])
+    assert server.is_routable('10.13.13.2') and not server.is_routable('10.13.13.3')
+    if forward_backend == 'nft':
+        assert server.elements == OrderedDict([('tcp . 30000-30010', '10.13.13.2')])
+    else:
+        assert server.rules == set(["sudo iptables -t nat PREROUTING -i eth0 -p tcp --dport 30000:30010 -j DNAT --to-destination 10.13.13.2"])
+
+@pytest.mark.parametrize('forward_backend', ['iptables', 'nft'])
+def test_apply_live_changes_changes_a_port_range(wg_wizard, forward_backend):
+    server, executor, artifact = start(wg_wizard, config, forward_backend)
+
+    apply(wg_wizard, executor, artifact, OrderedDict([('alice', [rule('tcp', '30005-30020')]), ('bob', config['bob'])]), forward_backend)
+
+    assert not any(e.startswith('sudo wg set ') for e in executor.commands)
+    if forward_backend == 'nft':
+        assert server.elements == OrderedDict([('udp . 40000', '10.13.13.3'), ('tcp . 30005-30020', '10.13.13.2')])
+    else:
+        assert server.rules == set(["sudo iptables -t nat PREROUTING -i eth0 -p tcp --dport 30005:30020 -j DNAT --to-destination 10.13.13.2", "sudo iptables -t nat PREROUTING -i eth0 -p udp --dport 40000 -j DNAT --to-destination 10.13.13.3"])
+
+@pytest.mark.parametrize('forward_backend', ['iptables', 'nft'])
+def test_a_changed_uplink_needs_a_restart(wg_wizard, forward_backend):
+    old_artifact, _ = render_artifact(wg_wizard, config, forward_backend, 'eth0')
+    new_artifact, _ = render_artifact(wg_wizard, config, forward_backend, 'ens3')
+
+    assert not wg_wizard.is_live_change(old_artifact, new_artifact)
+    assert not wg_wizard.is_live_change(None, new_artifact)
+
+def test_apply_live_changes_resumes_after_a_failed_step(wg_wizard):
+    # The second deletion fails once. Applying the same change again must neither delete a rule twice nor append one twice.
+    server, executor, artifact = start(wg_wizard, config, 'iptables', fail_on='-D PREROUTING -i eth0 -p udp --dport 40000 ')
+    changed = OrderedDict([('alice', [rule('tcp', '31000')]), ('bob', [rule('udp', '41000')])])
+    progress = []
+
+    with pytest.raises(subprocess.CalledProcessError):
+        apply(wg_wizard, executor, artifact, changed, 'iptables', progress.append)
+
+    assert wg_wizard.is_live_change(progress[-1], render_artifact(wg_wizard, changed, 'iptables')[0])
+    apply(wg_wizard, executor, progress[-1], changed, 'iptables')
+    apply(wg_wizard, executor, artifact, changed, 'iptables')
+
+    assert server.rules == set(["sudo iptables -t nat PREROUTING -i eth0 -p tcp --dport 31000 -j DNAT --to-destination 10.13.13.2", "sudo iptables -t nat PREROUTING -i eth0 -p udp --dport 41000 -j DNAT --to-destination 10.13.13.3"])
+
+def test_apply_live_changes_moves_a_map_element_to_another_peer(wg_wizard):
+    server, executor, artifact = start(wg_wizard, config, 'nft')
+    changed = OrderedDict([('alice', []), ('bob', [rule('udp', '40000'), rule('tcp', '30000-30010')])])
+
+    new_artifact = apply(wg_wizard, executor, artifact, changed, 'nft')
+    apply(wg_wizard, executor, artifact, changed, 'nft')
+
+    assert server.elements == OrderedDict([('udp . 40000', '10.13.13.3'), ('tcp . 30000-30010', '10.13.13.3')])
+    assert wg_wizard.is_live_change(artifact, new_artifact)
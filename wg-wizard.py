@@ -1,20 +1,209 @@
 from collections import OrderedDict
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import difflib
+import getpass
+import hashlib
+import heapq
+import http.server
+import inspect
 import json
 import os
 import pathlib
 import re
+import select
+import struct
 import subprocess
 import sys
+import tempfile
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 program_path = pathlib.Path(__file__).absolute()
 program_config_path = program_path.with_suffix('.json')
+program_state_path = program_path.with_name(program_path.stem + '.state.json')
 max_peers = 253
+# Shard n uses the subnet 10.13.(13 + n).0/24, so there is room for 243 shards.
+max_shards = 243
+wg_listen_port = 51820
 docker_config_path = pathlib.Path("/etc/docker/daemon.json")
-wireguard_config_path = pathlib.Path(os.path.expanduser('~' + os.getlogin())) /  'wireguard'
-docker_run_template = 'sudo docker run -d -p 51820:51820/udp {publish} -e PUID="{puid}" -e PGID="{pgid}" -e TZ="$(cat /etc/timezone)" -e SERVERURL=auto -e SERVERPORT=51820 -e PEERS="{peers}" -e PEERDNS=auto -e INTERNAL_SUBNET=10.13.13.0 -e ALLOWEDIPS=0.0.0.0/0 -e PERSISTENTKEEPALIVE_PEERS="" -e LOG_CONFS=false -v "{config_path}":/config --cap-add=NET_ADMIN --cap-add=SYS_MODULE --name=wireguard --restart=unless-stopped linuxserver/wireguard:latest'
-wg0_postup_template = "iptables -t nat -A PREROUTING -i eth+ -p {protocol} --dport {port_range} -j DNAT --to-destination {ip}"
-wg0_postdown_template = "iptables -t nat -D PREROUTING -i eth+ -p {protocol} --dport {port_range} -j DNAT --to-destination {ip}"
+docker_remove_script = "for pkg in docker.io docker-doc docker-compose docker-compose-v2 podman-docker containerd runc; do sudo apt-get remove -y $pkg; done"
+docker_repository_script = """
+sudo apt-get update
+sudo apt-get install -y ca-certificates curl
+sudo install -m 0755 -d /etc/apt/keyrings
+sudo curl -fsSL https://download.docker.com/linux/ubuntu/gpg -o /etc/apt/keyrings/docker.asc
+sudo chmod a+r /etc/apt/keyrings/docker.asc
+
+echo \
+  "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/ubuntu \
+  $(. /etc/os-release && echo "$VERSION_CODENAME") stable" | \
+  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+sudo apt-get update
+""".strip()
+wireguard_image = "linuxserver/wireguard:latest"
+# The wireguard image has no nftables. It is added once in a derived image, so starting a container never needs the Alpine package mirrors.
+wireguard_nft_image = "wg-wizard/wireguard-nftables:latest"
+wireguard_nft_dockerfile = f"FROM {wireguard_image}\nRUN apk add --no-cache nftables\n"
+docker_run_template = 'sudo docker run -d -p {listen_port}:51820/udp {publish} -e PUID="{puid}" -e PGID="{pgid}" -e TZ="$(cat /etc/timezone)" -e SERVERURL={server_url} -e SERVERPORT={listen_port} -e PEERS="{peers}" -e PEERDNS=auto -e INTERNAL_SUBNET={subnet}.0 -e ALLOWEDIPS=0.0.0.0/0 -e PERSISTENTKEEPALIVE_PEERS="" -e LOG_CONFS=false -v "{config_path}":/config --cap-add=NET_ADMIN --cap-add=SYS_MODULE --name={container} --restart=unless-stopped {image}'
+wg0_forward_postup = "PostUp = iptables -A FORWARD -i %i -j ACCEPT; iptables -A FORWARD -o %i -j ACCEPT; iptables -t nat -A POSTROUTING -o {uplink} -j MASQUERADE"
+wg0_forward_postdown = "PostDown = iptables -D FORWARD -i %i -j ACCEPT; iptables -D FORWARD -o %i -j ACCEPT; iptables -t nat -D POSTROUTING -o {uplink} -j MASQUERADE"
+wg0_postup_template = "iptables -t nat -A PREROUTING -i {uplink} -p {protocol} --dport {port_range} -j DNAT --to-destination {ip}"
+wg0_postdown_template = "iptables -t nat -D PREROUTING -i {uplink} -p {protocol} --dport {port_range} -j DNAT --to-destination {ip}"
+wg0_nft_ruleset_name = 'wg-wizard.nft'
+# Without nft in the image only the forward rules are missing. wg-quick would stop bringing up the interface if PostUp failed.
+wg0_nft_postup_container = f"if command -v nft > /dev/null; then nft -f /config/{wg0_nft_ruleset_name}; else echo 'nft was not found, so the forward rules are not loaded.' >&2; fi"
+wg0_nft_postup_native = "nft -f {path}"
+wg0_nft_postdown_container = "if command -v nft > /dev/null; then nft delete table ip {table}; fi"
+wg0_nft_postdown = "nft delete table ip {table}"
+# Loading this file replaces the whole table in one transaction, so there is no moment without forward rules.
+# The first two lines make sure the table exists before it is deleted.
+wg0_nft_ruleset_template = """
+table ip {table}
+delete table ip {table}
+table ip {table} {{
+    map forward_ports {{
+        type inet_proto . inet_service : ipv4_addr
+        flags interval
+        counter
+{elements}    }}
+
+    chain prerouting {{
+        type nat hook prerouting priority dstnat; policy accept;
+        iifname "{uplink}" meta l4proto {{ tcp, udp }} dnat ip to meta l4proto . th dport map @forward_ports
+    }}
+}}
+""".lstrip()
+forward_backends = ['iptables', 'nft']
+# Counters of 'iptables -t nat -L PREROUTING -v -x -n' and 'nft list map', read back by the metrics mode.
+# The columns between the target and the match differ between iptables versions, so only the counters, the match and the destination are anchored.
+iptables_dnat_counter_pattern = re.compile(r"^ *([0-9]+) +([0-9]+) +DNAT +.*? (tcp|udp) dpts?:([0-9]+)(?::([0-9]+))? +to:([0-9.]+)")
+nft_element_counter_pattern = re.compile(r"\b(tcp|udp) \. ([0-9-]+) counter packets ([0-9]+) bytes ([0-9]+) : ([0-9.]+)")
+metrics_listen = "127.0.0.1:9586"
+metric_families = OrderedDict([
+    ('wg_wizard_server_up', ('gauge', "Whether the counters of the wireguard server could be read.")),
+    ('wg_wizard_peer_latest_handshake_seconds', ('gauge', "Unix time of the latest handshake with the peer, 0 if there was none.")),
+    ('wg_wizard_peer_receive_bytes_total', ('counter', "Bytes received from the peer.")),
+    ('wg_wizard_peer_transmit_bytes_total', ('counter', "Bytes sent to the peer.")),
+    ('wg_wizard_forward_packets_total', ('counter', "Connections forwarded to the port range of the peer. The nat table only counts the first packet of every connection.")),
+    ('wg_wizard_forward_bytes_total', ('counter', "Bytes of the first packets of the connections forwarded to the port range of the peer.")),
+    ('wg_wizard_scrape_duration_seconds', ('gauge', "Seconds it took to read every counter.")),
+])
+server_backends = ['docker', 'native']
+native_config_path = pathlib.Path("/etc/wireguard")
+native_service_path = pathlib.Path("/etc/systemd/system")
+native_sysctl_path = pathlib.Path("/etc/sysctl.d/99-wg-wizard.conf")
+# There is no DNS server inside the tunnel without the container, so native peers resolve through a public one.
+native_peer_dns = "1.1.1.1"
+native_server_config_template = """
+[Interface]
+Address = {subnet}.1
+ListenPort = {listen_port}
+PrivateKey = {private_key}
+{postup}
+{postdown}
+""".lstrip()
+native_server_peer_template = """
+[Peer]
+# peer_{peer}
+PublicKey = {public_key}
+PresharedKey = {preshared_key}
+AllowedIPs = {address}/32
+""".lstrip()
+native_service_template = """
+[Unit]
+Description={interface}
+After=network-online.target
+
+[Service]
+ExecStart=/usr/bin/wg-quick up {interface}
+Type=oneshot
+RemainAfterExit=yes
+ExecStop=/usr/bin/wg-quick down {interface}
+
+[Install]
+WantedBy=multi-user.target
+""".strip()
+# The offline cache holds the .deb files of every package set, with all their dependencies, and the saved wireguard image.
+package_cache_path = program_path.with_name('wg-wizard-cache')
+package_cache_manifest_name = 'manifest.json'
+package_cache_images = OrderedDict([(wireguard_image, 'images/wireguard.tar'), (wireguard_nft_image, 'images/wireguard-nftables.tar')])
+package_cache_installer_name = 'install.py'
+package_cache_max_age_days = 30
+# The auto setup scripts fall back to installing client_packages with apt.
+client_packages = ['wireguard', 'resolvconf']
+package_sets = OrderedDict([
+    ('docker', ['docker-ce', 'docker-ce-cli', 'containerd.io', 'docker-buildx-plugin', 'docker-compose-plugin']),
+    ('wireguard', ['wireguard']),
+    ('wireguard-nftables', ['wireguard', 'nftables']),
+    ('client', client_packages),
+])
+os_release_path = pathlib.Path("/etc/os-release")
+# IPv4 and UDP headers plus the wireguard header and authentication tag around every tunneled packet.
+wg_overhead = 20 + 8 + 32
+# The smallest MTU IPv6 allows.
+min_mtu = 1280
+server_url_api = "https://ipv4.icanhazip.com"
+server_url_placeholder = "<server-url>"
+curve25519_p = 2 ** 255 - 19
+curve25519_a24 = 121665
+curve25519_base_point = (9).to_bytes(32, 'little')
+wg_peer_config_template = """
+[Interface]
+Address = {address}
+PrivateKey = {private_key}
+ListenPort = 51820
+DNS = {dns}
+
+[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+Endpoint = {server_url}:{listen_port}
+AllowedIPs = 0.0.0.0/0
+""".lstrip()
+inotify_in_modify = 0x00000002
+inotify_in_close_write = 0x00000008
+inotify_in_moved_to = 0x00000080
+inotify_in_create = 0x00000100
+inotify_event_header = struct.Struct('iIII')
+ufw_default_path = pathlib.Path("/etc/default/ufw")
+ufw_user_rules_path = pathlib.Path("/etc/ufw/user.rules")
+ufw_user6_rules_path = pathlib.Path("/etc/ufw/user6.rules")
+ufw_rule_template = "### tuple ### allow {protocol} {port_range} {address} any {address} in\n-A {chain} -p {protocol} {dport} -j ACCEPT"
+
+def get_login():
+    # os.getlogin() fails without a controlling terminal, e.g. under cron or in a container.
+    try:
+        return os.getlogin()
+    except OSError:
+        return os.environ.get('SUDO_USER') or getpass.getuser()
+
+wireguard_config_path = pathlib.Path(os.path.expanduser('~' + get_login())) /  'wireguard'
+
+# Shard 0 is the original single wireguard server, so an existing setup is shard 0 of a sharded one.
+def get_shard_container(shard):
+    return 'wireguard' if shard == 0 else f"wireguard-{shard}"
+
+def get_shard_path(shard):
+    return wireguard_config_path.with_name(get_shard_container(shard))
+
+def get_shard_listen_port(shard):
+    return wg_listen_port + shard
+
+def get_shard_subnet(shard):
+    return f"10.13.{13 + shard}"
+
+def get_shard_interface(shard):
+    return f"wg{shard}"
+
+def get_shard_nft_table(shard):
+    return 'wg_wizard' if shard == 0 else f"wg_wizard_{shard}"
 
 def print_info(msg):
     print(f"\033[34m{msg}\033[0m")
@@ -25,13 +214,88 @@ def print_warn(msg):
 def print_error(msg):
     print(f"\033[31m{msg}\033[0m")
 
+def format_port_range(start_port, end_port):
+    return str(start_port) if start_port == end_port else f"{start_port}-{end_port}"
+
+def parse_port_range(port_range):
+    start_port, _, end_port = port_range.partition('-')
+    return int(start_port), int(end_port or start_port)
+
+def coalesce_port_ranges(intervals):
+    merged = []
+
+    for start_port, end_port in sorted(intervals):
+        if len(merged) > 0 and start_port <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end_port)
+        else:
+            merged.append([start_port, end_port])
+
+    return [tuple(e) for e in merged]
+
+def find_port_conflicts(intervals):
+    # Sweep over the intervals ordered by start port while keeping the ones that are still open in a heap keyed by end port.
+    # Every interval left in the heap when a new one starts overlaps with it, so each conflicting pair is reported exactly once.
+    # The pairs of one interval are reported in heap order, which keeps the sweep O(n log n) plus the number of pairs.
+    conflicts = []
+    active = []
+
+    for interval in sorted(intervals):
+        while active and active[0][0] < interval[0]:
+            heapq.heappop(active)
+        for _, other in active:
+            conflicts.append((other, interval))
+        heapq.heappush(active, (interval[1], interval))
+
+    return conflicts
+
+def render_ufw_rules(allow_rules, address, chain):
+    rules = []
+
+    for protocol, port_range in allow_rules:
+        if ':' in port_range:
+            dport = f"-m multiport --dports {port_range}"
+        else:
+            dport = f"--dport {port_range}"
+        rules.append(ufw_rule_template.format(protocol=protocol, port_range=port_range, address=address, chain=chain, dport=dport))
+
+    return rules
+
+def apply_ufw_rules(executor, allow_rules):
+    # Write every rule into the RULES section of the files ufw keeps after a reset, exactly as 'ufw allow' would,
+    # so that a single 'ufw enable' loads the whole ruleset instead of starting ufw once per rule.
+    # ip6tables-restore only knows the ufw6 chains, so user6.rules gets its own chain name.
+    rules_files = [(ufw_user_rules_path, '0.0.0.0/0', 'ufw-user-input')]
+
+    if executor.is_file(ufw_default_path) and re.search(r"^IPV6=yes$", executor.read_text(ufw_default_path), re.M):
+        rules_files.append((ufw_user6_rules_path, '::/0', 'ufw6-user-input'))
+
+    rendered_files = []
+
+    for rules_path, address, chain in rules_files:
+        if not executor.is_file(rules_path):
+            return False
+
+        rules_content = executor.read_text(rules_path)
+        rules_section = re.search(r"^### RULES ###\n.*?^### END RULES ###$", rules_content, re.M | re.S)
+
+        if rules_section is None:
+            return False
+
+        rules = render_ufw_rules(allow_rules, address, chain)
+        new_section = '\n\n'.join(["### RULES ###"] + rules + ["### END RULES ###"])
+        rendered_files.append((rules_path, rules_content[:rules_section.start()] + new_section + rules_content[rules_section.end():]))
+
+    for rules_path, rules_content in rendered_files:
+        executor.write_text(rules_path, rules_content)
+
+    return True
+
 def verify_config(dict_obj):
-    if len(dict_obj) > max_peers:
-        print_error(f"The number of peers cannot exceed {max_peers}.")
+    if len(dict_obj) > max_peers * max_shards:
+        print_error(f"The number of peers cannot exceed {max_peers * max_shards}.")
         return False
 
-    used_tcp_ports = set()
-    used_udp_ports = set()
+    port_intervals = {'tcp': [], 'udp': []}
 
     for peer, forward_rules in dict_obj.items():
         if not re.match(r"^[A-Za-z0-9]+$", peer):
@@ -68,236 +332,721 @@ def verify_config(dict_obj):
                         if start_port > end_port:
                             print_error("The value for key 'port-range' is invalid. end_port must be greater than start_port.")
                             return False
-                        if forward_rule['protocol'] == 'tcp':
-                            if len(used_tcp_ports.intersection(set(range(start_port, end_port + 1)))) > 0:
-                                print_error("The value for key 'port-range' is invalid. An attempt was made to reuse a tcp port that has already been used.")
-                                return False
-                            else:
-                                used_tcp_ports.update(range(start_port, end_port + 1))
-                        elif forward_rule['protocol'] == 'udp':
-                            if len(used_udp_ports.intersection(set(range(start_port, end_port + 1)))) > 0:
-                                print_error("The value for key 'port-range' is invalid. An attempt was made to reuse a udp port that has already been used.")
-                                return False
-                            else:
-                                used_udp_ports.update(range(start_port, end_port + 1))
-                        else:
-                            print_error("The value for key 'protocol' must be tcp or udp.")
-                            return False
                     elif value.isdecimal():
-                        single_port = int(value)
-                        if single_port not in range(0, 65536):
+                        start_port = end_port = int(value)
+                        if start_port not in range(0, 65536):
                             print_error("The value for key 'port-range' is invalid. Must be an integer between 0 and 65535.")
                             return False
-                        if forward_rule['protocol'] == 'tcp':
-                            if single_port in used_tcp_ports:
-                                print_error("The value for key 'port-range' is invalid. An attempt was made to reuse a tcp port that has already been used.")
-                                return False
-                            else:
-                                used_tcp_ports.add(single_port)
-                        elif forward_rule['protocol'] == 'udp':
-                            if single_port in used_udp_ports:
-                                print_error("The value for key 'port-range' is invalid. An attempt was made to reuse a udp port that has already been used.")
-                                return False
-                            else:
-                                used_udp_ports.add(single_port)
-                        else:
-                            print_error("The value for key 'protocol' must be tcp or udp.")
-                            return False
                     else:
                         print_error("The value of key 'port-range' must be an integer between 0 and 65535 or a port range in the format start_port-end_port.")
                         return False
+                    if forward_rule['protocol'] in port_intervals:
+                        port_intervals[forward_rule['protocol']].append((start_port, end_port, peer))
+                    else:
+                        print_error("The value for key 'protocol' must be tcp or udp.")
+                        return False
                 else:
                     print_warn(f"An unnecessary key '{key}' exists in the forward rule of {peer}.")
 
+    conflict_found = False
+
+    for protocol, intervals in port_intervals.items():
+        for (start_a, end_a, peer_a), (start_b, end_b, peer_b) in find_port_conflicts(intervals):
+            print_error(f"The value for key 'port-range' is invalid. {protocol} port range {format_port_range(start_a, end_a)} of '{peer_a}' overlaps with {protocol} port range {format_port_range(start_b, end_b)} of '{peer_b}'.")
+            conflict_found = True
+
+    if conflict_found:
+        return False
+
     return True
 
-if not program_config_path.is_file():
-    print_error(f"{str(program_config_path)} file cannot be found.")
-    sys.exit(1)
+def normalize_config(dict_obj):
+    # Merge adjacent or touching port ranges of the same peer and protocol so that every generator emits as few rules as possible.
+    normalized = OrderedDict()
 
-with program_config_path.open('r', encoding='utf-8') as f:
-    program_config_dict = json.load(f, object_pairs_hook=OrderedDict) or OrderedDict()
+    for peer, forward_rules in dict_obj.items():
+        normalized[peer] = []
+
+        for protocol in ['tcp', 'udp']:
+            intervals = [parse_port_range(e['port-range']) for e in forward_rules if e['protocol'] == protocol]
+
+            for start_port, end_port in coalesce_port_ranges(intervals):
+                normalized[peer].append(OrderedDict([('protocol', protocol), ('port-range', format_port_range(start_port, end_port))]))
+
+        if len(normalized[peer]) < len(forward_rules):
+            print_info(f"The forward rules of {peer} have been merged from {len(forward_rules)} into {len(normalized[peer])}.")
+
+    return normalized
+
+def x25519(scalar, u):
+    # Montgomery ladder from RFC 7748. wg genkey and wg pubkey do the same computation.
+    k = int.from_bytes(scalar, 'little')
+    k &= ~7
+    k &= ~(128 << 8 * 31)
+    k |= 64 << 8 * 31
+    x1 = int.from_bytes(u, 'little') & ((1 << 255) - 1)
+    x2, z2, x3, z3, swap = 1, 0, x1, 1, 0
+
+    for t in reversed(range(255)):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = k_t
+
+        a = x2 + z2
+        aa = a * a % curve25519_p
+        b = x2 - z2
+        bb = b * b % curve25519_p
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % curve25519_p
+        cb = c * b % curve25519_p
+        x3 = (da + cb) ** 2 % curve25519_p
+        z3 = x1 * (da - cb) ** 2 % curve25519_p
+        x2 = aa * bb % curve25519_p
+        z2 = e * (aa + curve25519_a24 * e) % curve25519_p
+
+    if swap:
+        x2, x3 = x3, x2
+        z2, z3 = z3, z2
+
+    return (x2 * pow(z2, curve25519_p - 2, curve25519_p) % curve25519_p).to_bytes(32, 'little')
+
+def generate_key_set(_=None):
+    private_key = bytearray(os.urandom(32))
+    private_key[0] &= 248
+    private_key[31] = (private_key[31] & 127) | 64
+    public_key = x25519(bytes(private_key), curve25519_base_point)
+    preshared_key = os.urandom(32)
+    return tuple(base64.b64encode(e).decode() for e in [bytes(private_key), public_key, preshared_key])
+
+def generate_key_sets(count):
+    if count < 2 or (os.cpu_count() or 1) < 2:
+        return [generate_key_set() for _ in range(count)]
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            return list(executor.map(generate_key_set, range(count), chunksize=max(1, count // (os.cpu_count() * 4))))
+    except (OSError, concurrent.futures.process.BrokenProcessPool):
+        return [generate_key_set() for _ in range(count)]
+
+def detect_server_url(executor, dict_obj, fetch=True):
+    for peer in dict_obj.keys():
+        peer_config_path = wireguard_config_path / f"peer_{peer}/peer_{peer}.conf"
+
+        if executor.is_file(peer_config_path):
+            endpoint = re.search(r"^Endpoint *= *(.+):[0-9]+$", executor.read_text(peer_config_path), re.M)
+            if endpoint is not None:
+                return endpoint.group(1)
+
+    if not fetch:
+        return None
+
+    server_url = executor.fetch_text(server_url_api)
+    return server_url.strip() if server_url is not None else None
+
+def count_shards(executor, dict_obj):
+    # Shards that already have server keys stay, so peers are never moved to another shard without being asked to.
+    shards = 1
+
+    while shards < max_shards and executor.is_file(get_shard_path(shards) / 'server/privatekey-server'):
+        shards += 1
+
+    return max(shards, -(-len(dict_obj) // max_peers))
+
+def assign_peer_addresses(executor, dict_obj, shards):
+    # Peers keep the shard and address of their existing profile, so adding or removing peers never renumbers the others.
+    # New peers go to the shard with the fewest peers and get its lowest free address.
+    assignment = OrderedDict()
+    used_hosts = [set() for _ in range(shards)]
+
+    for peer in dict_obj.keys():
+        for shard in range(shards):
+            peer_config_path = get_shard_path(shard) / f"peer_{peer}/peer_{peer}.conf"
+
+            if not executor.is_file(peer_config_path):
+                continue
+
+            address = re.search(r"^Address *= *([0-9]+\.[0-9]+\.[0-9]+)\.([0-9]+)", executor.read_text(peer_config_path), re.M)
+
+            if address is not None and address.group(1) == get_shard_subnet(shard) and 2 <= int(address.group(2)) <= max_peers + 1 and int(address.group(2)) not in used_hosts[shard]:
+                used_hosts[shard].add(int(address.group(2)))
+                assignment[peer] = (shard, f"{address.group(1)}.{address.group(2)}")
+            break
+
+    next_hosts = [2] * shards
+
+    for peer in dict_obj.keys():
+        if peer in assignment:
+            continue
+
+        shard = min(range(shards), key=lambda e: (len(used_hosts[e]), e))
+
+        if len(used_hosts[shard]) >= max_peers:
+            print_error(f"There is no free address for {peer}. {len(dict_obj)} peers need at least {-(-len(dict_obj) // max_peers)} shards.")
+            sys.exit(1)
+
+        while next_hosts[shard] in used_hosts[shard]:
+            next_hosts[shard] += 1
+
+        used_hosts[shard].add(next_hosts[shard])
+        assignment[peer] = (shard, f"{get_shard_subnet(shard)}.{next_hosts[shard]}")
+
+    return OrderedDict([(peer, assignment[peer]) for peer in dict_obj.keys()])
+
+def split_config(dict_obj, assignment, shards):
+    shard_configs = [OrderedDict() for _ in range(shards)]
+
+    for peer, forward_rules in dict_obj.items():
+        shard_configs[assignment[peer][0]][peer] = forward_rules
+
+    return shard_configs
+
+def seed_wireguard_config(executor, dict_obj, server_url, assignment, peer_dns=None):
+    # Keys and peer profiles are laid out the way the linuxserver/wireguard image stores them. The image reuses whatever it finds,
+    # so existing peers keep their keys and new peers get their profile without waiting for the container.
+    key_paths = OrderedDict()
+
+    for shard in sorted(set([e[0] for e in assignment.values()])):
+        server_path = get_shard_path(shard) / 'server'
+
+        if not executor.is_file(server_path / 'privatekey-server'):
+            key_paths[shard] = (server_path / 'privatekey-server', server_path / 'publickey-server', None)
+
+    for peer in dict_obj.keys():
+        peer_path = get_shard_path(assignment[peer][0]) / f"peer_{peer}"
+
+        if not executor.is_file(peer_path / f"privatekey-peer_{peer}"):
+            key_paths[peer] = (peer_path / f"privatekey-peer_{peer}", peer_path / f"publickey-peer_{peer}", peer_path / f"presharedkey-peer_{peer}")
+
+    if len(key_paths) > 0:
+        print_info(f"I will generate {len(key_paths)} key pairs.")
 
-# Verify program_config_dict
-if not verify_config(program_config_dict):
-    sys.exit(1)
+    for (private_key_path, public_key_path, preshared_key_path), key_set in zip(key_paths.values(), generate_key_sets(len(key_paths))):
+        executor.write_text(private_key_path, key_set[0] + '\n', mode=0o600)
+        executor.write_text(public_key_path, key_set[1] + '\n', mode=0o600)
+        if preshared_key_path is not None:
+            executor.write_text(preshared_key_path, key_set[2] + '\n', mode=0o600)
 
-# Configure ufw firewall
-if subprocess.run("which ufw".split(), stdout = subprocess.DEVNULL).returncode == 0:
-    print_info("ufw was found. I'm going to reset the firewall and set it up from scratch.")
+    server_public_keys = OrderedDict()
+    peer_public_keys = OrderedDict()
+    peer_configs = OrderedDict()
 
-    subprocess.run("sudo ufw disable".split(), check=True, stdout = subprocess.DEVNULL)
-    subprocess.run("sudo ufw --force reset".split(), check=True, stdout = subprocess.DEVNULL)
-    subprocess.run("sudo ufw default deny incoming".split(), check=True, stdout = subprocess.DEVNULL)
-    subprocess.run("sudo ufw default allow outgoing".split(), check=True, stdout = subprocess.DEVNULL)
+    for peer in dict_obj.keys():
+        shard, address = assignment[peer]
+        peer_path = get_shard_path(shard) / f"peer_{peer}"
+        peer_config_path = peer_path / f"peer_{peer}.conf"
+        peer_public_keys[peer] = executor.read_text(peer_path / f"publickey-peer_{peer}").strip()
 
-    ss_output = subprocess.run("sudo ss -nlptu".split(), check=True, stdout=subprocess.PIPE).stdout.decode()
+        dns = peer_dns or f"{get_shard_subnet(shard)}.1"
+
+        if executor.is_file(peer_config_path) and re.search(f"^Address *= *{re.escape(address)}$", executor.read_text(peer_config_path), re.M) and re.search(f"^DNS *= *{re.escape(dns)}$", executor.read_text(peer_config_path), re.M):
+            peer_configs[peer] = executor.read_text(peer_config_path)
+        else:
+            if shard not in server_public_keys:
+                server_public_keys[shard] = executor.read_text(get_shard_path(shard) / 'server/publickey-server').strip()
+            peer_configs[peer] = wg_peer_config_template.format(address=address, private_key=executor.read_text(peer_path / f"privatekey-peer_{peer}").strip(), dns=dns, server_public_key=server_public_keys[shard], preshared_key=executor.read_text(peer_path / f"presharedkey-peer_{peer}").strip(), server_url=server_url, listen_port=get_shard_listen_port(shard))
+            executor.write_text(peer_config_path, peer_configs[peer], mode=0o600)
+
+    return peer_public_keys, peer_configs
+
+def load_program_config(executor):
+    if not executor.is_file(program_config_path):
+        print_error(f"{str(program_config_path)} file cannot be found.")
+        sys.exit(1)
+
+    return json.loads(executor.read_text(program_config_path), object_pairs_hook=OrderedDict) or OrderedDict()
+
+def load_state(executor):
+    if not executor.is_file(program_state_path):
+        return OrderedDict()
+
+    try:
+        return json.loads(executor.read_text(program_state_path), object_pairs_hook=OrderedDict) or OrderedDict()
+    except ValueError:
+        print_warn(f"{str(program_state_path)} file is corrupted. I will apply every phase again.")
+        return OrderedDict()
+
+def save_state(executor, state):
+    executor.write_text(program_state_path, json.dumps(state, indent=2, sort_keys=False))
+
+def hash_object(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=False).encode('utf-8')).hexdigest()
+
+def get_sshd_ports(executor):
+    ss_output = executor.run("sudo ss -nlptu", check=True, stdout=subprocess.PIPE, probe=True).stdout
     grep_sshd = [e for e in ss_output.split('\n') if 'sshd' in e]
     awk_print_5 = [e.split()[4] for e in grep_sshd]
-    sshd_ports = list(set([e.rpartition(':')[2] for e in awk_print_5]))
+    return sorted(set([e.rpartition(':')[2] for e in awk_print_5]))
 
-    if len(sshd_ports) > 0:
-        print_info(f"It seems that the ssh server is using the following port. {sshd_ports}")
-        
-        for port in sshd_ports:
-            subprocess.run(f"sudo ufw allow {port}/tcp".split(), check=True, stdout = subprocess.DEVNULL)
+def render_ufw_allow_rules(dict_obj, sshd_ports, shards=1):
+    ufw_allow_rules = []
 
-    subprocess.run("sudo ufw allow 51820/udp".split(), check=True, stdout = subprocess.DEVNULL)
+    for port in sshd_ports:
+        ufw_allow_rules.append(('tcp', port))
 
-    for forward_rules in program_config_dict.values():
+    ufw_allow_rules.append(('udp', format_port_range(get_shard_listen_port(0), get_shard_listen_port(shards - 1)).replace('-', ':')))
+
+    for forward_rules in dict_obj.values():
         for forward_rule in forward_rules:
-            subprocess.run(f"sudo ufw allow {forward_rule['port-range'].replace('-', ':')}/{forward_rule['protocol']}".split(), check=True, stdout = subprocess.DEVNULL)
+            ufw_allow_rules.append((forward_rule['protocol'], forward_rule['port-range'].replace('-', ':')))
 
-    subprocess.run("sudo ufw --force enable".split(), check=True, stdout = subprocess.DEVNULL)
+    return list(OrderedDict.fromkeys(ufw_allow_rules))
 
-    print(subprocess.run("sudo ufw show added".split(), check=True, stdout=subprocess.PIPE).stdout.decode())
-else:
-    print_info("ufw was not found. I will skip setting up the firewall.")
+def configure_ufw(executor, ufw_allow_rules):
+    executor.run("sudo ufw disable", check=True, stdout = subprocess.DEVNULL)
+    executor.run("sudo ufw --force reset", check=True, stdout = subprocess.DEVNULL)
+    executor.run("sudo ufw default deny incoming", check=True, stdout = subprocess.DEVNULL)
+    executor.run("sudo ufw default allow outgoing", check=True, stdout = subprocess.DEVNULL)
 
-# Install docker
-if subprocess.run("which docker".split(), stdout = subprocess.DEVNULL).returncode == 0:
-    print_info("Docker was found. I will skip installing docker.")
-else:
-    print_info("Docker was not found. I'm going to install docker.")
+    if not apply_ufw_rules(executor, ufw_allow_rules):
+        print_warn("The ufw rules file could not be updated directly. I will add the rules one by one, which may take a while.")
+
+        for protocol, port_range in ufw_allow_rules:
+            executor.run(f"sudo ufw allow {port_range}/{protocol}", check=True, stdout = subprocess.DEVNULL)
+
+    executor.run("sudo ufw --force enable", check=True, stdout = subprocess.DEVNULL)
 
-    subprocess.run("""
+    print(executor.run("sudo ufw show added", check=True, stdout=subprocess.PIPE).stdout)
+
+def install_docker(executor, package_cache=None):
+    if package_cache is not None:
+        executor.run(docker_remove_script, shell=True)
+
+        if install_from_package_cache(executor, package_cache, 'docker'):
+            return
+
+    executor.run(f"""
 DEBIAN_FRONTEND=noninteractive
 
-for pkg in docker.io docker-doc docker-compose docker-compose-v2 podman-docker containerd runc; do sudo apt-get remove -y $pkg; done
+{docker_remove_script}
 
-sudo apt-get update
-sudo apt-get install -y ca-certificates curl
-sudo install -m 0755 -d /etc/apt/keyrings
-sudo curl -fsSL https://download.docker.com/linux/ubuntu/gpg -o /etc/apt/keyrings/docker.asc
-sudo chmod a+r /etc/apt/keyrings/docker.asc
+{docker_repository_script}
 
-echo \
-  "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/ubuntu \
-  $(. /etc/os-release && echo "$VERSION_CODENAME") stable" | \
-  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
-sudo apt-get update
+sudo apt-get install -y {' '.join(package_sets['docker'])}
+""".strip(), check=True, shell=True)
 
-sudo apt-get install -y docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin
+def build_wireguard_nft_image(executor):
+    # The build directory only holds the Dockerfile, so nothing else is sent to docker.
+    build_path = executor.make_temp_dir('wg-wizard-image-')
+    executor.write_text(build_path / 'Dockerfile', wireguard_nft_dockerfile)
+
+    try:
+        return executor.run(f"sudo docker build -t {wireguard_nft_image} {str(build_path)}", stdout = subprocess.DEVNULL).returncode == 0
+    finally:
+        executor.run(f"rm -rf {str(build_path)}")
+
+def render_docker_run_publish(dict_obj):
+    docker_run_publish = []
+
+    for forward_rules in dict_obj.values():
+        for forward_rule in forward_rules:
+            docker_run_publish.append(f"-p {forward_rule['port-range']}:{forward_rule['port-range']}/{forward_rule['protocol']}")
+
+    return docker_run_publish
+
+def render_docker_run(dict_obj, server_url, shard=0, image=wireguard_image):
+    return docker_run_template.format(publish=' '.join(render_docker_run_publish(dict_obj)), listen_port=get_shard_listen_port(shard), server_url=server_url, puid=f"$(id -u {get_login()})", pgid=f"$(id -g {get_login()})", peers=','.join(dict_obj.keys()), subnet=get_shard_subnet(shard), config_path=str(get_shard_path(shard)), container=get_shard_container(shard), image=image)
+
+def render_wg0_postup_postdown(dict_obj, assignment, forward_backend='iptables', server_backend='docker', shard=0, uplink='eth+'):
+    # Inside the container the uplink is eth0. On the host it is the interface of the default route.
+    postup = []
+    postup.append(wg0_forward_postup.format(uplink=uplink))
+    postdown = []
+    postdown.append(wg0_forward_postdown.format(uplink=uplink))
+
+    if forward_backend == 'nft':
+        postup.append(wg0_nft_postup_container if server_backend == 'docker' else wg0_nft_postup_native.format(path=str(get_shard_path(shard) / wg0_nft_ruleset_name)))
+        postdown.append((wg0_nft_postdown_container if server_backend == 'docker' else wg0_nft_postdown).format(table=get_shard_nft_table(shard)))
+        return '; '.join(postup), '; '.join(postdown)
+
+    for peer, forward_rules in dict_obj.items():
+        for forward_rule in forward_rules:
+            postup.append(wg0_postup_template.format(uplink=uplink, protocol=forward_rule['protocol'], port_range=forward_rule['port-range'].replace('-', ':'), ip=assignment[peer][1]))
+            postdown.append(wg0_postdown_template.format(uplink=uplink, protocol=forward_rule['protocol'], port_range=forward_rule['port-range'].replace('-', ':'), ip=assignment[peer][1]))
+
+    return '; '.join(postup), '; '.join(postdown)
+
+def render_nft_ruleset(dict_obj, assignment, shard=0, uplink='eth+'):
+    # Every packet is looked up once in an interval map instead of walking one DNAT rule per forward rule.
+    elements = []
+
+    for peer, forward_rules in dict_obj.items():
+        for forward_rule in forward_rules:
+            elements.append(f"{forward_rule['protocol']} . {forward_rule['port-range']} : {assignment[peer][1]}")
+
+    # iptables and nftables use different wildcards for interface names.
+    table = get_shard_nft_table(shard)
+    uplink = uplink.replace('+', '*')
+
+    if len(elements) == 0:
+        return wg0_nft_ruleset_template.format(table=table, uplink=uplink, elements='')
+
+    return wg0_nft_ruleset_template.format(table=table, uplink=uplink, elements="        elements = {\n" + ',\n'.join([f"            {e}" for e in elements]) + "\n        }\n")
+
+def render_rules_artifact(postup, postdown, nft_ruleset):
+    # One line per PostUp and PostDown command and per map element, which is what the live changes of the watch mode diff.
+    return postup.split('; ') + postdown.split('; ') + ([] if nft_ruleset is None else [e.strip().rstrip(',') for e in nft_ruleset.split('\n') if ' : ' in e])
+
+def get_uplink_interface(executor):
+    route_output = executor.run("ip -4 route show default", stdout=subprocess.PIPE, probe=True).stdout or ''
+    uplink = re.search(r"\bdev (\S+)", route_output)
+    return uplink.group(1) if uplink is not None else None
+
+def install_wireguard(executor, forward_backend, package_cache=None):
+    set_name = 'wireguard-nftables' if forward_backend == 'nft' else 'wireguard'
+
+    if package_cache is not None and install_from_package_cache(executor, package_cache, set_name):
+        return
+
+    executor.run(f"""
+DEBIAN_FRONTEND=noninteractive
+
+sudo apt-get update
+sudo apt-get install -y {' '.join(package_sets[set_name])}
 """.strip(), check=True, shell=True)
 
-# Apply tweak to Docker
-if docker_config_path.is_file():
-    with docker_config_path.open('r', encoding='utf-8') as f:
-        docker_config_dict = json.load(f, object_pairs_hook=OrderedDict) or OrderedDict()
-else:
-    docker_config_dict = OrderedDict()
+package_cache_installer_head = '''
+#!/usr/bin/env python3
+from collections import OrderedDict
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+'''.strip()
 
-if 'userland-proxy' not in docker_config_dict or docker_config_dict['userland-proxy'] == True:
-    print_info("I will apply a tweak to prevent docker from using the userland proxy.")
-    
-    docker_config_dict['userland-proxy'] = False
+package_cache_installer_body = '''
+# Install a package set
+parser = argparse.ArgumentParser(description="Install a package set from this cache without downloading anything, if the cache suits this computer.")
+parser.add_argument('set_name', choices=list(package_sets.keys()))
+parser.add_argument('--max-age', type=float, default=package_cache_max_age_days, help="days after which the cache is considered stale, 0 never expires (default: %(default)s)")
+args = parser.parse_args()
 
-    with docker_config_path.open('w', encoding='utf-8') as f:
-        json.dump(docker_config_dict, f, indent=2, sort_keys=False)
+executor = RealExecutor()
+cache_path = pathlib.Path(__file__).absolute().parent
+problems = check_package_cache(executor, cache_path, [args.set_name], [], get_distribution(executor), args.max_age)
 
-    subprocess.run("sudo systemctl restart docker.service".split(), check=True, stdout = subprocess.DEVNULL)
-else:
-    print_info("The tweak is already applied to docker.")
+if len(problems) > 0:
+    print_warn(f"I cannot use the package cache in {str(cache_path)}, so I will download the packages instead.")
+    for problem in problems:
+        print_warn(problem)
+    sys.exit(2)
 
-# Run wireguard server
-wireguard_config_path.mkdir(exist_ok=True, parents=False)
+sys.exit(0 if install_from_package_cache(executor, cache_path, args.set_name) else 1)
+'''.strip()
 
-with os.scandir(wireguard_config_path) as it:
-    if any(it):
-        print_warn("There is an existing configuration for the wireguard server. Updating your current settings is not guaranteed and may conflict with your existing settings.")
+package_cache_installer_constants = ['package_cache_manifest_name', 'package_cache_max_age_days', 'package_sets', 'os_release_path']
 
-docker_run_publish = []
+def get_distribution(executor):
+    os_release = dict(re.findall(r'^([A-Z_]+)="?([^"\n]*)"?$', executor.read_text(os_release_path) if executor.is_file(os_release_path) else '', re.M))
+    architecture = (executor.run("dpkg --print-architecture", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, probe=True).stdout or '').strip()
+    return f"{os_release.get('ID', 'unknown')} {os_release.get('VERSION_CODENAME') or os_release.get('VERSION_ID', 'unknown')} {architecture or 'unknown'}"
 
-for forward_rules in program_config_dict.values():
-    for forward_rule in forward_rules:
-        docker_run_publish.append(f"-p {forward_rule['port-range']}:{forward_rule['port-range']}/{forward_rule['protocol']}")
+def open_package_cache(executor, cache):
+    # Returns the cache directory and whether it is temporary. Without --cache, the cache directory next to this script is used when there is one.
+    # A tarball is unpacked into a temporary directory, which close_package_cache removes.
+    if cache is None:
+        return (package_cache_path if executor.is_file(package_cache_path / package_cache_manifest_name) else None), False
 
-docker_run = docker_run_template.format(publish=' '.join(docker_run_publish), puid=f"$(id -u {os.getlogin()})", pgid=f"$(id -g {os.getlogin()})", peers=','.join(program_config_dict.keys()), config_path=str(wireguard_config_path))
+    cache_path = pathlib.Path(cache).absolute()
 
-print_info("I'm going to run the wireguard server using the following command.")
-print(docker_run)
+    if re.search(r"\.(tar|tar\.gz|tgz)$", cache_path.name) and executor.is_file(cache_path):
+        unpacked_path = executor.make_temp_dir('wg-wizard-cache-')
+        executor.run(f"tar -xf {str(cache_path)} -C {str(unpacked_path)}", check=True)
+        return unpacked_path, True
 
-subprocess.run("sudo docker stop wireguard".split(), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-subprocess.run("sudo docker rm wireguard".split(), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-subprocess.run(docker_run, check=True, shell=True, stdout = subprocess.DEVNULL)
+    return cache_path, False
 
-# Edit wg0.conf
-wg0_config_path = wireguard_config_path / "wg_confs/wg0.conf"
-start_time = time.time()
+def close_package_cache(executor, cache_path, temporary):
+    if temporary:
+        executor.run(f"rm -rf {str(cache_path)}", check=True)
 
-while not wg0_config_path.is_file():
-    if (time.time() - start_time) >= 15:
-        print_error(f"{str(wg0_config_path)} file cannot be found.")
-        exit(1)
-    time.sleep(1)
+def check_package_cache(executor, cache_path, set_names, images, distribution, max_age_days, now=None):
+    # Returns why the cache cannot be used. A cache is stale when it was made for another release or architecture, is older than max_age_days
+    # or holds other packages than this version of wg-wizard.py installs, and incomplete when a file is missing or does not match its checksum.
+    manifest_path = cache_path / package_cache_manifest_name
 
-print_info("I will add forward rules to the wireguard server.")
+    if not executor.is_file(manifest_path):
+        return [f"{str(manifest_path)} cannot be found."]
 
-wg0_config = []
+    try:
+        manifest = json.loads(executor.read_text(manifest_path), object_pairs_hook=OrderedDict)
+    except ValueError:
+        return [f"{str(manifest_path)} is corrupted."]
 
-with wg0_config_path.open('r', encoding='utf-8') as f:
-    for line in f:
-        line = line.strip()
+    problems = []
+    age_days = ((now or time.time()) - manifest.get('created', 0)) / 86400
 
-        if re.match("^PostUp *=", line, re.I):
-            temp = []
-            temp.append("PostUp = iptables -A FORWARD -i %i -j ACCEPT; iptables -A FORWARD -o %i -j ACCEPT; iptables -t nat -A POSTROUTING -o eth+ -j MASQUERADE")
+    if manifest.get('distribution') != distribution:
+        problems.append(f"It was made for {manifest.get('distribution')}, but this is {distribution}.")
 
-            for i, (peer, forward_rules) in enumerate(program_config_dict.items()):
-                for forward_rule in forward_rules:
-                    temp.append(wg0_postup_template.format(protocol=forward_rule['protocol'], port_range=forward_rule['port-range'].replace('-', ':'), ip=f"10.13.13.{str(i+2)}"))
+    if max_age_days > 0 and age_days > max_age_days:
+        problems.append(f"It is {int(age_days)} days old and may miss security updates. Create it again or raise --cache-max-age.")
 
-            wg0_config.append('; '.join(temp))
-        elif re.match("^PostDown *=", line, re.I):
-            temp = []
-            temp.append("PostDown = iptables -D FORWARD -i %i -j ACCEPT; iptables -D FORWARD -o %i -j ACCEPT; iptables -t nat -D POSTROUTING -o eth+ -j MASQUERADE")
+    def check_file(entry):
+        if not executor.is_file(cache_path / entry['path']):
+            problems.append(f"{entry['path']} is missing.")
+        elif executor.hash_file(cache_path / entry['path']) != entry['sha256']:
+            problems.append(f"{entry['path']} is damaged.")
+
+    for set_name in set_names:
+        package_set = manifest.get('sets', {}).get(set_name)
+
+        if package_set is None or len(package_set.get('files', [])) == 0:
+            problems.append(f"It has no {set_name} packages.")
+        elif package_set.get('packages') != package_sets[set_name]:
+            problems.append(f"It has the {set_name} packages {', '.join(package_set.get('packages', []))} instead of {', '.join(package_sets[set_name])}.")
+        else:
+            for entry in package_set['files']:
+                check_file(entry)
+
+    for image in images:
+        if image not in manifest.get('images', {}):
+            problems.append(f"It has no {image} image.")
+        else:
+            check_file(manifest['images'][image])
+
+    return problems
+
+def install_from_package_cache(executor, cache_path, set_name):
+    # Packages that are installed in the same or a newer version are left out, because apt would downgrade them.
+    manifest = json.loads(executor.read_text(cache_path / package_cache_manifest_name), object_pairs_hook=OrderedDict)
+    installed = {}
+
+    for line in (executor.run("dpkg-query -W -f=${db:Status-Abbrev}${Package}\\t${Version}\\n", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, probe=True).stdout or '').split('\n'):
+        if line.startswith('ii '):
+            package, _, version = line[3:].partition('\t')
+            installed[package] = version
+
+    deb_paths = []
+
+    for entry in manifest['sets'][set_name]['files']:
+        version = installed.get(entry['package'])
+        if version is None or (version != entry['version'] and executor.run(f"dpkg --compare-versions {entry['version']} gt {version}", probe=True).returncode == 0):
+            deb_paths.append(str(cache_path / entry['path']))
+
+    if len(deb_paths) == 0:
+        print_info(f"Every {set_name} package in the cache is already installed.")
+        return True
+
+    print_info(f"I will install {len(deb_paths)} {set_name} packages from {str(cache_path)} without downloading anything.")
+
+    if executor.run(f"sudo DEBIAN_FRONTEND=noninteractive apt-get install -y --no-download {' '.join(deb_paths)}").returncode != 0:
+        print_warn("apt could not install the packages from the cache. I will download them instead.")
+        return False
+
+    return True
+
+def render_package_cache_installer():
+    # The auto setup scripts run this installer from the cache, so the client is checked and installed by the same code as the server.
+    # The functions are resolved here because the executors are defined further below.
+    installer = [package_cache_installer_head]
+    installer.append(render_shared_code(package_cache_installer_constants, [print_info, print_warn, print_error, Executor, RealExecutor, get_distribution, check_package_cache, install_from_package_cache]))
+    installer.append(package_cache_installer_body)
+
+    return '\n'.join(installer) + '\n'
+
+def create_package_cache(executor, cache_path):
+    print_info(f"I will download every package wg-wizard.py and the auto setup scripts install, and the wireguard image, into {str(cache_path)}.")
+
+    # The docker repository has to be known to apt to download docker.
+    executor.run(f"DEBIAN_FRONTEND=noninteractive\n\n{docker_repository_script}", check=True, shell=True)
+
+    manifest = OrderedDict([('created', int(time.time())), ('distribution', get_distribution(executor)), ('sets', OrderedDict()), ('images', OrderedDict())])
+
+    for set_name, packages in package_sets.items():
+        set_path = cache_path / 'debs' / set_name
+
+        # With an empty dpkg status, apt downloads every dependency as if nothing was installed, so the set also installs on a bare host.
+        executor.run(f"sudo mkdir -p {str(set_path / 'partial')}", check=True)
+        executor.run(f"sudo apt-get install -y --download-only -o Dir::State::status=/dev/null -o Dir::Cache::archives={str(set_path)} {' '.join(packages)}", check=True, stdout = subprocess.DEVNULL)
 
-            for i, (peer, forward_rules) in enumerate(program_config_dict.items()):
-                for forward_rule in forward_rules:
-                    temp.append(wg0_postdown_template.format(protocol=forward_rule['protocol'], port_range=forward_rule['port-range'].replace('-', ':'), ip=f"10.13.13.{str(i+2)}"))
+        entries = []
 
-            wg0_config.append('; '.join(temp))
+        for name in executor.list_dir(set_path):
+            if name.endswith('.deb'):
+                package, version = name.split('_')[:2]
+                entries.append(OrderedDict([('path', f"debs/{set_name}/{name}"), ('package', package), ('version', urllib.parse.unquote(version)), ('sha256', executor.hash_file(set_path / name))]))
+
+        manifest['sets'][set_name] = OrderedDict([('packages', packages), ('files', entries)])
+        print_info(f"{len(entries)} {set_name} packages have been downloaded.")
+
+    if executor.run("which docker", stdout = subprocess.DEVNULL, probe=True).returncode == 0:
+        executor.run(f"sudo docker pull {wireguard_image}", check=True, stdout = subprocess.DEVNULL)
+        images = [wireguard_image]
+
+        if build_wireguard_nft_image(executor):
+            images.append(wireguard_nft_image)
+        else:
+            print_warn(f"{wireguard_nft_image} cannot be built, so servers with '--forward-backend nft' will build it.")
+
+        for image in images:
+            executor.run(f"sudo mkdir -p {str((cache_path / package_cache_images[image]).parent)}", check=True)
+            executor.run(f"sudo docker save -o {str(cache_path / package_cache_images[image])} {image}", check=True)
+            manifest['images'][image] = OrderedDict([('path', package_cache_images[image]), ('sha256', executor.hash_file(cache_path / package_cache_images[image]))])
+            print_info(f"{image} has been saved.")
+    else:
+        print_warn(f"Docker was not found, so I cannot save {wireguard_image}. Servers with the docker backend will pull it.")
+
+    executor.write_text(cache_path / package_cache_installer_name, render_package_cache_installer(), 0o755)
+    executor.write_text(cache_path / package_cache_manifest_name, json.dumps(manifest, indent=2, sort_keys=False))
+
+def bundle_package_cache(executor, bundle):
+    bundle_path = pathlib.Path(bundle).absolute()
+
+    if re.search(r"\.(tar|tar\.gz|tgz)$", bundle_path.name) is None:
+        create_package_cache(executor, bundle_path)
+    else:
+        cache_path = executor.make_temp_dir('wg-wizard-cache-')
+        create_package_cache(executor, cache_path)
+        executor.run(f"tar -caf {str(bundle_path)} -C {str(cache_path)} .", check=True)
+        executor.run(f"sudo rm -rf {str(cache_path)}", check=True)
+
+    print_info(f"{str(bundle_path)} has been created. Pass it to wg-wizard.py and the auto setup scripts with --cache, or put the cache directory next to them as {package_cache_path.name}.")
+
+def render_native_server_config(executor, dict_obj, assignment, shard, postup, postdown):
+    shard_path = get_shard_path(shard)
+    server_config = [native_server_config_template.format(subnet=get_shard_subnet(shard), listen_port=get_shard_listen_port(shard), private_key=executor.read_text(shard_path / 'server/privatekey-server').strip(), postup=postup, postdown=postdown)]
+
+    for peer in dict_obj.keys():
+        peer_path = shard_path / f"peer_{peer}"
+        server_config.append(native_server_peer_template.format(peer=peer, public_key=executor.read_text(peer_path / f"publickey-peer_{peer}").strip(), preshared_key=executor.read_text(peer_path / f"presharedkey-peer_{peer}").strip(), address=assignment[peer][1]))
+
+    return '\n'.join(server_config)
+
+def render_wg0_config(wg0_config_text, postup, postdown):
+    wg0_config = []
+
+    for line in wg0_config_text.split('\n'):
+        line = line.strip()
+
+        if re.match("^PostUp *=", line, re.I):
+            wg0_config.append(postup)
+        elif re.match("^PostDown *=", line, re.I):
+            wg0_config.append(postdown)
         else:
             wg0_config.append(line)
 
-with wg0_config_path.open('w', encoding='utf-8') as f:
-    f.write('\n'.join(wg0_config))
+    return '\n'.join(wg0_config)
+
+def render_wg0_config_peers(executor, wg0_config_text, dict_obj, assignment, shard):
+    # The container only writes the [Peer] sections of the peers it was created with, so peers added to a running container
+    # get theirs from here. Sections are told apart by the '# peer_<name>' comment the container and this script put into them.
+    sections = [e.strip('\n') for e in re.split(r"\n(?=\[Peer\])", wg0_config_text)]
+    peers = OrderedDict()
+    wg0_config = [sections[0]]
+
+    for section in sections[1:]:
+        peer = re.search(r"^# *peer_(\S+)$", section, re.M)
+        if peer is None:
+            wg0_config.append(section)
+        elif peer.group(1) in dict_obj:
+            peers[peer.group(1)] = section
+
+    shard_path = get_shard_path(shard)
+
+    for peer in dict_obj.keys():
+        peer_path = shard_path / f"peer_{peer}"
+        wg0_config.append(peers[peer] if peer in peers else native_server_peer_template.format(peer=peer, public_key=executor.read_text(peer_path / f"publickey-peer_{peer}").strip(), preshared_key=executor.read_text(peer_path / f"presharedkey-peer_{peer}").strip(), address=assignment[peer][1]).rstrip('\n'))
+
+    return '\n\n'.join(wg0_config) + '\n'
+
+def get_tunnel_mtu(path_mtu):
+    # The tunnel MTU is never raised above what the path carries, as that would fragment every full-sized packet.
+    return path_mtu - wg_overhead
+
+def discover_path_mtu(probe, low=576, high=1500):
+    # Binary search for the largest packet that reaches the server unfragmented. probe(size) returns whether a packet of size bytes got through.
+    if not probe(low):
+        return None
+    if probe(high):
+        return high
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if probe(middle):
+            low = middle
+        else:
+            high = middle
 
-subprocess.run("sudo docker restart wireguard".split(), check=True, stdout = subprocess.DEVNULL)
+    return low
 
-# Generate auto setup scripts
-print_info("I will create auto setup scripts. If you run the generated python script with administrator privileges, it will connect to the wireguard server.")
+def choose_mtu(candidates, measure, tolerance=0.95):
+    # Measurements are noisy, so the largest MTU within tolerance of the fastest one wins.
+    results = [(mtu, measure(mtu)) for mtu in candidates]
+    measured = [e for e in results if e[1] is not None]
 
-for peer, forward_rules in program_config_dict.items():
-    auto_setup_script = []
+    if len(measured) == 0:
+        return None, results
+
+    best = max([e[1] for e in measured])
+    return max([mtu for mtu, throughput in measured if throughput >= best * tolerance]), results
+
+# Constants and functions the auto setup scripts share with this script. Their source is copied into every script.
+auto_setup_script_constants = ['wg_overhead', 'min_mtu', 'client_packages', 'package_cache_installer_name']
+auto_setup_script_functions = [get_tunnel_mtu, discover_path_mtu, choose_mtu]
+
+def render_shared_code(constants, functions):
+    shared = []
+
+    for name in constants:
+        value = globals()[name]
+        shared.append(f"{name} = pathlib.Path({repr(str(value))})" if isinstance(value, pathlib.PurePath) else f"{name} = {repr(value)}")
+
+    for function in functions:
+        shared.append('')
+        shared.append(inspect.getsource(function).rstrip('\n'))
+
+    return '\n'.join(shared)
 
-    auto_setup_script.append('''
+auto_setup_script_shared = render_shared_code(auto_setup_script_constants, auto_setup_script_functions)
+
+auto_setup_script_head = '''
+import argparse
+import asyncio
 import concurrent.futures
 import configparser
+import errno
 import pathlib
 import random
 import re
+import resource
+import shutil
 import socket
 import subprocess
+import sys
+import tempfile
+import time
 import urllib.error
 import urllib.request
 
 wg0_config = configparser.ConfigParser()
-'''.strip())
-
-    with pathlib.Path(wireguard_config_path / f"peer_{peer}/peer_{peer}.conf").open('r', encoding='utf-8') as f:
-        auto_setup_script.append(f"wg0_config.read_string({repr(f.read())})")
+'''.strip()
 
-    auto_setup_script.append(f"forward_rules = {json.dumps(forward_rules, indent=2, sort_keys=False)}")
-
-    auto_setup_script.append('''
+auto_setup_script_body = '''
 wg0_postup_template = "ip rule add sport {port} table main"
 wg0_postdown_template = "ip rule del sport {port} table main"
 wg0_config_path = pathlib.Path("/etc/wireguard/wg0.conf")
 ip_test_api = "https://checkip.amazonaws.com"
-tcp_port_test_api = "https://check-host.net/check-tcp?host={address}&max_nodes=3"
-udp_port_test_api = "https://check-host.net/check-udp?host={address}&max_nodes=3"
+port_test_api = "https://check-host.net/check-{protocol}?host={address}&max_nodes=3"
 wg0_service_path = pathlib.Path("/etc/systemd/system/wg0.service")
+throughput_test_url = "https://speed.cloudflare.com/__down?bytes=25000000"
+monitor_script_path = pathlib.Path("/usr/local/sbin/wg0-monitor.py")
+monitor_service_path = pathlib.Path("/etc/systemd/system/wg0-monitor.service")
+metrics_path = pathlib.Path("/var/lib/prometheus/node-exporter/wg0.prom")
+package_cache_path = pathlib.Path(__file__).absolute().with_name("wg-wizard-cache")
 
 def print_info(msg):
     print(f"\\033[34m{msg}\\033[0m")
@@ -308,69 +1057,326 @@ def print_warn(msg):
 def print_error(msg):
     print(f"\\033[31m{msg}\\033[0m")
 
-def test_tcp_port(ip, port):
-    def sock_accept(sock):
-        con, addr = sock.accept()
-        con.close()
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('0.0.0.0', int(port)))
-        sock.listen()
-        
-        future = executor.submit(sock_accept, sock)
-
-        req = urllib.request.Request(tcp_port_test_api.format(address=f"{ip}:{port}"))
-        req.add_header('Accept', 'application/json')
-        req.add_header('User-Agent', 'curl/7.81.0')
+def positive_int(value):
+    number = int(value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not at least 1.")
+
+    return number
+
+def sample_ports(port_range, ports_per_range):
+    start_port, _, end_port = port_range.partition('-')
+    start_port = int(start_port)
+    end_port = int(end_port or start_port)
+
+    if ports_per_range <= 0 or end_port - start_port + 1 <= ports_per_range:
+        return list(range(start_port, end_port + 1))
+
+    ports = set([start_port, end_port]) if ports_per_range >= 2 else set()
+
+    while len(ports) < ports_per_range:
+        ports.add(random.randint(start_port, end_port))
+
+    return sorted(ports)
+
+def request_port_test(api, protocol, ip, port):
+    req = urllib.request.Request(api.format(protocol=protocol, address=f"{ip}:{port}"))
+    req.add_header('Accept', 'application/json')
+    req.add_header('User-Agent', 'curl/7.81.0')
+
+    try:
+        response = urllib.request.urlopen(req, timeout=10)
+        response.close()
+        return True
+    except (urllib.error.URLError, urllib.error.HTTPError, OSError):
+        return False
+
+async def open_port_listener(loop, protocol, port, received):
+    def mark_received():
+        if not received.done():
+            received.set_result(True)
+
+    if protocol == 'tcp':
+        def on_connection(reader, writer):
+            mark_received()
+            writer.close()
+
+        return await asyncio.start_server(on_connection, '0.0.0.0', port, reuse_address=True)
+    elif protocol == 'udp':
+        class DatagramReceiver(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                mark_received()
+
+        transport, _ = await loop.create_datagram_endpoint(DatagramReceiver, local_addr=('0.0.0.0', port))
+        return transport
+    else:
+        raise NotImplementedError(f"Processing for {protocol} protocol is not implemented.")
+
+async def test_port(loop, executor, listener_semaphore, semaphore, api, probe_timeout, protocol, ip, port):
+    async with listener_semaphore:
+        received = loop.create_future()
 
         try:
-            response = urllib.request.urlopen(req, timeout=10)
-            response.close()
-        except (urllib.error.URLError, urllib.error.HTTPError):
-            print_error("API used in tcp port test appears to be unavailable.")
-            sock.close()
-            return False
+            listener = await open_port_listener(loop, protocol, port, received)
+        except OSError as e:
+            return 'too many open files' if e.errno == errno.EMFILE else 'port in use'
 
         try:
-            future.result(timeout=15)
-            return True
-        except concurrent.futures.TimeoutError:
-            return False
+            async with semaphore:
+                if not await loop.run_in_executor(executor, request_port_test, api, protocol, ip, port):
+                    return 'api unavailable'
+            try:
+                await asyncio.wait_for(received, probe_timeout)
+                return 'passed'
+            except asyncio.TimeoutError:
+                return 'failed'
         finally:
-            sock.close()
-
-def test_udp_port(ip, port):
-    def sock_recvfrom(sock):
-        data, addr = sock.recvfrom(1024)
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('0.0.0.0', int(port)))
-        
-        future = executor.submit(sock_recvfrom, sock)
-
-        req = urllib.request.Request(udp_port_test_api.format(address=f"{ip}:{port}"))
-        req.add_header('Accept', 'application/json')
-        req.add_header('User-Agent', 'curl/7.81.0')
+            listener.close()
+
+def get_listener_limit(concurrency):
+    # Every listener and every request to the port test service holds a file descriptor, and a few more are already open.
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft_limit == resource.RLIM_INFINITY:
+        return 65536
+
+    return max(1, soft_limit - concurrency - 64)
+
+def test_ports(api, ip, targets, concurrency, probe_timeout):
+    # Every port gets its own listener and the outside checker is asked to reach all of them at once,
+    # so testing many ports takes about as long as testing one. Only as many listeners are open as file descriptors allow.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            listener_semaphore = asyncio.Semaphore(get_listener_limit(concurrency))
+            semaphore = asyncio.Semaphore(concurrency)
+            tasks = [test_port(loop, executor, listener_semaphore, semaphore, api, probe_timeout, protocol, ip, port) for protocol, port in targets]
+            return loop.run_until_complete(asyncio.gather(*tasks))
+    finally:
+        loop.close()
+
+def ping_probe(host, packet_size):
+    # The don't fragment bit makes routers drop the packet instead of fragmenting it. 28 bytes are IPv4 and ICMP headers.
+    return subprocess.run(f"ping -M do -c 2 -i 0.2 -W 1 -s {packet_size - 28} {host}".split(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def measure_throughput(url, mtu, duration):
+    subprocess.run(f"sudo ip link set dev wg0 mtu {mtu}".split(), check=True)
+    start_time = time.time()
+    received = 0
+
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            while time.time() - start_time < duration:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                received += len(chunk)
+    except (urllib.error.URLError, urllib.error.HTTPError, OSError):
+        return None
+
+    return received / max(time.time() - start_time, 1e-6)
+
+def read_wg_dump():
+    # The first line describes the interface and the second one the wireguard server, the only peer.
+    output = subprocess.run("wg show wg0 dump".split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode()
+    lines = output.strip().split('\\n')
+
+    if len(lines) < 2 or len(lines[1].split('\\t')) < 7:
+        return None
+
+    fields = lines[1].split('\\t')
+
+    try:
+        return {'latest_handshake': int(fields[4]), 'receive_bytes': int(fields[5]), 'transmit_bytes': int(fields[6])}
+    except ValueError:
+        return None
+
+def measure_rtt(address):
+    output = subprocess.run(f"ping -c 1 -W 1 {address}".split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode()
+    rtt = re.search(r"time=([0-9.]+) ms", output)
+    return float(rtt.group(1)) / 1000 if rtt is not None else None
+
+def render_metrics(sample, reconnects, port_results):
+    metrics = []
+
+    def add_metric(name, metric_type, description, values):
+        metrics.append(f"# HELP {name} {description}")
+        metrics.append(f"# TYPE {name} {metric_type}")
+        for labels, value in values:
+            label_text = ','.join([k + '="' + str(v) + '"' for k, v in labels])
+            metrics.append(f"{name}{{{label_text}}} {'NaN' if value is None else value}")
+
+    interface = [('interface', 'wg0')]
+    add_metric('wg_wizard_up', 'gauge', "Whether wg0 exists and has the wireguard server as its peer.", [(interface, 0 if sample is None else 1)])
+
+    if sample is not None:
+        add_metric('wg_wizard_latest_handshake_seconds', 'gauge', "Unix time of the last handshake with the wireguard server.", [(interface, sample['latest_handshake'])])
+        add_metric('wg_wizard_handshake_age_seconds', 'gauge', "Seconds since the last handshake with the wireguard server.", [(interface, sample['handshake_age'])])
+        add_metric('wg_wizard_receive_bytes_total', 'counter', "Bytes received from the wireguard server.", [(interface, sample['receive_bytes'])])
+        add_metric('wg_wizard_transmit_bytes_total', 'counter', "Bytes sent to the wireguard server.", [(interface, sample['transmit_bytes'])])
+        add_metric('wg_wizard_rtt_seconds', 'gauge', "Round trip time to the tunnel address of the wireguard server, NaN when the ping was lost.", [(interface, sample['rtt'])])
+
+    add_metric('wg_wizard_reconnects_total', 'counter', "Number of times wg0 was restarted because of a stale handshake.", [(interface, reconnects)])
+
+    if len(port_results) > 0:
+        add_metric('wg_wizard_port_reachable', 'gauge', "Whether the port test service could reach the forwarded port.", [(interface + [('protocol', protocol), ('port', port)], 1 if result == 'passed' else 0) for (protocol, port), result in port_results])
+
+    return '\\n'.join(metrics) + '\\n'
+
+def write_metrics(path, text):
+    # node_exporter may read the file at any time, so it is replaced in one step.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.write_text(text, encoding='utf-8')
+    temp_path.replace(path)
+
+def quote_systemd_argument(value):
+    # systemd expands % specifiers and $ variables even inside quotes.
+    return '"' + value.replace('\\\\', '\\\\\\\\').replace('"', '\\\\"').replace('%', '%%').replace('$', '$$') + '"'
+
+def render_monitor_service(args):
+    # Every option the monitor uses is passed on, so the service tests ports with the same checker and timeouts as this setup.
+    options = [('--monitor-interval', f"{args.monitor_interval:g}"), ('--stale-after', f"{args.stale_after:g}"), ('--port-check-interval', f"{args.port_check_interval:g}"), ('--port-test-api', args.port_test_api), ('--concurrency', str(args.concurrency)), ('--probe-timeout', f"{args.probe_timeout:g}"), ('--metrics-path', args.metrics_path)]
+    exec_start = ' '.join([f"/usr/bin/python3 {monitor_script_path} --monitor"] + [f"{name} {quote_systemd_argument(value)}" for name, value in options])
+
+    return f"""
+[Unit]
+Description=wg0 monitor
+After=wg0.service
 
-        try:
-            response = urllib.request.urlopen(req, timeout=10)
-            response.close()
-        except (urllib.error.URLError, urllib.error.HTTPError):
-            print_error("API used in udp port test appears to be unavailable.")
-            sock.close()
-            return False
+[Service]
+ExecStart={exec_start}
+Restart=always
 
-        try:
-            future.result(timeout=15)
-            return True
-        except concurrent.futures.TimeoutError:
+[Install]
+WantedBy=multi-user.target
+""".strip()
+
+def monitor(args):
+    wg_server_ip = wg0_config['Peer']['Endpoint'].rpartition(':')[0]
+    wg_server_tunnel_ip = wg0_config['Interface']['Address'].partition('/')[0].rpartition('.')[0] + '.1'
+    # The first port of each range is enough to tell whether forwarding works and keeps the metric labels the same across restarts.
+    targets = [(forward_rule['protocol'], int(forward_rule['port-range'].partition('-')[0])) for forward_rule in forward_rules]
+    reconnects = 0
+    last_reconnect = time.time()
+    port_results = []
+    port_check_future = None
+    next_port_check = time.time()
+
+    print_info(f"I will write metrics to {args.metrics_path} every {args.monitor_interval:g} seconds.")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as port_check_executor:
+        while True:
+            start_time = time.time()
+            sample = read_wg_dump()
+
+            if sample is not None:
+                sample['handshake_age'] = start_time - sample['latest_handshake'] if sample['latest_handshake'] > 0 else None
+                # The ping also keeps traffic flowing, so an idle but healthy tunnel still renews its handshake.
+                sample['rtt'] = measure_rtt(wg_server_tunnel_ip)
+
+            stale = sample is None or sample['handshake_age'] is None or sample['handshake_age'] > args.stale_after
+
+            if stale and start_time - last_reconnect > args.stale_after:
+                print_warn("The handshake with the wireguard server is stale. I will restart wg0.")
+                subprocess.run("systemctl restart wg0.service".split(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                reconnects += 1
+                last_reconnect = start_time
+
+            # The port test takes as long as the probe timeout, so it runs next to the sampling instead of delaying it.
+            if port_check_future is not None and port_check_future.done():
+                port_results = [(target, result) for target, result in zip(targets, port_check_future.result()) if result != 'port in use']
+                port_check_future = None
+
+            if args.port_check_interval > 0 and len(targets) > 0 and port_check_future is None and start_time >= next_port_check:
+                port_check_future = port_check_executor.submit(test_ports, args.port_test_api, wg_server_ip, targets, args.concurrency, args.probe_timeout)
+                next_port_check = start_time + args.port_check_interval
+
+            write_metrics(pathlib.Path(args.metrics_path), render_metrics(sample, reconnects, port_results))
+            time.sleep(max(args.monitor_interval - (time.time() - start_time), 0))
+
+def read_latest_handshakes():
+    output = subprocess.run("sudo wg show wg0 latest-handshakes".split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode()
+    return [int(e.split()[1]) for e in output.split('\\n') if len(e.split()) == 2]
+
+def wait_for_handshake(address, timeout, interval=0.1):
+    # wg-quick up does not contact the server until something is sent through the tunnel,
+    # so a datagram is sent to the server every second to start the handshake right away.
+    start_time = time.time()
+    next_nudge = start_time
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        while time.time() - start_time < timeout:
+            if any(e > 0 for e in read_latest_handshakes()):
+                return True
+            if time.time() >= next_nudge:
+                try:
+                    sock.sendto(b'', (address, 9))
+                except OSError:
+                    pass
+                next_nudge += 1
+            time.sleep(interval)
+
+    return False
+
+def test_external_ip(api, server_ip):
+    try:
+        with urllib.request.urlopen(api, timeout=10) as response:
+            response_html = response.read().decode(response.headers.get_content_charset())
+    except (urllib.error.URLError, urllib.error.HTTPError, TypeError, OSError):
+        return 'api unavailable'
+
+    return 'passed' if server_ip in response_html else 'failed'
+
+def install_from_package_cache(cache, max_age_days):
+    # The cache carries the installer of the wg-wizard.py that made it, which checks the cache the same way as on the server.
+    # A tarball is unpacked into a temporary directory that is removed afterwards.
+    cache_path = pathlib.Path(cache).absolute()
+    unpacked_path = None
+
+    if re.search(r"\\.(tar|tar\\.gz|tgz)$", cache_path.name) and cache_path.is_file():
+        unpacked_path = pathlib.Path(tempfile.mkdtemp(prefix='wg-wizard-cache-'))
+        subprocess.run(["tar", "-xf", str(cache_path), "-C", str(unpacked_path)], check=True)
+        cache_path = unpacked_path
+
+    try:
+        if not (cache_path / package_cache_installer_name).is_file():
+            print_warn(f"{cache_path} has no {package_cache_installer_name}, so I will download the packages instead.")
             return False
-        finally:
-            sock.close()
+
+        return subprocess.run([sys.executable, str(cache_path / package_cache_installer_name), "client", "--max-age", str(max_age_days)]).returncode == 0
+    finally:
+        if unpacked_path is not None:
+            shutil.rmtree(str(unpacked_path), ignore_errors=True)
+
+# Parse arguments
+parser = argparse.ArgumentParser(description="Connect this computer to the wireguard server and test port forwarding.")
+parser.add_argument('--port-test-api', default=port_test_api, help="URL of the service asked to connect to each forwarded port. {protocol} and {address} are replaced with the protocol and ip:port (default: %(default)s)")
+parser.add_argument('--ports-per-range', type=int, default=3, help="number of ports tested in each port range, 0 tests every port (default: %(default)s)")
+parser.add_argument('--concurrency', type=positive_int, default=16, help="maximum number of requests to the port test service at the same time (default: %(default)s)")
+parser.add_argument('--probe-timeout', type=float, default=15, help="seconds to wait for the service to reach a port (default: %(default)s)")
+parser.add_argument('--handshake-timeout', type=float, default=30, help="seconds to wait for the first handshake with the wireguard server (default: %(default)s)")
+parser.add_argument('--mtu', type=int, help="MTU of the wireguard interface. Path MTU discovery is skipped when it is given")
+parser.add_argument('--skip-mtu-discovery', action='store_true', help="leave the MTU to wg-quick instead of probing the path to the server")
+parser.add_argument('--throughput-test', action='store_true', help="download through the tunnel at a few MTUs below the discovered one and keep the fastest")
+parser.add_argument('--throughput-test-url', default=throughput_test_url, help="URL downloaded by the throughput test (default: %(default)s)")
+parser.add_argument('--throughput-test-duration', type=float, default=5, help="seconds spent downloading at each MTU (default: %(default)s)")
+parser.add_argument('--install-monitor', action='store_true', help="install a systemd service that keeps monitoring the connection after the setup")
+parser.add_argument('--monitor', action='store_true', help="only monitor the connection, writing Prometheus textfile metrics and restarting wg0 when the handshake is stale")
+parser.add_argument('--monitor-interval', type=float, default=10, help="seconds between two samples of the monitor (default: %(default)s)")
+parser.add_argument('--stale-after', type=float, default=300, help="seconds without a handshake after which the monitor restarts wg0 (default: %(default)s)")
+parser.add_argument('--port-check-interval', type=float, default=900, help="seconds between two port tests of the monitor, 0 disables them. Ports a local service listens on are not tested (default: %(default)s)")
+parser.add_argument('--metrics-path', default=str(metrics_path), help="Prometheus textfile the monitor writes to (default: %(default)s)")
+parser.add_argument('--cache', default=str(package_cache_path), help="package cache directory or tarball made by wg-wizard.py --bundle to install wireguard from without downloading anything (default: %(default)s, if it exists)")
+parser.add_argument('--cache-max-age', type=float, default=30, help="days after which the package cache is considered stale, 0 never expires (default: %(default)s)")
+args = parser.parse_args()
+
+# Monitor the connection
+if args.monitor:
+    monitor(args)
 
 # Install wireguard
 if subprocess.run("which wg-quick".split(), stdout = subprocess.DEVNULL).returncode == 0:
@@ -378,13 +1384,39 @@ if subprocess.run("which wg-quick".split(), stdout = subprocess.DEVNULL).returnc
 else:
     print_info("wg-quick was not found. I'm going to install wireguard.")
 
-    subprocess.run("""
+    if (args.cache == str(package_cache_path) and not package_cache_path.is_dir()) or not install_from_package_cache(args.cache, args.cache_max_age):
+        subprocess.run(f"""
 DEBIAN_FRONTEND=noninteractive
 
 sudo apt update
-sudo apt install -y wireguard resolvconf
+sudo apt install -y {' '.join(client_packages)}
 """.strip(), check=True, shell=True)
 
+# Discover path MTU
+wg_server_ip, _, wg_server_port = wg0_config['Peer']['Endpoint'].rpartition(':')
+
+if args.mtu is not None:
+    print_info(f"I will use the given MTU. {args.mtu}")
+    wg0_config['Interface']['MTU'] = str(args.mtu)
+elif args.skip_mtu_discovery:
+    print_info("I will skip path MTU discovery and leave the MTU to wg-quick.")
+elif subprocess.run("which ping".split(), stdout = subprocess.DEVNULL).returncode != 0:
+    print_warn("ping was not found, so I cannot discover the path MTU. I will leave the MTU to wg-quick.")
+else:
+    # Probes must not go through a tunnel that is still up from an earlier run.
+    subprocess.run("sudo wg-quick down wg0".split(), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    path_mtu = discover_path_mtu(lambda size: ping_probe(wg_server_ip, size))
+
+    if path_mtu is None:
+        print_warn(f"{wg_server_ip} does not answer ping, so I cannot discover the path MTU. I will leave the MTU to wg-quick.")
+    else:
+        wg0_config['Interface']['MTU'] = str(get_tunnel_mtu(path_mtu))
+        print_info(f"The path MTU to the wireguard server is {path_mtu}. I will set the MTU of the wireguard interface to {wg0_config['Interface']['MTU']}.")
+
+        if get_tunnel_mtu(path_mtu) < min_mtu:
+            print_warn(f"The MTU is below {min_mtu}, the smallest one IPv6 allows. IPv6 will not work through the tunnel.")
+
 # Write peer profile
 print_info(f"I will write the peer profile included in this script to the following path. {wg0_config_path}")
 
@@ -407,51 +1439,93 @@ with wg0_config_path.open('w', encoding='utf-8') as f:
 print_info("Now, I will connect this computer to the wireguard server.")
 
 subprocess.run("sudo wg-quick down wg0".split(), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+start_time = time.time()
 subprocess.run("sudo wg-quick up wg0".split(), check=True, stdout = subprocess.DEVNULL)
 
-# Test external IP
-try:
-    with urllib.request.urlopen(ip_test_api, timeout=10) as response:
-        response_html = response.read().decode(response.headers.get_content_charset())
-except (urllib.error.URLError, urllib.error.HTTPError, TypeError):
-    print_error("API used in IP test appears to be unavailable.")
+wg_server_tunnel_ip = wg0_config['Interface']['Address'].partition('/')[0].rpartition('.')[0] + '.1'
+
+if wait_for_handshake(wg_server_tunnel_ip, args.handshake_timeout):
+    print_info(f"The handshake with the wireguard server was completed {time.time() - start_time:.1f} seconds after bringing up wg0.")
+else:
+    print_error(f"There was no handshake with the wireguard server within {args.handshake_timeout:g} seconds. Check that UDP port {wg_server_port} of {wg_server_ip} is reachable from this computer.")
     exit(1)
 
-wg_server_ip = wg0_config['Peer']['Endpoint'].rpartition(':')[0]
+# Test throughput
+if args.throughput_test:
+    current_mtu = int(pathlib.Path("/sys/class/net/wg0/mtu").read_text())
+    candidates = sorted(set([e for e in [current_mtu, current_mtu - 20, current_mtu - 40, current_mtu - 80] if e >= min(min_mtu, current_mtu)]), reverse=True)
+
+    print_info(f"I will measure the throughput through the tunnel at the following MTUs. {candidates}")
+
+    chosen_mtu, throughput_results = choose_mtu(candidates, lambda mtu: measure_throughput(args.throughput_test_url, mtu, args.throughput_test_duration))
+
+    print(f"{'mtu':<8}throughput")
+
+    for mtu, throughput in throughput_results:
+        print_info(f"{mtu:<8}{'unavailable' if throughput is None else f'{throughput * 8 / 1000000:.1f} Mbit/s'}")
+
+    if chosen_mtu is None:
+        print_warn(f"The throughput test failed. I will keep the MTU at {current_mtu}.")
+        chosen_mtu = current_mtu
+    else:
+        print_info(f"I will use MTU {chosen_mtu}.")
+
+    wg0_config['Interface']['MTU'] = str(chosen_mtu)
+
+    with wg0_config_path.open('w', encoding='utf-8') as f:
+        wg0_config.write(f)
+
+    subprocess.run(f"sudo ip link set dev wg0 mtu {chosen_mtu}".split(), check=True)
+
+# Test external IP and port forwarding
+# Both tests only need a working tunnel, so the IP test runs in the background while the ports are tested.
+targets = [(forward_rule['protocol'], port) for forward_rule in forward_rules for port in sample_ports(forward_rule['port-range'], args.ports_per_range)]
+
+if len(targets) == 0:
+    print_info("There are no forwarding rules defined for this peer, so I will skip the port forwarding test.")
+else:
+    print_info(f"I will test the external IP and {len(targets)} ports at the same time.")
+
+test_start_time = time.time()
 
-if wg_server_ip in response_html:
+with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ip_test_executor:
+    ip_test_future = ip_test_executor.submit(test_external_ip, ip_test_api, wg_server_ip)
+    port_test_results = test_ports(args.port_test_api, wg_server_ip, targets, args.concurrency, args.probe_timeout) if len(targets) > 0 else []
+    ip_test_result = ip_test_future.result()
+
+test_failed = False
+
+if ip_test_result == 'passed':
     print_info("Test passed. Your external IP is the wireguard server's IP.")
+elif ip_test_result == 'api unavailable':
+    print_error("API used in IP test appears to be unavailable.")
+    test_failed = True
 else:
     print_error("Test failed. Your external IP is different from the wireguard server's IP.")
-    print_error("There seems to be a problem with automatic setup. If you find a bug, please report it.")
-    exit(1)
+    test_failed = True
 
-# Test port forwarding
-if len(forward_rules) == 0:
-    print_info("There are no forwarding rules defined for this peer, so I will skip the port forwarding test.")
-else:
-    print_info("Testing all ports is time-consuming and inefficient, so I will choose one representative port to test.")
+if len(targets) > 0:
+    print(f"{'protocol':<10}{'port':<8}result")
 
-    selected_forward_rule = random.choice(forward_rules)
+    for (protocol, port), result in zip(targets, port_test_results):
+        if result == 'passed':
+            print_info(f"{protocol:<10}{port:<8}{result}")
+        else:
+            print_error(f"{protocol:<10}{port:<8}{result}")
 
-    if '-' in selected_forward_rule['port-range']:
-        selected_port = random.randint(*map(int, selected_forward_rule['port-range'].split('-')))
-    else:
-        selected_port = selected_forward_rule['port-range']
+    failed = len([e for e in port_test_results if e != 'passed'])
 
-    if selected_forward_rule['protocol'] == 'tcp':
-        port_test_result = test_tcp_port(wg_server_ip, selected_port)
-    elif selected_forward_rule['protocol'] == 'udp':
-        port_test_result = test_udp_port(wg_server_ip, selected_port)
+    if failed == 0:
+        print_info(f"Test passed. All {len(targets)} tested ports are accessible from outside. ({time.time() - test_start_time:.1f} seconds)")
     else:
-        raise NotImplementedError(f"Processing for {selected_forward_rule['protocol']} protocol is not implemented.")
-    
-    if port_test_result:
-        print_info(f"Test passed. {selected_forward_rule['protocol']} port {selected_port} is accessible from outside.")
-    else:
-        print_error(f"Test failed. {selected_forward_rule['protocol']} port {selected_port} is NOT accessible from outside.")
-        print_error("There seems to be a problem with automatic setup. If you find a bug, please report it.")
-        exit(1)
+        print_error(f"Test failed. {failed} of {len(targets)} tested ports are NOT accessible from outside. ({time.time() - test_start_time:.1f} seconds)")
+        test_failed = True
+
+if test_failed:
+    print_error("There seems to be a problem with automatic setup. If you find a bug, please report it.")
+    exit(1)
+
+print_info(f"This computer is connected through the wireguard server. ({time.time() - start_time:.1f} seconds from bringing up wg0)")
 
 # Register wireguard as a systemd service
 print_info("I will add wireguard as a systemd service in order to connect to the wireguard server when the system restarts.")
@@ -474,11 +1548,1261 @@ WantedBy=multi-user.target
 
 subprocess.run("sudo systemctl enable wg0.service".split(), check=True, stdout = subprocess.DEVNULL)
 
+# Register the monitor as a systemd service
+if args.install_monitor:
+    print_info(f"I will install the monitor as a systemd service. It writes metrics to {args.metrics_path} and restarts wg0 when the handshake is stale.")
+
+    monitor_script_path.write_text(pathlib.Path(__file__).read_text(encoding='utf-8'), encoding='utf-8')
+
+    with monitor_service_path.open('w', encoding='utf-8') as f:
+        f.write(render_monitor_service(args))
+
+    subprocess.run("sudo systemctl daemon-reload".split(), check=True, stdout = subprocess.DEVNULL)
+    subprocess.run("sudo systemctl enable --now wg0-monitor.service".split(), check=True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
 print_info("This is the end of the automatic setup script.")
-'''.strip())
+'''.strip()
+
+def render_auto_setup_script(peer, forward_rules, peer_config):
+    auto_setup_script = []
+
+    auto_setup_script.append(auto_setup_script_head)
+    auto_setup_script.append(auto_setup_script_shared)
+    auto_setup_script.append(f"wg0_config.read_string({repr(peer_config)})")
+
+    auto_setup_script.append(f"forward_rules = {json.dumps(forward_rules, indent=2, sort_keys=False)}")
+
+    auto_setup_script.append(auto_setup_script_body)
+
+    return '\n'.join(auto_setup_script)
+
+def write_auto_setup_scripts(executor, dict_obj, peer_configs):
+    print_info("I will create auto setup scripts. If you run the generated python script with administrator privileges, it will connect to the wireguard server.")
+
+    for peer, forward_rules in dict_obj.items():
+        auto_setup_script_path = program_path.with_name(f"auto-setup-{peer}.py")
+        auto_setup_script = render_auto_setup_script(peer, forward_rules, peer_configs[peer])
+
+        if executor.is_file(auto_setup_script_path) and executor.read_text(auto_setup_script_path) == auto_setup_script:
+            continue
+
+        executor.write_text(auto_setup_script_path, auto_setup_script)
+        print_info(f"{str(auto_setup_script_path)} file has been created.")
+
+def is_fresh_file(path, newer_than):
+    # newer_than maps a path to the time its writer was started. A file older than that is left over from an earlier run.
+    return path.stat().st_mtime >= newer_than.get(path, 0)
+
+def poll_for_files(paths, timeout, start_time, ready, newer_than):
+    # A file is considered complete once it is not empty, is fresh and its size stays the same between two polls.
+    last_sizes = {}
+
+    while len(ready) < len(paths) and (time.time() - start_time) < timeout:
+        for path in paths:
+            if path in ready:
+                continue
+            try:
+                size = path.stat().st_size if is_fresh_file(path, newer_than) else 0
+            except FileNotFoundError:
+                continue
+            if size > 0 and last_sizes.get(path) == size:
+                ready[path] = time.time() - start_time
+            last_sizes[path] = size
+        if len(ready) < len(paths):
+            time.sleep(0.2)
+
+def inotify_wait_for_files(paths, timeout, start_time, ready, newer_than):
+    # Fresh files that already exist are taken as they are. A file that appears or is rewritten later is complete once IN_CLOSE_WRITE or IN_MOVED_TO
+    # is seen for it, or, if it showed up before its directory could be watched, once it is fresh and its size has not changed for stable_interval
+    # seconds without any write event.
+    stable_interval = 0.2
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    watches = {}
+    writing = set()
+    closed = set()
+    last_sizes = {}
+    first_pass = True
+
+    try:
+        while True:
+            # Watch the deepest existing directory of every pending file, so that directories created by the container are followed as well.
+            for path in paths:
+                if path in ready:
+                    continue
+                directory = path.parent
+                while not directory.is_dir() and directory != directory.parent:
+                    directory = directory.parent
+                if directory not in watches.values():
+                    wd = libc.inotify_add_watch(fd, str(directory).encode(), inotify_in_modify | inotify_in_close_write | inotify_in_moved_to | inotify_in_create)
+                    if wd < 0:
+                        raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {str(directory)}")
+                    watches[wd] = directory
+
+            unconfirmed = False
+
+            for path in paths:
+                if path in ready or path in writing or not path.is_file():
+                    continue
+                size = path.stat().st_size
+                if size == 0 or (path not in closed and not is_fresh_file(path, newer_than)):
+                    continue
+                if first_pass or path in closed:
+                    ready[path] = time.time() - start_time
+                elif path in last_sizes and last_sizes[path][0] == size and (time.time() - last_sizes[path][1]) >= stable_interval:
+                    ready[path] = time.time() - start_time
+                else:
+                    if path not in last_sizes or last_sizes[path][0] != size:
+                        last_sizes[path] = (size, time.time())
+                    unconfirmed = True
+
+            first_pass = False
+            remaining = timeout - (time.time() - start_time)
+
+            if len(ready) == len(paths) or remaining <= 0:
+                return
+
+            if len(select.select([fd], [], [], min(remaining, stable_interval) if unconfirmed else remaining)[0]) == 0:
+                continue
+
+            buffer = os.read(fd, 65536)
+            offset = 0
+
+            while offset < len(buffer):
+                wd, mask, _, name_length = inotify_event_header.unpack_from(buffer, offset)
+                name = buffer[offset + inotify_event_header.size:offset + inotify_event_header.size + name_length].rstrip(b'\0').decode()
+                offset += inotify_event_header.size + name_length
+
+                if wd not in watches:
+                    continue
+                path = watches[wd] / name
+
+                if mask & (inotify_in_modify | inotify_in_create):
+                    writing.add(path)
+                    closed.discard(path)
+                elif mask & (inotify_in_close_write | inotify_in_moved_to):
+                    writing.discard(path)
+                    closed.add(path)
+    finally:
+        os.close(fd)
+
+def wait_for_files(paths, timeout, newer_than=None):
+    start_time = time.time()
+    ready = OrderedDict()
+
+    try:
+        inotify_wait_for_files(paths, timeout, start_time, ready, newer_than or {})
+    except (AttributeError, OSError, TypeError) as e:
+        print_warn(f"inotify is not available ({e}). I will poll for the files instead.")
+        poll_for_files(paths, timeout, start_time, ready, newer_than or {})
+
+    return ready
+
+def inotify_wait_for_change(path, timeout):
+    # Editors either write the file in place or rename a new one over it, so its directory is watched for both.
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    try:
+        if libc.inotify_add_watch(fd, str(path.parent).encode(), inotify_in_close_write | inotify_in_moved_to) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {str(path.parent)}")
+
+        end_time = time.time() + timeout
+
+        while time.time() < end_time:
+            if len(select.select([fd], [], [], max(0, end_time - time.time()))[0]) == 0:
+                return False
+
+            buffer = os.read(fd, 65536)
+            offset = 0
+
+            while offset < len(buffer):
+                _, _, _, name_length = inotify_event_header.unpack_from(buffer, offset)
+                name = buffer[offset + inotify_event_header.size:offset + inotify_event_header.size + name_length].rstrip(b'\0').decode()
+                offset += inotify_event_header.size + name_length
+
+                if name == path.name:
+                    return True
+
+        return False
+    finally:
+        os.close(fd)
+
+def wait_for_change(path, timeout):
+    try:
+        return inotify_wait_for_change(path, timeout)
+    except (AttributeError, OSError, TypeError):
+        # Without inotify the modification time is polled.
+        mtime = path.stat().st_mtime if path.is_file() else None
+        end_time = time.time() + timeout
+
+        while time.time() < end_time:
+            time.sleep(min(timeout, 0.2))
+            if (path.stat().st_mtime if path.is_file() else None) != mtime:
+                return True
+
+        return False
+
+class Executor:
+    # Every side effect of the script goes through an executor, so that a provisioning run can be timed, recorded or faked.
+    # Subclasses implement execute(), store() and the read-only file accessors.
+    simulated = False
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.events = []
+        self.phases = []
+
+    def record(self, name, category, start_time, **extra):
+        event = OrderedDict([('name', name), ('category', category), ('phase', self.phases[-1] if len(self.phases) > 0 else None), ('start', start_time - self.start_time), ('seconds', time.time() - start_time)])
+        event.update(extra)
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        self.phases.append(name)
+
+        try:
+            yield
+        finally:
+            self.phases.pop()
+            self.record(name, 'phase', start_time)
+
+    def run(self, command, check=False, shell=False, stdout=None, stderr=None, probe=False):
+        # probe marks read-only commands such as 'which' that a dry run may still execute.
+        start_time = time.time()
+        returncode, output = self.execute(command, shell, stdout, stderr, probe)
+        self.record(command, 'command', start_time, returncode=returncode)
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+
+        return subprocess.CompletedProcess(command, returncode, output)
+
+    def fetch_text(self, url, timeout=10):
+        start_time = time.time()
+        text = self.download(url, timeout)
+        self.record(url, 'request', start_time, ok=text is not None)
+        return text
+
+    def make_temp_dir(self, prefix):
+        start_time = time.time()
+        path = self.create_temp_dir(prefix)
+        self.record(str(path), 'file', start_time, size=0)
+        return path
+
+    def write_text(self, path, content, mode=None):
+        start_time = time.time()
+        self.store(path, content, mode)
+        self.record(str(path), 'file', start_time, size=len(content))
+
+    def write_report(self, path):
+        report = OrderedDict()
+        report['seconds'] = time.time() - self.start_time
+        report['phases'] = [e for e in self.events if e['category'] == 'phase']
+        report['commands'] = [e for e in self.events if e['category'] == 'command']
+        report['files'] = [e for e in self.events if e['category'] == 'file']
+        report['requests'] = [e for e in self.events if e['category'] == 'request']
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=False)
+
+    def write_chrome_trace(self, path):
+        trace_events = []
+
+        for e in self.events:
+            trace_events.append(OrderedDict([('name', e['name']), ('cat', e['category']), ('ph', 'X'), ('ts', int(e['start'] * 1000000)), ('dur', int(e['seconds'] * 1000000)), ('pid', 1), ('tid', 1), ('args', OrderedDict([(k, v) for k, v in e.items() if k not in ['name', 'category', 'start', 'seconds']]))]))
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(OrderedDict([('traceEvents', trace_events), ('displayTimeUnit', 'ms')]), f, sort_keys=False)
+
+class RealExecutor(Executor):
+    def execute(self, command, shell, stdout, stderr, probe):
+        result = subprocess.run(command if shell else command.split(), shell=shell, stdout=stdout, stderr=stderr)
+        return result.returncode, result.stdout.decode() if result.stdout is not None else None
+
+    def download(self, url, timeout):
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                return response.read().decode()
+        except (urllib.error.URLError, urllib.error.HTTPError, OSError):
+            return None
+
+    def is_file(self, path):
+        return path.is_file()
+
+    def read_text(self, path):
+        return path.read_text(encoding='utf-8')
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def list_dir(self, path):
+        return sorted([e.name for e in path.iterdir()]) if path.is_dir() else []
+
+    def create_temp_dir(self, prefix):
+        return pathlib.Path(tempfile.mkdtemp(prefix=prefix))
+
+    def store(self, path, content, mode):
+        # Write to a temporary file and rename it, keeping the mode and owner of the file it replaces.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + '.tmp')
+        old_stat = path.stat() if path.exists() else None
+
+        with os.fdopen(os.open(str(temp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode), 'w', encoding='utf-8') as f:
+            f.write(content)
+
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        elif old_stat is not None:
+            os.chmod(temp_path, old_stat.st_mode & 0o7777)
+
+        if old_stat is not None and hasattr(os, 'chown'):
+            os.chown(temp_path, old_stat.st_uid, old_stat.st_gid)
+
+        os.replace(temp_path, path)
+
+    def wait_for_files(self, paths, timeout, newer_than=None):
+        return wait_for_files(paths, timeout, newer_than)
+
+class FakeExecutor(Executor):
+    # Keeps files in memory and answers commands from handlers, so the whole provisioning can run without root, docker or ufw.
+    # handlers is a list of (regex, function) pairs. The first function whose regex matches the command is called with the executor
+    # and the command and returns (returncode, stdout). Commands without a handler succeed with no output.
+    # responses maps URLs to the text they return. Requests to any other URL fail.
+    simulated = True
+
+    def __init__(self, files=None, handlers=None, responses=None):
+        super().__init__()
+        # Files given here count as written before the run. Handlers write files with store() so that their mtime is known.
+        self.files = OrderedDict([(pathlib.Path(k), v) for k, v in (files or {}).items()])
+        self.mtimes = OrderedDict([(e, self.start_time) for e in self.files.keys()])
+        self.handlers = list(handlers or [])
+        self.responses = dict(responses or {})
+        self.commands = []
+        self.requests = []
+        self.temp_dirs = []
+
+    def execute(self, command, shell, stdout, stderr, probe):
+        self.commands.append(command)
+
+        for pattern, handler in self.handlers:
+            if re.search(pattern, command):
+                return handler(self, command)
+
+        return 0, ''
+
+    def download(self, url, timeout):
+        self.requests.append(url)
+        return self.responses.get(url)
 
-    with program_path.with_name(f"auto-setup-{peer}.py").open('w', encoding='utf-8') as f:
-        f.write('\n'.join(auto_setup_script))
-        print_info(f"{f.name} file has been created.")
+    def is_file(self, path):
+        return pathlib.Path(path) in self.files
 
-print_info("This is the end of the script.")
+    def read_text(self, path):
+        if pathlib.Path(path) not in self.files:
+            raise FileNotFoundError(str(path))
+        return self.files[pathlib.Path(path)]
+
+    def hash_file(self, path):
+        content = self.read_text(path)
+        return hashlib.sha256(content if isinstance(content, bytes) else content.encode('utf-8')).hexdigest()
+
+    def list_dir(self, path):
+        path = pathlib.Path(path)
+        return sorted(set([e.relative_to(path).parts[0] for e in self.files.keys() if path in e.parents]))
+
+    def create_temp_dir(self, prefix):
+        # Only a name. Nothing is created on disk, so a dry run leaves no directory behind.
+        self.temp_dirs.append(pathlib.Path(tempfile.gettempdir()) / f"{prefix}{len(self.temp_dirs)}")
+        return self.temp_dirs[-1]
+
+    def store(self, path, content, mode):
+        self.files[pathlib.Path(path)] = content
+        self.mtimes[pathlib.Path(path)] = time.time()
+
+    def get_mtime(self, path):
+        return self.mtimes.get(pathlib.Path(path), 0)
+
+    def wait_for_files(self, paths, timeout, newer_than=None):
+        return OrderedDict([(e, 0.0) for e in paths if self.is_file(e) and self.get_mtime(e) >= (newer_than or {}).get(e, 0)])
+
+class RecordingExecutor(FakeExecutor):
+    # Dry run. Files are read from disk unless this run would have written them, probes are really executed and
+    # every other command is only recorded.
+    def execute(self, command, shell, stdout, stderr, probe):
+        if probe:
+            return RealExecutor.execute(self, command, shell, stdout, stderr, probe)
+
+        return super().execute(command, shell, stdout, stderr, probe)
+
+    def is_file(self, path):
+        return super().is_file(path) or pathlib.Path(path).is_file()
+
+    def read_text(self, path):
+        return super().read_text(path) if super().is_file(path) else pathlib.Path(path).read_text(encoding='utf-8')
+
+    def hash_file(self, path):
+        return super().hash_file(path) if super().is_file(path) else RealExecutor.hash_file(self, path)
+
+    def get_mtime(self, path):
+        return super().get_mtime(path) if super().is_file(path) else pathlib.Path(path).stat().st_mtime
+
+    def list_dir(self, path):
+        return sorted(set(super().list_dir(path) + RealExecutor.list_dir(self, pathlib.Path(path))))
+
+def print_plan_diff(name, old_lines, new_lines):
+    diff = list(difflib.unified_diff(old_lines, new_lines, fromfile=f"{name} (applied)", tofile=f"{name} (planned)", lineterm=''))
+
+    if len(diff) > 0:
+        print_warn(f"{name} will be changed.")
+        print('\n'.join(diff))
+    else:
+        print_info(f"{name} is up to date.")
+
+def is_live_artifact_line(line):
+    return line.startswith('PEERS=') or (' -j DNAT ' in line) or re.match(r"^(tcp|udp) \. [0-9-]+ : [0-9.]+$", line) is not None
+
+def is_live_change(old_artifact, new_artifact):
+    # Peers, DNAT rules and nftables map elements can be changed on a running server. Anything else, such as the uplink, needs a restart.
+    return old_artifact is not None and set([e for e in old_artifact if not is_live_artifact_line(e)]) == set([e for e in new_artifact if not is_live_artifact_line(e)])
+
+def apply_live_changes(executor, interface, table, old_artifact, new_artifact, assignment, key_path, applied=None, prefix="sudo ", server_key_path=None):
+    # Every step looks at the running server before it changes anything, so a reload that failed halfway can be applied again.
+    # applied is called with the artifact of what is running after every step, so the next reload diffs against that.
+    # prefix runs the commands where the server is, and server_key_path is where the server finds the keys if it sees another file system than key_path.
+    current = list(old_artifact)
+    old_lines = set(old_artifact)
+    new_lines = set(new_artifact)
+    old_peers = set([e for line in old_artifact if line.startswith('PEERS=') for e in line[len('PEERS='):].split(',') if e])
+    new_peers = [e for line in new_artifact if line.startswith('PEERS=') for e in line[len('PEERS='):].split(',') if e]
+
+    def step_applied(removed, added):
+        current[:] = [e for e in current if e not in removed] + [e for e in added if e not in current]
+        if applied is not None:
+            applied(list(current))
+
+    # Removing a peer that is not there and setting a peer that is already there both succeed, so peers need no check.
+    # Keys and profiles of removed peers stay on disk, so their public key and address are still known.
+    # wg-quick only routes the allowed IPs of the peers it brings up, so the route of every peer is replaced or deleted along with it.
+    for peer in sorted(old_peers - set(new_peers)):
+        if executor.is_file(key_path(peer) / f"publickey-peer_{peer}"):
+            executor.run(f"{prefix}wg set {interface} peer {executor.read_text(key_path(peer) / f'publickey-peer_{peer}').strip()} remove", check=True, stdout = subprocess.DEVNULL)
+
+        address = re.search(r"^Address *= *([0-9.]+)", executor.read_text(key_path(peer) / f"peer_{peer}.conf"), re.M) if executor.is_file(key_path(peer) / f"peer_{peer}.conf") else None
+
+        if address is not None and address.group(1) not in [assignment[e][1] for e in new_peers]:
+            executor.run(f"{prefix}ip -4 route del {address.group(1)}/32 dev {interface}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    for peer in [e for e in new_peers if e not in old_peers]:
+        executor.run(f"{prefix}wg set {interface} peer {executor.read_text(key_path(peer) / f'publickey-peer_{peer}').strip()} preshared-key {str((server_key_path or key_path)(peer) / f'presharedkey-peer_{peer}')} allowed-ips {assignment[peer][1]}/32", check=True, stdout = subprocess.DEVNULL)
+        executor.run(f"{prefix}ip -4 route replace {assignment[peer][1]}/32 dev {interface}", check=True, stdout = subprocess.DEVNULL)
+
+    step_applied([e for e in old_artifact if e.startswith('PEERS=')], [e for e in new_artifact if e.startswith('PEERS=')])
+
+    # DNAT rules that are gone are deleted before the new ones are appended. Forward rules never overlap, so their order does not matter.
+    # 'iptables -C' tells whether a rule is in place, so a rule is never deleted twice or appended twice.
+    removed_rules = [e for e in old_artifact if ' -j DNAT ' in e and ' -A ' in e and e not in new_lines]
+    added_rules = [e for e in new_artifact if ' -j DNAT ' in e and ' -A ' in e and e not in old_lines]
+
+    for rule in removed_rules:
+        if executor.run(prefix + rule.replace(' -A ', ' -C ', 1), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, probe=True).returncode == 0:
+            executor.run(prefix + rule.replace(' -A ', ' -D ', 1), check=True, stdout = subprocess.DEVNULL)
+        step_applied([rule, rule.replace(' -A ', ' -D ', 1)], [])
+
+    for rule in added_rules:
+        if executor.run(prefix + rule.replace(' -A ', ' -C ', 1), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, probe=True).returncode != 0:
+            executor.run(prefix + rule, check=True, stdout = subprocess.DEVNULL)
+        step_applied([], [rule, rule.replace(' -A ', ' -D ', 1)])
+
+    # Map elements are compared with the running map. They are deleted by their key and added in one transaction each,
+    # which keeps the counters of the other elements.
+    removed_elements = [e for e in old_artifact if re.match(r"^(tcp|udp) \. [0-9-]+ : [0-9.]+$", e) and e not in new_lines]
+    added_elements = [e for e in new_artifact if re.match(r"^(tcp|udp) \. [0-9-]+ : [0-9.]+$", e) and e not in old_lines]
+
+    if len(removed_elements) + len(added_elements) > 0:
+        map_output = executor.run(f"{prefix}nft list map ip {table} forward_ports", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, probe=True).stdout or ''
+        running = dict([(f"{protocol} . {port_range}", address) for protocol, port_range, address, _, _ in parse_nft_counters(iter_lines(map_output))])
+        stale_keys = []
+        missing_elements = []
+
+        for element in removed_elements:
+            key, _, address = element.partition(' : ')
+            if running.get(key) == address:
+                stale_keys.append(key)
+
+        # A key that already goes to another peer has to be deleted before it can be added again.
+        for element in added_elements:
+            key, _, address = element.partition(' : ')
+            if running.get(key) == address:
+                continue
+            if key in running and key not in stale_keys:
+                stale_keys.append(key)
+            missing_elements.append(element)
+
+        if len(stale_keys) > 0:
+            executor.run(f"{prefix}nft delete element ip {table} forward_ports {{ {', '.join(stale_keys)} }}", check=True, stdout = subprocess.DEVNULL)
+
+        step_applied(removed_elements, [])
+
+        if len(missing_elements) > 0:
+            executor.run(f"{prefix}nft add element ip {table} forward_ports {{ {', '.join(missing_elements)} }}", check=True, stdout = subprocess.DEVNULL)
+
+        step_applied([], added_elements)
+
+    print_info(f"{interface}: {len(set(new_peers) - old_peers)} peers added, {len(old_peers - set(new_peers))} removed, {len(added_rules) + len(added_elements)} forward rules added, {len(removed_rules) + len(removed_elements)} removed.")
+
+def provision(args, executor):
+    with executor.phase('verify'):
+        program_config_dict = load_program_config(executor)
+
+        # Verify program_config_dict
+        if not verify_config(program_config_dict):
+            sys.exit(1)
+
+        program_config_dict = normalize_config(program_config_dict)
+
+    # --plan and dry runs never ask server_url_api, and show a placeholder if the existing profiles have no address either.
+    server_url = args.server_url or detect_server_url(executor, program_config_dict, fetch=not args.plan)
+
+    if server_url is None and (args.plan or executor.simulated):
+        print_warn(f"The public address of this server is not known without asking {server_url_api}. I will show {server_url_placeholder} in its place.")
+        server_url = server_url_placeholder
+
+    if server_url is None:
+        print_error("The public address of this server cannot be detected. Please specify it with --server-url.")
+        sys.exit(1)
+
+    shards = args.shards or count_shards(executor, program_config_dict)
+
+    if shards * max_peers < len(program_config_dict) or shards > max_shards:
+        print_error(f"{len(program_config_dict)} peers need between {-(-len(program_config_dict) // max_peers)} and {max_shards} shards.")
+        sys.exit(1)
+
+    assignment = assign_peer_addresses(executor, program_config_dict, shards)
+    shard_configs = split_config(program_config_dict, assignment, shards)
+    # A shard without peers would start the image in client mode, so only shard 0 is run when it has no peers.
+    active_shards = [e for e in range(shards) if e == 0 or len(shard_configs[e]) > 0]
+
+    existing_configuration = len(executor.list_dir(wireguard_config_path)) > 0
+    native = args.server_backend == 'native'
+    peer_dns = native_peer_dns if native else None
+
+    if args.scripts_only:
+        with executor.phase('keys'):
+            _, peer_configs = seed_wireguard_config(executor, program_config_dict, server_url, assignment, peer_dns)
+        with executor.phase('scripts'):
+            write_auto_setup_scripts(executor, program_config_dict, peer_configs)
+        return
+
+    state = OrderedDict() if args.force else load_state(executor)
+    state_phases = state.get('phases', OrderedDict())
+    new_state = OrderedDict([('config-hash', hash_object(program_config_dict)), ('server-backend', args.server_backend), ('forward-backend', args.forward_backend), ('phases', OrderedDict(state_phases))])
+
+    def shard_phase(name, shard):
+        return name if shard == 0 else f"{name}-{shard}"
+
+    with executor.phase('render'):
+        ufw_found = executor.run("which ufw", stdout = subprocess.DEVNULL, probe=True).returncode == 0
+        sshd_ports = get_sshd_ports(executor) if ufw_found else []
+        uplink = 'eth+'
+
+        if native:
+            uplink = get_uplink_interface(executor)
+
+            if uplink is None:
+                print_error("The network interface of the default route cannot be found, so I cannot forward ports on this server.")
+                sys.exit(1)
+
+        ufw_allow_rules = render_ufw_allow_rules(program_config_dict, sshd_ports, active_shards[-1] + 1)
+        docker_runs = OrderedDict()
+        # What a container is created with, apart from its published ports and peers.
+        docker_settings = OrderedDict()
+        wg0_rules = OrderedDict()
+        nft_rulesets = OrderedDict()
+
+        for shard in active_shards:
+            docker_runs[shard] = render_docker_run(shard_configs[shard], server_url, shard, wireguard_nft_image if args.forward_backend == 'nft' else wireguard_image)
+            docker_settings[shard] = render_docker_run(OrderedDict(), server_url, shard, wireguard_nft_image if args.forward_backend == 'nft' else wireguard_image)
+            wg0_rules[shard] = render_wg0_postup_postdown(shard_configs[shard], assignment, args.forward_backend, args.server_backend, shard, uplink)
+            nft_rulesets[shard] = render_nft_ruleset(shard_configs[shard], assignment, shard, uplink) if args.forward_backend == 'nft' else None
+
+    # The docker backend keeps a container and a wg0.conf per shard, the native backend a wireguard interface on the host per shard.
+    server_phase = 'server' if native else 'container'
+    config_phase = 'server' if native else 'wg0'
+
+    phases = OrderedDict()
+    phases['firewall'] = OrderedDict([('hash', hash_object(ufw_allow_rules)), ('artifact', [f"allow {port_range}/{protocol}" for protocol, port_range in ufw_allow_rules])])
+
+    for shard in active_shards:
+        postup, postdown = wg0_rules[shard]
+        rules_hash = [postup, postdown] if nft_rulesets[shard] is None else [postup, postdown, nft_rulesets[shard]]
+        rules_artifact = render_rules_artifact(postup, postdown, nft_rulesets[shard])
+
+        if native:
+            phases[shard_phase('server', shard)] = OrderedDict([('hash', hash_object([list(shard_configs[shard].keys())] + rules_hash)), ('artifact', [f"PEERS={','.join(shard_configs[shard].keys())}"] + rules_artifact)])
+        else:
+            phases[shard_phase('container', shard)] = OrderedDict([('hash', hash_object(docker_runs[shard])), ('artifact', [docker_settings[shard]] + render_docker_run_publish(shard_configs[shard]) + [f"PEERS={','.join(shard_configs[shard].keys())}"])])
+            phases[shard_phase('wg0', shard)] = OrderedDict([('hash', hash_object(rules_hash)), ('artifact', rules_artifact)])
+
+    # Servers that were running before but have no peers any more, or belong to the other backend, are stopped.
+    retired_containers = sorted(set([0 if e == 'container' else int(e.rpartition('-')[2]) for e in state_phases.keys() if re.match(r"^container(-[0-9]+)?$", e)]) - set([] if native else active_shards))
+    retired_interfaces = sorted(set([0 if e == 'server' else int(e.rpartition('-')[2]) for e in state_phases.keys() if re.match(r"^server(-[0-9]+)?$", e)]) - set(active_shards if native else []))
+
+    def phase_changed(name):
+        return name not in state_phases or state_phases[name].get('hash') != phases[name]['hash']
+
+    def phase_applied(name):
+        new_state['phases'][name] = phases[name]
+        save_state(executor, new_state)
+
+    def phase_progress(name, artifact):
+        # Keeps the hash of the last complete run, so the phase still counts as changed, but records what is already applied.
+        new_state['phases'][name] = OrderedDict([('hash', state_phases.get(name, {}).get('hash')), ('artifact', artifact)])
+        save_state(executor, new_state)
+
+    def phase_retired(names):
+        for name in names:
+            new_state['phases'].pop(name, None)
+        save_state(executor, new_state)
+
+    package_caches = []
+
+    def get_package_cache(set_names, images):
+        # The package cache is opened on first use and only checked for what has to be installed.
+        if len(package_caches) == 0:
+            package_caches.append(open_package_cache(executor, args.cache))
+
+        cache_path = package_caches[0][0]
+
+        if cache_path is None or len(set_names) + len(images) == 0:
+            return cache_path
+
+        problems = check_package_cache(executor, cache_path, set_names, images, get_distribution(executor), args.cache_max_age)
+
+        if len(problems) > 0:
+            print_warn(f"I cannot use the package cache in {str(cache_path)}, so I will download instead.")
+            for problem in problems:
+                print_warn(problem)
+            return None
+
+        return cache_path
+
+    if native:
+        wg0_config_paths = OrderedDict([(shard, native_config_path / f"{get_shard_interface(shard)}.conf") for shard in active_shards])
+    else:
+        wg0_config_paths = OrderedDict([(shard, get_shard_path(shard) / "wg_confs/wg0.conf") for shard in active_shards])
+    nft_ruleset_paths = OrderedDict([(shard, get_shard_path(shard) / wg0_nft_ruleset_name) for shard in active_shards])
+
+    if args.plan:
+        if ufw_found:
+            print_plan_diff('firewall', state_phases.get('firewall', {}).get('artifact', []), phases['firewall']['artifact'])
+        else:
+            print_info("ufw was not found. The firewall will not be set up.")
+
+        for shard in active_shards:
+            postup, postdown = wg0_rules[shard]
+            wg0_config_path = wg0_config_paths[shard]
+            nft_ruleset_path = nft_ruleset_paths[shard]
+
+            print_plan_diff(shard_phase(server_phase, shard), state_phases.get(shard_phase(server_phase, shard), {}).get('artifact', []), phases[shard_phase(server_phase, shard)]['artifact'])
+
+            if not native and executor.is_file(wg0_config_path):
+                wg0_config_text = executor.read_text(wg0_config_path)
+                print_plan_diff(str(wg0_config_path), wg0_config_text.split('\n'), render_wg0_config(wg0_config_text, postup, postdown).split('\n'))
+            elif not native:
+                print_warn(f"{str(wg0_config_path)} will be created by the wireguard server and forward rules will be added to it.")
+
+            if nft_rulesets[shard] is not None:
+                print_plan_diff(str(nft_ruleset_path), executor.read_text(nft_ruleset_path).split('\n') if executor.is_file(nft_ruleset_path) else [], nft_rulesets[shard].split('\n'))
+
+        for shard in retired_containers:
+            print_warn(f"The container {get_shard_container(shard)} will be stopped.")
+
+        for shard in retired_interfaces:
+            print_warn(f"The wireguard interface {get_shard_interface(shard)} will be stopped.")
+
+        for peer, forward_rules in program_config_dict.items():
+            auto_setup_script_path = program_path.with_name(f"auto-setup-{peer}.py")
+            peer_config_path = get_shard_path(assignment[peer][0]) / f"peer_{peer}/peer_{peer}.conf"
+
+            if not executor.is_file(peer_config_path):
+                print_warn(f"{auto_setup_script_path.name} will be created together with new keys and a new profile for {peer}.")
+            elif not executor.is_file(auto_setup_script_path) or executor.read_text(auto_setup_script_path) != render_auto_setup_script(peer, forward_rules, executor.read_text(peer_config_path)):
+                print_warn(f"{auto_setup_script_path.name} will be changed.")
+            else:
+                print_info(f"{auto_setup_script_path.name} is up to date.")
+
+        return
+
+    # Configure ufw firewall
+    with executor.phase('firewall'):
+        if not ufw_found:
+            print_info("ufw was not found. I will skip setting up the firewall.")
+        elif not phase_changed('firewall'):
+            print_info("The firewall rules have not changed. I will skip setting up the firewall.")
+        elif args.watch and 'firewall' in state_phases:
+            # Resetting ufw would drop it for a moment, so only the rules that changed are added or deleted.
+            # ufw skips rules that already exist and rules it cannot find, and the progress is saved after every rule.
+            old_allow_rules = state_phases['firewall'].get('artifact', [])
+            applied_rules = list(old_allow_rules)
+            print_info("The firewall rules have changed. I will add and delete only the rules that changed.")
+
+            for rule in [e for e in old_allow_rules if e not in phases['firewall']['artifact']]:
+                executor.run(f"sudo ufw delete {rule}", check=True, stdout = subprocess.DEVNULL)
+                applied_rules.remove(rule)
+                phase_progress('firewall', applied_rules)
+
+            for rule in [e for e in phases['firewall']['artifact'] if e not in old_allow_rules]:
+                executor.run(f"sudo ufw {rule}", check=True, stdout = subprocess.DEVNULL)
+                applied_rules.append(rule)
+                phase_progress('firewall', applied_rules)
+
+            phase_applied('firewall')
+        else:
+            print_info("ufw was found. I'm going to reset the firewall and set it up from scratch.")
+
+            if len(sshd_ports) > 0:
+                print_info(f"It seems that the ssh server is using the following port. {sshd_ports}")
+
+            configure_ufw(executor, ufw_allow_rules)
+            phase_applied('firewall')
+
+    if native:
+        # Install wireguard
+        with executor.phase('wireguard-install'):
+            if executor.run("which wg-quick", stdout = subprocess.DEVNULL, probe=True).returncode == 0 and (args.forward_backend != 'nft' or executor.run("which nft", stdout = subprocess.DEVNULL, probe=True).returncode == 0):
+                print_info("wg-quick was found. I will skip installing wireguard.")
+            else:
+                print_info("wg-quick was not found. I'm going to install wireguard.")
+                install_wireguard(executor, args.forward_backend, get_package_cache(['wireguard-nftables' if args.forward_backend == 'nft' else 'wireguard'], []))
+
+            if not executor.is_file(native_sysctl_path) or executor.read_text(native_sysctl_path) != "net.ipv4.ip_forward = 1\n":
+                print_info("I will let this server forward packets between the internet and the peers.")
+
+                executor.write_text(native_sysctl_path, "net.ipv4.ip_forward = 1\n")
+                executor.run("sudo sysctl -w net.ipv4.ip_forward=1", check=True, stdout = subprocess.DEVNULL)
+    else:
+        # Install docker
+        with executor.phase('docker-install'):
+            if executor.run("which docker", stdout = subprocess.DEVNULL, probe=True).returncode == 0:
+                print_info("Docker was found. I will skip installing docker.")
+            else:
+                print_info("Docker was not found. I'm going to install docker.")
+                install_docker(executor, get_package_cache(['docker'], []))
+
+            # docker run would pull the image, so it is loaded from the cache first. The nftables image cannot be pulled and is built otherwise.
+            image = wireguard_nft_image if args.forward_backend == 'nft' else wireguard_image
+
+            if executor.run(f"sudo docker image inspect {image}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, probe=True).returncode != 0:
+                if get_package_cache([], []) is not None and get_package_cache([], [image]) is not None:
+                    print_info(f"I will load {image} from the package cache instead of {'building' if image == wireguard_nft_image else 'pulling'} it.")
+                    executor.run(f"sudo docker load -i {str(get_package_cache([], []) / package_cache_images[image])}", check=True, stdout = subprocess.DEVNULL)
+                elif image == wireguard_nft_image:
+                    print_info(f"I will build {wireguard_nft_image}, which adds nftables to {wireguard_image}.")
+
+                    if not build_wireguard_nft_image(executor):
+                        print_error(f"{wireguard_nft_image} cannot be built. Run this script again with internet access or with a package cache made by 'wg-wizard.py --bundle', or use '--forward-backend iptables'.")
+                        sys.exit(1)
+
+        # Apply tweak to Docker
+        with executor.phase('docker-tweak'):
+            if executor.is_file(docker_config_path):
+                docker_config_dict = json.loads(executor.read_text(docker_config_path), object_pairs_hook=OrderedDict) or OrderedDict()
+            else:
+                docker_config_dict = OrderedDict()
+
+            if 'userland-proxy' not in docker_config_dict or docker_config_dict['userland-proxy'] == True:
+                print_info("I will apply a tweak to prevent docker from using the userland proxy.")
+
+                docker_config_dict['userland-proxy'] = False
+
+                executor.write_text(docker_config_path, json.dumps(docker_config_dict, indent=2, sort_keys=False))
+
+                executor.run("sudo systemctl restart docker.service", check=True, stdout = subprocess.DEVNULL)
+            else:
+                print_info("The tweak is already applied to docker.")
+
+    # Nothing else is installed from the package cache.
+    for cache_path, temporary in package_caches:
+        close_package_cache(executor, cache_path, temporary)
+
+    # Generate keys and peer profiles
+    with executor.phase('keys'):
+        peer_public_keys, _ = seed_wireguard_config(executor, program_config_dict, server_url, assignment, peer_dns)
+
+    # Stop servers that are not needed any more
+    for shard in retired_containers:
+        with executor.phase(shard_phase('container', shard)):
+            print_info(f"The container {get_shard_container(shard)} is not needed any more. I will stop it.")
+
+            executor.run(f"sudo docker stop {get_shard_container(shard)}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            executor.run(f"sudo docker rm {get_shard_container(shard)}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            phase_retired([shard_phase('container', shard), shard_phase('wg0', shard)])
+
+    for shard in retired_interfaces:
+        with executor.phase(shard_phase('server', shard)):
+            print_info(f"The wireguard interface {get_shard_interface(shard)} is not needed any more. I will stop it.")
+
+            executor.run(f"sudo systemctl disable --now {get_shard_interface(shard)}.service", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            phase_retired([shard_phase('server', shard)])
+
+    if native:
+        # Run wireguard servers on the host
+        for shard in active_shards:
+            with executor.phase(shard_phase('server', shard)):
+                interface = get_shard_interface(shard)
+                server_config_path = wg0_config_paths[shard]
+                service_path = native_service_path / f"{interface}.service"
+                server_config_text = render_native_server_config(executor, shard_configs[shard], assignment, shard, *wg0_rules[shard])
+                service_text = native_service_template.format(interface=interface)
+                nft_ruleset = nft_rulesets[shard]
+                nft_ruleset_path = nft_ruleset_paths[shard]
+                nft_ruleset_changed = nft_ruleset is not None and (not executor.is_file(nft_ruleset_path) or executor.read_text(nft_ruleset_path) != nft_ruleset)
+
+                if nft_ruleset_changed:
+                    executor.write_text(nft_ruleset_path, nft_ruleset)
+
+                service_changed = not executor.is_file(service_path) or executor.read_text(service_path) != service_text
+                old_artifact = state_phases.get(shard_phase('server', shard), {}).get('artifact')
+                live = args.watch and not service_changed and executor.is_file(server_config_path) and is_live_change(old_artifact, phases[shard_phase('server', shard)]['artifact'])
+
+                if service_changed:
+                    executor.write_text(service_path, service_text)
+                    executor.run("sudo systemctl daemon-reload", check=True, stdout = subprocess.DEVNULL)
+                    executor.run(f"sudo systemctl enable {interface}.service", check=True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+                if live and (executor.read_text(server_config_path) != server_config_text or phase_changed(shard_phase('server', shard))):
+                    print_info(f"I will apply the changes to the running wireguard interface {interface} without restarting it.")
+
+                    executor.write_text(server_config_path, server_config_text, mode=0o600)
+                    apply_live_changes(executor, interface, get_shard_nft_table(shard), old_artifact, phases[shard_phase('server', shard)]['artifact'], assignment, lambda peer: get_shard_path(shard) / f"peer_{peer}", lambda artifact: phase_progress(shard_phase('server', shard), artifact))
+                elif not executor.is_file(server_config_path) or executor.read_text(server_config_path) != server_config_text or phase_changed(shard_phase('server', shard)):
+                    print_info(f"I'm going to run the wireguard interface {interface} on this server.")
+
+                    executor.write_text(server_config_path, server_config_text, mode=0o600)
+                    executor.run(f"sudo systemctl restart {interface}.service", check=True, stdout = subprocess.DEVNULL)
+                elif nft_ruleset_changed:
+                    print_info(f"Only the nftables forward rules of {interface} have changed. I will load them.")
+
+                    executor.run(f"sudo nft -f {str(nft_ruleset_path)}", check=True, stdout = subprocess.DEVNULL)
+                else:
+                    print_info(f"The peers and forward rules of {interface} have not changed. I will keep it running.")
+
+                phase_applied(shard_phase('server', shard))
+    else:
+        # Run wireguard servers
+        # The time each recreated container was started, as wg0.conf files older than that are left over from the last one.
+        started_shards = OrderedDict()
+
+        for shard in active_shards:
+            with executor.phase(shard_phase('container', shard)):
+                container = get_shard_container(shard)
+                old_artifact = state_phases.get(shard_phase('container', shard), {}).get('artifact')
+                live = args.watch and executor.is_file(wg0_config_paths[shard]) and is_live_change(old_artifact, phases[shard_phase('container', shard)]['artifact'])
+
+                if not phase_changed(shard_phase('container', shard)):
+                    print_info(f"The published ports and peers of {container} have not changed. I will keep the running wireguard server.")
+                elif live:
+                    # The peer list the container was created with goes stale, but it only counts when the container is created again.
+                    print_info(f"The published ports of {container} have not changed. I will apply the changed peers to the running wireguard server without recreating it.")
+
+                    executor.write_text(wg0_config_paths[shard], render_wg0_config_peers(executor, executor.read_text(wg0_config_paths[shard]), shard_configs[shard], assignment, shard))
+                    apply_live_changes(executor, 'wg0', get_shard_nft_table(shard), old_artifact, phases[shard_phase('container', shard)]['artifact'], assignment, lambda peer: get_shard_path(shard) / f"peer_{peer}", lambda artifact: phase_progress(shard_phase('container', shard), artifact), f"sudo docker exec {container} ", lambda peer: pathlib.Path('/config') / f"peer_{peer}")
+                    phase_applied(shard_phase('container', shard))
+                else:
+                    if shard == 0 and existing_configuration and 'container' not in state_phases:
+                        print_warn("There is an existing configuration for the wireguard server. Updating your current settings is not guaranteed and may conflict with your existing settings.")
+
+                    if args.watch and shard_phase('container', shard) in state_phases:
+                        print_warn(f"Docker can only publish ports when a container is created, so I have to recreate {container} and the tunnels of its peers will reconnect. '--server-backend native' applies these changes without restarting anything.")
+
+                    print_info("I'm going to run the wireguard server using the following command.")
+                    print(docker_runs[shard])
+
+                    executor.run(f"sudo docker stop {container}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+                    executor.run(f"sudo docker rm {container}", stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+                    started_shards[shard] = time.time()
+                    executor.run(docker_runs[shard], check=True, shell=True, stdout = subprocess.DEVNULL)
+                    phase_applied(shard_phase('container', shard))
+
+        # Wait for the wireguard server configuration
+        with executor.phase('wg0-wait'):
+            # The peer profiles are written by this script beforehand, so only wg0.conf is waited for.
+            wireguard_config_files = list(wg0_config_paths.values())
+            newer_than = OrderedDict([(wg0_config_paths[e], start_time) for e, start_time in started_shards.items()])
+            already_present = set([e for e in wireguard_config_files if executor.is_file(e) and e not in newer_than])
+            wait_start_time = time.time()
+            ready = executor.wait_for_files(wireguard_config_files, args.wait_timeout, newer_than)
+
+            for path, elapsed in ready.items():
+                if path not in already_present:
+                    print_info(f"{str(path)} appeared after {elapsed:.2f} seconds.")
+
+            missing = [e for e in wireguard_config_files if e not in ready]
+
+            if len(missing) > 0 and executor.simulated:
+                print_warn(f"{str(missing[0])} would be written by the wireguard server. The remaining steps cannot be simulated.")
+                return
+
+            if len(missing) > 0:
+                for path in missing:
+                    print_error(f"{str(path)} file cannot be found." if not executor.is_file(path) else f"{str(path)} file has not been rewritten by the new wireguard server.")
+                sys.exit(1)
+
+            # The server appends one [Peer] section per peer to wg0.conf after creating it, so wait until every peer is in it.
+            wg0_config_texts = OrderedDict()
+
+            for shard in active_shards:
+                wg0_config_path = wg0_config_paths[shard]
+                wg0_config_texts[shard] = executor.read_text(wg0_config_path)
+
+                while not all([peer_public_keys[e] in wg0_config_texts[shard] for e in shard_configs[shard].keys()]):
+                    if (time.time() - wait_start_time) >= args.wait_timeout:
+                        print_error(f"{str(wg0_config_path)} file does not contain every peer.")
+                        sys.exit(1)
+                    time.sleep(0.2)
+                    wg0_config_texts[shard] = executor.read_text(wg0_config_path)
+
+        # Edit wg0.conf
+        for shard in active_shards:
+            with executor.phase(shard_phase('wg0', shard)):
+                container = get_shard_container(shard)
+                wg0_config_path = wg0_config_paths[shard]
+                wg0_config_text = wg0_config_texts[shard]
+                nft_ruleset = nft_rulesets[shard]
+                nft_ruleset_path = nft_ruleset_paths[shard]
+                new_wg0_config_text = render_wg0_config(wg0_config_text, *wg0_rules[shard])
+                nft_ruleset_changed = nft_ruleset is not None and (not executor.is_file(nft_ruleset_path) or executor.read_text(nft_ruleset_path) != nft_ruleset)
+
+                if nft_ruleset_changed:
+                    executor.write_text(nft_ruleset_path, nft_ruleset)
+
+                old_artifact = state_phases.get(shard_phase('wg0', shard), {}).get('artifact')
+                live = args.watch and shard not in started_shards and is_live_change(old_artifact, phases[shard_phase('wg0', shard)]['artifact'])
+
+                if live and (new_wg0_config_text != wg0_config_text or phase_changed(shard_phase('wg0', shard))):
+                    print_info(f"I will apply the changed forward rules to the running wireguard server in {container} without restarting it.")
+
+                    executor.write_text(wg0_config_path, new_wg0_config_text)
+                    apply_live_changes(executor, 'wg0', get_shard_nft_table(shard), old_artifact, phases[shard_phase('wg0', shard)]['artifact'], assignment, lambda peer: get_shard_path(shard) / f"peer_{peer}", lambda artifact: phase_progress(shard_phase('wg0', shard), artifact), f"sudo docker exec {container} ")
+                elif new_wg0_config_text != wg0_config_text or shard in started_shards:
+                    print_info(f"I will add forward rules to {container}.")
+
+                    executor.write_text(wg0_config_path, new_wg0_config_text)
+
+                    executor.run(f"sudo docker restart {container}", check=True, stdout = subprocess.DEVNULL)
+                elif nft_ruleset_changed:
+                    print_info(f"Only the nftables forward rules of {container} have changed. I will load them into the running wireguard server.")
+
+                    executor.run(f"sudo docker exec {container} nft -f /config/{wg0_nft_ruleset_name}", check=True, stdout = subprocess.DEVNULL)
+                else:
+                    print_info(f"The forward rules of {container} have not changed. I will skip restarting it.")
+
+                phase_applied(shard_phase('wg0', shard))
+
+    # Generate auto setup scripts
+    with executor.phase('scripts'):
+        write_auto_setup_scripts(executor, program_config_dict, OrderedDict([(peer, executor.read_text(get_shard_path(assignment[peer][0]) / f"peer_{peer}/peer_{peer}.conf")) for peer in program_config_dict.keys()]))
+
+    print_info("This is the end of the script.")
+
+def iter_lines(text):
+    # Yields one line at a time, so a long command output is never copied as a whole.
+    start = 0
+
+    while start < len(text):
+        end = text.find('\n', start)
+        end = len(text) if end == -1 else end
+        yield text[start:end]
+        start = end + 1
+
+def parse_wg_dump(lines):
+    # Yields (public key, latest handshake, received bytes, sent bytes) for every peer line of 'wg show <interface> dump' or 'wg show all dump'.
+    # Interface lines have 4 or 5 fields and peer lines 8 or 9, depending on whether the interface name is in front.
+    # Numbers are yielded as the digits wg printed, because they go into the metrics unchanged.
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+
+        if len(fields) not in [8, 9]:
+            continue
+
+        offset = len(fields) - 8
+
+        if fields[offset + 4].isdigit() and fields[offset + 5].isdigit() and fields[offset + 6].isdigit():
+            yield fields[offset], fields[offset + 4], fields[offset + 5], fields[offset + 6]
+
+def parse_iptables_counters(lines):
+    # Yields (protocol, port range, destination, packets, bytes) for every DNAT rule of 'iptables -t nat -L PREROUTING -v -x -n'.
+    for line in lines:
+        match = iptables_dnat_counter_pattern.match(line)
+
+        if match is not None:
+            yield match.group(3), match.group(4) if match.group(5) is None else f"{match.group(4)}-{match.group(5)}", match.group(6), match.group(1), match.group(2)
+
+def parse_nft_counters(lines):
+    # Yields the same tuples for every element of the forward_ports map. nft prints several elements on one line.
+    for line in lines:
+        for match in nft_element_counter_pattern.finditer(line):
+            yield match.group(1), match.group(2), match.group(5), match.group(3), match.group(4)
+
+class MetricsCollector:
+    # Reads the counters of every wireguard server and labels them with the peer names and port ranges of wg-wizard.json.
+    # Labels are rendered once and reused by every scrape until wg-wizard.json or the saved state changes.
+    def __init__(self, executor):
+        self.executor = executor
+        self.source_texts = None
+        self.servers = []
+        self.peer_labels = {}
+        self.rule_labels = {}
+
+    def reload(self):
+        source_texts = [self.executor.read_text(e) if self.executor.is_file(e) else '' for e in [program_config_path, program_state_path]]
+
+        if source_texts == self.source_texts:
+            return
+
+        self.source_texts = source_texts
+
+        try:
+            program_config_dict = json.loads(source_texts[0], object_pairs_hook=OrderedDict) or OrderedDict()
+            state = json.loads(source_texts[1], object_pairs_hook=OrderedDict) if source_texts[1] else OrderedDict()
+        except ValueError:
+            print_warn(f"{str(program_config_path)} or {str(program_state_path)} cannot be read. I will keep the labels of the last configuration.")
+            return
+
+        # A configuration that cannot be assigned to the servers ends in sys.exit, which must not end the exporter.
+        try:
+            if not verify_config(program_config_dict):
+                print_warn("I will keep the labels of the last valid configuration.")
+                return
+
+            self.servers, self.peer_labels, self.rule_labels = self.render_labels(program_config_dict, state)
+        except (SystemExit, Exception) as e:
+            print_warn(f"The labels of {str(program_config_path)} cannot be rendered ({type(e).__name__}). I will keep the labels of the last valid configuration.")
+
+    def render_labels(self, program_config_dict, state):
+        program_config_dict = normalize_config(program_config_dict)
+        assignment = assign_peer_addresses(self.executor, program_config_dict, count_shards(self.executor, program_config_dict))
+        native = state.get('server-backend', 'docker') == 'native'
+        nft = state.get('forward-backend', 'iptables') == 'nft'
+        server_phase = 'server' if native else 'container'
+        shards = sorted(set([0 if e == server_phase else int(e.rpartition('-')[2]) for e in state.get('phases', {}).keys() if re.match(f"^{server_phase}(-[0-9]+)?$", e)])) or [0]
+
+        # Each server is (name, wg command, counter command). The iptables rules of every native server are in the table of the host, so they are read once.
+        servers = []
+
+        for shard in shards:
+            name = get_shard_interface(shard) if native else get_shard_container(shard)
+            prefix = "sudo " if native else f"sudo docker exec {name} "
+
+            if nft:
+                counter_command = f"{prefix}nft list map ip {get_shard_nft_table(shard)} forward_ports"
+            elif not native or shard == shards[0]:
+                counter_command = f"{prefix}iptables -t nat -L PREROUTING -v -x -n"
+            else:
+                counter_command = None
+
+            servers.append((name, f"{prefix}wg show {name if native else 'wg0'} dump", counter_command))
+
+        peer_labels = {}
+        rule_labels = {}
+
+        for peer, forward_rules in program_config_dict.items():
+            shard, address = assignment[peer]
+            public_key_path = get_shard_path(shard) / f"peer_{peer}/publickey-peer_{peer}"
+            server = get_shard_interface(shard) if native else get_shard_container(shard)
+
+            if self.executor.is_file(public_key_path):
+                peer_labels[self.executor.read_text(public_key_path).strip()] = f'peer="{peer}",server="{server}"'
+
+            for forward_rule in forward_rules:
+                rule_labels[(forward_rule['protocol'], forward_rule['port-range'], address)] = f'peer="{peer}",protocol="{forward_rule["protocol"]}",port_range="{forward_rule["port-range"]}"'
+
+        return servers, peer_labels, rule_labels
+
+    def collect(self):
+        start_time = time.time()
+        self.reload()
+        samples = OrderedDict([(e, []) for e in metric_families.keys()])
+
+        for name, wg_command, counter_command in self.servers:
+            wg_result = self.executor.run(wg_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, probe=True)
+            samples['wg_wizard_server_up'].append(f'wg_wizard_server_up{{server="{name}"}} {1 if wg_result.returncode == 0 else 0}')
+
+            if wg_result.returncode == 0:
+                for public_key, latest_handshake, received_bytes, sent_bytes in parse_wg_dump(iter_lines(wg_result.stdout)):
+                    labels = self.peer_labels.get(public_key)
+
+                    if labels is not None:
+                        samples['wg_wizard_peer_latest_handshake_seconds'].append(f"wg_wizard_peer_latest_handshake_seconds{{{labels}}} {latest_handshake}")
+                        samples['wg_wizard_peer_receive_bytes_total'].append(f"wg_wizard_peer_receive_bytes_total{{{labels}}} {received_bytes}")
+                        samples['wg_wizard_peer_transmit_bytes_total'].append(f"wg_wizard_peer_transmit_bytes_total{{{labels}}} {sent_bytes}")
+
+            if counter_command is None:
+                continue
+
+            counter_result = self.executor.run(counter_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, probe=True)
+
+            if counter_result.returncode != 0:
+                continue
+
+            parse_counters = parse_nft_counters if counter_command.endswith('forward_ports') else parse_iptables_counters
+
+            for protocol, port_range, address, packets, counted_bytes in parse_counters(iter_lines(counter_result.stdout)):
+                labels = self.rule_labels.get((protocol, port_range, address))
+
+                if labels is not None:
+                    samples['wg_wizard_forward_packets_total'].append(f"wg_wizard_forward_packets_total{{{labels}}} {packets}")
+                    samples['wg_wizard_forward_bytes_total'].append(f"wg_wizard_forward_bytes_total{{{labels}}} {counted_bytes}")
+
+        samples['wg_wizard_scrape_duration_seconds'].append(f"wg_wizard_scrape_duration_seconds {time.time() - start_time:.6f}")
+        # The metrics server runs for months, so the timings the executor records for every command are dropped.
+        del self.executor.events[:]
+        lines = []
+
+        for family, (metric_type, help_text) in metric_families.items():
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {metric_type}"] + samples[family]
+
+        return '\n'.join(lines) + '\n'
+
+def serve_metrics(args, executor):
+    collector = MetricsCollector(executor)
+
+    if args.metrics_once:
+        sys.stdout.write(collector.collect())
+        return
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.partition('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = collector.collect().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host, _, port = args.metrics_listen.rpartition(':')
+
+    try:
+        server = http.server.HTTPServer((host, int(port)), MetricsHandler)
+    except (OSError, ValueError) as e:
+        print_error(f"I cannot listen on {args.metrics_listen}. {e}")
+        sys.exit(1)
+
+    print_info(f"I will serve Prometheus metrics on http://{args.metrics_listen}/metrics.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def watch(args, executor):
+    provision(args, executor)
+    applied_text = executor.read_text(program_config_path)
+    print_info(f"I'm watching {str(program_config_path)} for changes. Press Ctrl+C to stop.")
+
+    while True:
+        # A change that was saved while nothing was watching is still picked up when the wait times out.
+        wait_for_change(program_config_path, 60)
+        change_time = time.time()
+
+        # Wait until the editor has finished writing before reading the file.
+
+        while wait_for_change(program_config_path, 0.1):
+            pass
+
+        if not executor.is_file(program_config_path) or executor.read_text(program_config_path) == applied_text:
+            continue
+
+        applied_text = executor.read_text(program_config_path)
+        start_time = time.time()
+
+        try:
+            provision(args, executor)
+        except (SystemExit, Exception) as e:
+            # Nothing a bad edit of wg-wizard.json causes may stop the watch.
+            print_error(f"The changes could not be applied{'' if isinstance(e, SystemExit) else f'. {type(e).__name__}: {e}'}. I will try again when {program_config_path.name} changes.")
+            continue
+        finally:
+            # The watch runs for a long time, so the timings the executor records for every reload are dropped.
+            del executor.events[:]
+
+        print_info(f"The changes were applied {time.time() - start_time:.3f} seconds after I started and {time.time() - change_time:.3f} seconds after {program_config_path.name} was saved.")
+
+def main(argv=None, executor=None):
+    parser = argparse.ArgumentParser(description="Set up a wireguard server with port forwarding and create auto setup scripts for its peers.")
+    parser.add_argument('--plan', action='store_true', help="print what would change compared to the last applied configuration without changing anything")
+    parser.add_argument('--force', action='store_true', help="ignore the saved state and apply every phase again")
+    parser.add_argument('--server-url', help="address the peers use to reach this server (default: the endpoint of the existing profiles or the public IPv4 address of this server)")
+    parser.add_argument('--scripts-only', action='store_true', help="only generate the keys, peer profiles and auto setup scripts without touching the firewall or docker")
+    parser.add_argument('--server-backend', choices=server_backends, default='docker', help="how the wireguard server runs. native runs it with wg-quick and a systemd unit directly on this server and forwards ports on the host, without docker (default: %(default)s)")
+    parser.add_argument('--forward-backend', choices=forward_backends, default='iptables', help="how the wireguard server forwards ports to the peers. nft loads a single nftables table with one map lookup per packet instead of one iptables rule per port range (default: %(default)s)")
+    parser.add_argument('--shards', type=int, metavar='N', help=f"number of wireguard servers the peers are spread over, each with its own container, listen port and subnet. Up to {max_peers} peers fit into one (default: as many as already exist or as the peers need)")
+    parser.add_argument('--wait-timeout', type=float, default=300, metavar='SECONDS', help="how long to wait for the wireguard server to generate its configuration (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true', help="go through every phase and print the commands and file writes instead of executing them")
+    parser.add_argument('--timing-report', metavar='PATH', help="write the wall-clock time of every phase, command and file write to a JSON file")
+    parser.add_argument('--chrome-trace', metavar='PATH', help="write the same timings as a trace file for chrome://tracing or Perfetto")
+    parser.add_argument('--bundle', nargs='?', const=str(package_cache_path), metavar='PATH', help=f"download every package wg-wizard.py and the auto setup scripts install, and the wireguard image, into a cache directory, or a tarball if PATH ends with .tar, .tar.gz or .tgz, and exit (default: {package_cache_path.name} next to this script)")
+    parser.add_argument('--cache', metavar='PATH', help=f"cache directory or tarball to install packages and the wireguard image from, without apt-get update and image pulls (default: {package_cache_path.name} next to this script, if it exists)")
+    parser.add_argument('--cache-max-age', type=float, default=package_cache_max_age_days, metavar='DAYS', help="days after which the cache is considered stale and packages are downloaded instead, 0 never expires (default: %(default)s)")
+    parser.add_argument('--watch', action='store_true', help="keep running and apply every change of wg-wizard.json to the running servers. Peers and forward rules are added and deleted live where the server backend allows it, without restarting anything")
+    parser.add_argument('--metrics', action='store_true', help="serve handshakes and transfer of every peer and the counters of every forward rule as Prometheus metrics instead of setting up the server")
+    parser.add_argument('--metrics-once', action='store_true', help="print the Prometheus metrics once and exit")
+    parser.add_argument('--metrics-listen', default=metrics_listen, metavar='HOST:PORT', help="address the metrics are served on (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.metrics or args.metrics_once:
+        serve_metrics(args, executor or RealExecutor())
+        return
+
+    if executor is None:
+        executor = RecordingExecutor() if args.dry_run else RealExecutor()
+
+    try:
+        if args.bundle:
+            bundle_package_cache(executor, args.bundle)
+        elif args.watch:
+            watch(args, executor)
+        else:
+            provision(args, executor)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+    finally:
+        if args.dry_run:
+            print_info("The following commands would have been run.")
+            print('\n'.join(executor.commands))
+            print_info("The following files would have been written.")
+            print('\n'.join([str(e) for e in executor.files.keys()]))
+            if len(executor.requests) > 0:
+                print_info("The following addresses would have been requested.")
+                print('\n'.join(executor.requests))
+        if args.timing_report:
+            executor.write_report(args.timing_report)
+        if args.chrome_trace:
+            executor.write_chrome_trace(args.chrome_trace)
+
+if __name__ == '__main__':
+    main()